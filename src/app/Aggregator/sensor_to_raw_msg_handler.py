@@ -6,10 +6,13 @@ the data streams for the sensor objects and sets up threads for each one using t
 import app.lib.message_handler as message_handler
 import app.lib.messages as messages
 import app.Aggregator.sensors as sensors
+from app.lib.sharding import Router
+from app.lib.metrics import DEFAULT_METRICS, StageMetrics
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
 from multiprocessing import Process
 from mbientlab.metawear import MetaWear
 from timeit import default_timer as timer
-from time import sleep
+from time import sleep, time
 from sys import exit
 from threading import Condition, Event
 import logging, signal, json
@@ -20,7 +23,7 @@ class SensorProcess(Process):
     Inherits from Process class, used for starting a new process that initializes connections to two MetaWear MMR
     sensors and a message broker. It starts the data streams for the sensor objects and sets up threads for each one. 
     """
-    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, l_mac:str, r_mac:str, queue):
+    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, l_mac:str, r_mac:str, queue, transport:dict=None, sampling:dict=None, asset_id:str=None, partitions:int=None, metrics:dict=None, profiling:dict=None):
         """
         Args:
             client_id (str): Name of this process for use by Mosquitto msg broker.\n
@@ -28,7 +31,15 @@ class SensorProcess(Process):
             topic_pub (str): Broker topic to publish to.\n
             l_mac (str): Left wheel sensor mac address.\n
             r_mac (str): Right wheel sensor mac address.\n
-            queue (_type_): Multiprocessing Queue, used to tell parent process that setup is finished.
+            queue (_type_): Multiprocessing Queue, used to tell parent process that setup is finished.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            sampling (dict, optional): Keyword arguments for sensors.Sensor: odr_hz, gyro_only, averaging_depth and
+            decimate_ms. Defaults to None (25 Hz, fused acc and gyro, no on-board processing).\n
+            asset_id (str, optional): Identifies the asset in every message. Defaults to None, the left wheel mac address.\n
+            partitions (int, optional): Partitions of topic_pub when the raw stage is sharded, the readings are published
+            to the partition of asset_id. Defaults to None.\n
+            metrics (dict, optional): Counters, timings and resource usage reporting, see app.lib.metrics. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
         """ 
         Process.__init__(self)
         self.client_id = client_id
@@ -37,35 +48,51 @@ class SensorProcess(Process):
         self.l_mac = l_mac
         self.r_mac = r_mac
         self.queue = queue
+        self.transport = transport
+        self.sampling = sampling if sampling is not None else {}
+        self.asset_id = asset_id
+        self.partitions = partitions
+        self.metrics_config = dict(DEFAULT_METRICS)
+        if metrics is not None:
+            self.metrics_config.update(metrics)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
         self.logger = logging.getLogger('app')
         
     def run(self):
         try:
             # Setup interrupt signal handler
             signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
             
             self.logger.debug('Process Started')
             self.logger.info('Setting up Sensors...')
             
             self.cond = Condition()
             self.sensor_list = []
-            self.message = messages.Message(self.l_mac, self.r_mac)
+            self.message = messages.Message(self.l_mac, self.r_mac, self.asset_id)
+            # Readings are numbered from 1 in each run, the run (its start time in ms) tells a restart from a redelivery
+            self.message.payload['run'] = int(time() * 1000)
             
             # Create msg handler
-            self.handler = message_handler.Handler(self.client_id, self.topic_sub, self.topic_pub)
+            topic_pub = Router(self.topic_pub, self.partitions).topic(self.message.payload['asset_id'])
+            self.handler = message_handler.Handler(self.client_id, self.topic_sub, topic_pub, transport=self.transport)
             self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            # Received counts the packets of both sensors, processed and published the paired readings
+            self.metrics = StageMetrics(self.client_id, self.handler, **self.metrics_config)
             
             # Create sensor object and connect sensors
             self.left_device = MetaWear(self.l_mac)
             self.left_device.connect()
             self.logger.debug("Connected to left_device: %s ", self.left_device.address)
-            self.l_sensor = sensors.Sensor(self.left_device, self.cond, self.message, 'LSensor', self.handler, self.logger)
+            self.l_sensor = sensors.Sensor(self.left_device, self.cond, self.message, 'LSensor', self.handler, self.logger, metrics=self.metrics, **self.sampling)
             self.sensor_list.append(self.l_sensor)
             
             self.right_device = MetaWear(self.r_mac)
             self.right_device.connect()
             self.logger.debug("Connected to right_device: %s ", self.right_device.address)
-            self.r_sensor = sensors.Sensor(self.right_device, self.cond, self.message, 'RSensor', self.handler, self.logger)
+            self.r_sensor = sensors.Sensor(self.right_device, self.cond, self.message, 'RSensor', self.handler, self.logger, metrics=self.metrics, **self.sampling)
             self.sensor_list.append(self.r_sensor)
             
             # Setup sensors
@@ -75,6 +102,7 @@ class SensorProcess(Process):
                 
             # Start polling and publishing
             self.handler.connect()
+            self.metrics.start()
             self.message.payload['start_time'] = timer()
             
             for s in self.sensor_list:
@@ -4,15 +4,24 @@ MetaMotion MMR sensor, start a data stream, and collect, pair and publish data t
 '''
 
 from ctypes import c_void_p
-from mbientlab.metawear import MetaWear, libmetawear, parse_value, cbindings
-from mbientlab.metawear.cbindings import *
 from timeit import default_timer as timer
 from time import sleep, time
 from threading import Event
 import json
+from app.lib.metrics import StageMetrics
+
+def odr_enum(enum_class, hz:float):
+    '''Returns the member of a libmetawear ODR enum class for a rate in Hz, e.g. 25 -> _25Hz, 12.5 -> _12_5Hz.'''
+    name = '_' + f'{hz:g}'.replace('.', '_') + 'Hz'
+    if not hasattr(enum_class, name):
+        rates = [k[1:-2].replace('_', '.') for k in vars(enum_class) if k.startswith('_') and k.endswith('Hz')]
+        raise ValueError(f'{hz} Hz is not supported by {enum_class.__name__}. Accepted values are: {", ".join(rates)}')
+    return getattr(enum_class, name)
+
 
 class Sensor:
-    def __init__(self, device, cond, message, name:str, msg_handler, logger):
+    def __init__(self, device, cond, message, name:str, msg_handler, logger, odr_hz:float=25, gyro_only:bool=False,
+                 averaging_depth:int=0, decimate_ms:int=0, lib=None, bindings=None, metrics:StageMetrics=None):
         """
         Args:
             device (_type_): MetaWear device instance.\n
@@ -20,16 +29,44 @@ class Sensor:
             message (_type_): Message class object, stores sensor data.\n
             name (str): Name of the sensor data in the JSON message: LSensor | RSensor.\n
             msg_handler (_type_): Instance of Handler helper class from message_handler.py.\n
-            logger (_type_): Instance of the logger to use from the logging class.
+            logger (_type_): Instance of the logger to use from the logging class.\n
+            odr_hz (float, optional): Output data rate the board samples at. Defaults to 25.\n
+            gyro_only (bool, optional): Only stream the gyroscope, the accelerometer is not started or fused. Defaults to False.\n
+            averaging_depth (int, optional): If > 1, an on-board low pass (moving average) processor of this depth is
+            applied to each signal. Defaults to 0.\n
+            decimate_ms (int, optional): If > 0, an on-board time processor only passes one sample every decimate_ms,
+            so the board can sample fast and send filtered, lower rate data. Defaults to 0.\n
+            lib (_type_, optional): libmetawear implementation, a fake can be given to test without hardware.
+            Defaults to None (mbientlab libmetawear).\n
+            bindings (_type_, optional): libmetawear callback types and enums with a parse_value function, a fake can be
+            given with lib. Defaults to None (mbientlab cbindings and parse_value).\n
+            metrics (StageMetrics, optional): Counters and timings of the process, shared by both sensors. Defaults to
+            None, not recorded.
         """
+        # mbientlab is imported here, not with the module, so a fake lib and bindings work without it installed
+        if bindings is None:
+            from mbientlab.metawear import cbindings as bindings, parse_value
+        else:
+            parse_value = bindings.parse_value
+        if lib is None:
+            from mbientlab.metawear import libmetawear as lib
         self.device = device
-        self.callback = cbindings.FnVoid_VoidP_DataP(self.data_handler)
+        self.bindings = bindings
+        self.parse_value = parse_value
+        self.callback = bindings.FnVoid_VoidP_DataP(self.data_handler)
         self.processor = None
+        self.processors = []
+        self.odr_hz = odr_hz
+        self.gyro_only = gyro_only
+        self.averaging_depth = averaging_depth
+        self.decimate_ms = decimate_ms
+        self.lib = lib
         self.cond = cond
         self.message = message
         self.name = name
         self.msg_handler = msg_handler
         self.logger = logger
+        self.metrics = metrics if metrics is not None else StageMetrics(name, enabled=False)
 
     # Callback function that is executed for each packet of data that is produced
     def data_handler(self, ctx, data):
@@ -37,10 +74,17 @@ class Sensor:
         t1 = timer()
         # Get lock for data store, faster thread gets it - other thread forced to wait
         self.cond.acquire()
-        # Parse sensor data and add it to data store
-        values = parse_value(data, n_elem=2)
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
+        # Parse sensor data and add it to data store, gyro only packets hold a single value
+        if self.gyro_only:
+            values = [None, self.parse_value(data)]
+        else:
+            values = self.parse_value(data, n_elem=2)
         # self.logger.info('Acc: (x: %.6f, y: %.6f, z: %.6f), Gyro Value (x: %.6f, y: %.6f, z: %.6f) Time: %.6f', values[0].x, values[0].y, values[0].z, values[1].x, values[1].y, values[1].z, t1)
         self.message.update_sensor_data(self.name, values, t1)
+        if start:
+            self.metrics.decode_time.since(start)
 
         # If flag == 0 then this thread was the first to acquire lock
         if self.message.flag == 0:
@@ -52,8 +96,15 @@ class Sensor:
         elif self.message.flag == 1:
             # Only 2nd thread can enter here
             self.message.flag = 0
-            # Send paired data to msg broker
-            self.msg_handler.publish(json.dumps(self.message.payload))
+            # Send paired data to msg broker, seq identifies the reading in every stage's output
+            self.message.payload['seq'] += 1
+            self.metrics.processed += 1
+            start = self.metrics.sample_process and self.metrics.start_process()
+            payload = json.dumps(self.message.payload)
+            if start:
+                self.metrics.encode_time.since(start)
+            self.msg_handler.publish(payload)
+            self.metrics.published += 1
             # Check if there was a reset flag set
             if self.message.payload['reset'] == True:
                 self.message.payload['reset'] = False
@@ -61,80 +112,102 @@ class Sensor:
             self.cond.notifyAll()
             self.cond.release()
         
-    def setup(self):
-        '''Sets up the MetaWear sensors. Creates data processors, sets polling rates, subscribes to signals gyro and acc signals.'''
-        # ble settings
-        libmetawear.mbl_mw_settings_set_connection_parameters(self.device.board, 7.5, 7.5, 0, 6000)
-        sleep(1.5)
-
+    def create_processor(self, create_fn, *args):
+        '''Calls a libmetawear data processor create function and blocks until the board has created it. Returns the processor.'''
         e = Event()
-        
+        result = []
+
         # processor callback fn
         def processor_created(context, pointer):
-            self.processor = pointer
+            result.append(pointer)
             e.set()
 
-        fn_wrapper = cbindings.FnVoid_VoidP_VoidP(processor_created)
+        fn_wrapper = self.bindings.FnVoid_VoidP_VoidP(processor_created)
+        create_fn(*args, None, fn_wrapper)
+        e.wait()
+        if not result[0]:
+            raise RuntimeError(f'{self.name}: failed to create data processor with {create_fn.__name__}')
+        self.processors.append(result[0])
+        return result[0]
+
+    def setup(self):
+        '''Sets up the MetaWear sensors. Sets polling rates, subscribes to the gyro (and acc) signals and creates the optional
+        averaging, fusing and decimation data processors, in that order.'''
+        # ble settings
+        self.lib.mbl_mw_settings_set_connection_parameters(self.device.board, 7.5, 7.5, 0, 6000)
+        sleep(1.5)
 
         # setup acc
-        # Hz value governs how fast sensors stream data over ble
-        libmetawear.mbl_mw_acc_bmi270_set_odr(self.device.board, AccBmi270Odr._25Hz)
-        libmetawear.mbl_mw_acc_bosch_set_range(self.device.board, AccBoschRange._2G)
-        libmetawear.mbl_mw_acc_write_acceleration_config(self.device.board)
+        # Hz value governs how fast sensors sample, and stream data over ble unless it is decimated
+        if not self.gyro_only:
+            self.lib.mbl_mw_acc_bmi270_set_odr(self.device.board, odr_enum(self.bindings.AccBmi270Odr, self.odr_hz))
+            self.lib.mbl_mw_acc_bosch_set_range(self.device.board, self.bindings.AccBoschRange._2G)
+            self.lib.mbl_mw_acc_write_acceleration_config(self.device.board)
 
         # setup gyro
-        libmetawear.mbl_mw_gyro_bmi270_set_odr(self.device.board, GyroBoschOdr._25Hz)
-        libmetawear.mbl_mw_gyro_bmi270_set_range(self.device.board, GyroBoschRange._1000dps)  # Sensor sensitivity
-        libmetawear.mbl_mw_gyro_bmi270_write_config(self.device.board)
-
-        # get acc signal
-        self.signal_acc = libmetawear.mbl_mw_acc_get_acceleration_data_signal(
-            self.device.board)
+        self.lib.mbl_mw_gyro_bmi270_set_odr(self.device.board, odr_enum(self.bindings.GyroBoschOdr, self.odr_hz))
+        self.lib.mbl_mw_gyro_bmi270_set_range(self.device.board, self.bindings.GyroBoschRange._1000dps)  # Sensor sensitivity
+        self.lib.mbl_mw_gyro_bmi270_write_config(self.device.board)
 
         # get gyro signal
-        self.signal_gyro = libmetawear.mbl_mw_gyro_bmi270_get_rotation_data_signal(
-            self.device.board)
+        self.signal_gyro = self.lib.mbl_mw_gyro_bmi270_get_rotation_data_signal(self.device.board)
+        source = self.signal_gyro
+        if self.averaging_depth > 1:
+            source = self.create_processor(self.lib.mbl_mw_dataprocessor_lowpass_create, source, self.averaging_depth)
 
-        signals = (c_void_p * 1)()
-        signals[0] = self.signal_gyro
+        if not self.gyro_only:
+            # get acc signal
+            self.signal_acc = self.lib.mbl_mw_acc_get_acceleration_data_signal(self.device.board)
+            acc_source = self.signal_acc
+            if self.averaging_depth > 1:
+                acc_source = self.create_processor(self.lib.mbl_mw_dataprocessor_lowpass_create, acc_source, self.averaging_depth)
 
-        # Fuse acc and gyro signals
-        libmetawear.mbl_mw_dataprocessor_fuser_create(self.signal_acc, signals, 1, None, fn_wrapper)
-        # wait for fuser to be created
-        e.wait()
-        # Subscribe to the fused signal
-        libmetawear.mbl_mw_datasignal_subscribe(self.processor, None, self.callback)
+            signals = (c_void_p * 1)()
+            signals[0] = source
+
+            # Fuse acc and gyro signals
+            source = self.create_processor(self.lib.mbl_mw_dataprocessor_fuser_create, acc_source, signals, 1)
+
+        if self.decimate_ms > 0:
+            source = self.create_processor(self.lib.mbl_mw_dataprocessor_time_create, source, self.bindings.TimeMode.ABSOLUTE, self.decimate_ms)
+
+        # Subscribe to the final signal
+        self.processor = source
+        self.lib.mbl_mw_datasignal_subscribe(self.processor, None, self.callback)
 
     def start(self):
         '''Initializes the data stream for the MetaWear sensors.'''
         # start acc sampling
-        libmetawear.mbl_mw_acc_enable_acceleration_sampling(self.device.board)
-        libmetawear.mbl_mw_acc_start(self.device.board)
+        if not self.gyro_only:
+            self.lib.mbl_mw_acc_enable_acceleration_sampling(self.device.board)
+            self.lib.mbl_mw_acc_start(self.device.board)
         # start gyro sampling - MMS ONLY
-        libmetawear.mbl_mw_gyro_bmi270_enable_rotation_sampling(self.device.board)
-        libmetawear.mbl_mw_gyro_bmi270_start(self.device.board)
+        self.lib.mbl_mw_gyro_bmi270_enable_rotation_sampling(self.device.board)
+        self.lib.mbl_mw_gyro_bmi270_start(self.device.board)
 
     def shutdown(self, event):
-        libmetawear.mbl_mw_acc_stop(self.device.board)
-        self.logger.debug("Sensor acc stopped")
-        libmetawear.mbl_mw_gyro_bmi270_stop(self.device.board)
+        if not self.gyro_only:
+            self.lib.mbl_mw_acc_stop(self.device.board)
+            self.logger.debug("Sensor acc stopped")
+        self.lib.mbl_mw_gyro_bmi270_stop(self.device.board)
         self.logger.debug("Sensor gyro stopped")
 
-        libmetawear.mbl_mw_acc_disable_acceleration_sampling(self.device.board)
-        self.logger.debug("Acc sampling stopped")
-        libmetawear.mbl_mw_gyro_bmi270_disable_rotation_sampling(self.device.board)
+        if not self.gyro_only:
+            self.lib.mbl_mw_acc_disable_acceleration_sampling(self.device.board)
+            self.logger.debug("Acc sampling stopped")
+        self.lib.mbl_mw_gyro_bmi270_disable_rotation_sampling(self.device.board)
         self.logger.debug("Gyro sampling stopped stopped")
 
-        libmetawear.mbl_mw_datasignal_unsubscribe(self.processor)
+        self.lib.mbl_mw_datasignal_unsubscribe(self.processor)
         self.logger.debug("Unsubscribe from data signal")
 
         # debug and garbage collect
-        libmetawear.mbl_mw_debug_reset_after_gc(self.device.board)
+        self.lib.mbl_mw_debug_reset_after_gc(self.device.board)
         self.logger.debug("Sensor debug reset")
         sleep(1)
 
         # delete timer and processors
-        libmetawear.mbl_mw_debug_disconnect(self.device.board)
+        self.lib.mbl_mw_debug_disconnect(self.device.board)
         self.logger.debug("Sensor debug disconnect")
         sleep(1)
 
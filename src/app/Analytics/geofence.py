@@ -0,0 +1,123 @@
+"""
+Geofence evaluation: which zones an asset is in, and the enter, exit and dwell events as it moves.
+
+Zones are polygons in the same map coordinates as x_loc and y_loc. A uniform grid indexes them by bounding box, so a
+point is only tested against the zones whose bounding box overlaps its grid cell. The cost per point depends on how many
+zones overlap there, not on the total number of zones.
+
+Zones file format (JSON):
+    {"zones": [{"id": "unit_4_west", "polygon": [[x, y], [x, y], ...], "dwell": 300}, ...]}
+dwell is optional, seconds inside the zone before a dwell event, it falls back to Geofence's dwell.
+"""
+
+import json
+import math
+import numpy as np
+
+
+class Zone:
+    def __init__(self, zone_id: str, polygon: list, dwell: float = None):
+        """
+        Args:
+            zone_id (str): Name reported in events.\n
+            polygon (list): Vertices [[x, y], ...], the last vertex connects to the first.\n
+            dwell (float, optional): Seconds inside before a dwell event. Defaults to None.
+        """
+        self.zone_id = zone_id
+        self.dwell = dwell
+        vertices = np.asarray(polygon, dtype=float)
+        self.xs = vertices[:, 0]
+        self.ys = vertices[:, 1]
+        self.next_xs = np.roll(self.xs, -1)
+        self.next_ys = np.roll(self.ys, -1)
+        self.min_x, self.min_y = vertices.min(axis=0)
+        self.max_x, self.max_y = vertices.max(axis=0)
+
+    def contains(self, x: float, y: float):
+        "Ray casting point in polygon test, after a bounding box check."
+        if x < self.min_x or x > self.max_x or y < self.min_y or y > self.max_y:
+            return False
+        # Edges crossing the horizontal line through the point, and where they cross it
+        crosses = (self.ys > y) != (self.next_ys > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = (self.next_xs - self.xs) * (y - self.ys) / (self.next_ys - self.ys) + self.xs
+        return bool(np.count_nonzero(crosses & (x < x_cross)) % 2)
+
+
+class GridIndex:
+    """Uniform grid over the map, each cell lists the zones whose bounding box overlaps it."""
+
+    def __init__(self, zones: list, cell_size: float):
+        self.cell_size = cell_size
+        self.cells = {}
+        for zone in zones:
+            for cx in range(self.cell(zone.min_x), self.cell(zone.max_x) + 1):
+                for cy in range(self.cell(zone.min_y), self.cell(zone.max_y) + 1):
+                    self.cells.setdefault((cx, cy), []).append(zone)
+
+    def cell(self, value: float):
+        return math.floor(value / self.cell_size)
+
+    def candidates(self, x: float, y: float):
+        return self.cells.get((self.cell(x), self.cell(y)), ())
+
+
+class Geofence:
+    def __init__(self, zones: list, cell_size: float = 500.0, dwell: float = None):
+        """
+        Args:
+            zones (list): Zone objects.\n
+            cell_size (float, optional): Grid cell size in map units, about the size of a typical zone. Defaults to 500.0.\n
+            dwell (float, optional): Default seconds inside a zone before a dwell event, None for no dwell events
+            unless a zone sets its own. Defaults to None.
+        """
+        self.zones = zones
+        self.index = GridIndex(zones, cell_size)
+        self.dwell = dwell
+        # asset_id -> {zone_id: [zone, enter_time, dwell_reported]}
+        self.inside = {}
+
+    def evaluate(self, asset_id, x: float, y: float, timestamp: float):
+        """Updates the zones asset_id is in and returns the events caused by the new point.
+
+        Args:
+            asset_id (_type_): Asset the point belongs to.\n
+            x (float): x_loc of the point.\n
+            y (float): y_loc of the point.\n
+            timestamp (float): unix_timestamp of the point, used for dwell times.
+        """
+        events = []
+        inside = self.inside.setdefault(asset_id, {})
+        current = {zone.zone_id: zone for zone in self.index.candidates(x, y) if zone.contains(x, y)}
+
+        for zone_id in [zone_id for zone_id in inside if zone_id not in current]:
+            zone, enter_time, dwell_reported = inside.pop(zone_id)
+            events.append(self.event("exit", asset_id, zone_id, x, y, timestamp, timestamp - enter_time))
+        for zone_id, zone in current.items():
+            state = inside.get(zone_id)
+            if state is None:
+                inside[zone_id] = [zone, timestamp, False]
+                events.append(self.event("enter", asset_id, zone_id, x, y, timestamp, 0.0))
+                continue
+            dwell = zone.dwell if zone.dwell is not None else self.dwell
+            if dwell is not None and not state[2] and timestamp - state[1] >= dwell:
+                state[2] = True
+                events.append(self.event("dwell", asset_id, zone_id, x, y, timestamp, timestamp - state[1]))
+        return events
+
+    def event(self, kind: str, asset_id, zone_id: str, x: float, y: float, timestamp: float, duration: float):
+        return {
+            "event": kind,
+            "asset_id": asset_id,
+            "zone": zone_id,
+            "x_loc": x,
+            "y_loc": y,
+            "unix_timestamp": timestamp,
+            "duration": duration
+        }
+
+
+def load_zones(path: str):
+    "Reads the zones of a zones file."
+    with open(path) as zones_file:
+        return [Zone(zone["id"], zone["polygon"], zone.get("dwell")) for zone in json.load(zones_file)["zones"]]
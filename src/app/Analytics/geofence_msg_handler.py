@@ -0,0 +1,82 @@
+"""
+Process that handles subscribing to the location topic, evaluating each location against the geofence zones with
+geofence.Geofence and publishing the enter, exit and dwell events to the events topic.
+"""
+
+from multiprocessing import Process
+from sys import exit
+import app.lib.message_handler as message_handler
+import app.Analytics.geofence as geofence
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+import json, logging, signal, time
+
+
+class GeofenceProcess(Process):
+    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, zones_path:str, cell_size:float=500.0, dwell:float=None, control_queue=None, transport:dict=None, profiling:dict=None):
+        """
+        Args:
+            client_id (str): Mosquitto client id.\n
+            topic_sub (str): Broker topic with the asset locations.\n
+            topic_pub (str): Broker topic to publish events to.\n
+            zones_path (str): Zones file, see app/Analytics/geofence.py.\n
+            cell_size (float, optional): Grid cell size of the zone index in map units. Defaults to 500.0.\n
+            dwell (float, optional): Default seconds inside a zone before a dwell event. Defaults to None, no dwell events.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
+        Process.__init__(self)
+        self.client_id = client_id
+        self.topic_sub = topic_sub
+        self.topic_pub = topic_pub
+        self.zones_path = zones_path
+        self.cell_size = cell_size
+        self.dwell = dwell
+        self.control_queue = control_queue
+        self.transport = transport
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
+        self.logger = logging.getLogger('app')
+
+    def run(self):
+        try:
+            # Setup interrupt signal handler
+            signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
+            self.logger.debug('Process Started')
+
+            zones = geofence.load_zones(self.zones_path)
+            self.geofence = geofence.Geofence(zones, self.cell_size, self.dwell)
+            self.logger.info(f"GEOFENCE LOADED {len(zones)} ZONES FROM: {self.zones_path}")
+
+            self.handler = message_handler.Handler(self.client_id, self.topic_sub, self.topic_pub, on_ready=self.ready, transport=self.transport)
+            self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            self.handler.connect()
+            self.handler.loop()
+
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            exit(1)
+
+    def on_message(self, client, userdata, msg):
+        data = json.loads(msg.payload)
+        if "x_loc" not in data or "y_loc" not in data:
+            return
+        # Same convention as the fleet view: the payload's asset_id, else the last level of the topic
+        asset_id = data.get("asset_id") or msg.topic.rsplit('/', 1)[-1]
+        timestamp = data.get("unix_timestamp") or time.time()
+        for event in self.geofence.evaluate(asset_id, data["x_loc"], data["y_loc"], timestamp):
+            self.handler.publish(json.dumps(event))
+
+    def interrupt_handler(self, signum, frame):
+        self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
+        self.handler.client.disconnect()
+        self.logger.debug('Process Ended')
+        time.sleep(1)
+        exit(0)
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
@@ -0,0 +1,262 @@
+"""
+Occupancy heatmaps: how long assets spent in each cell of a grid over the map.
+
+Each location update adds a weight (the seconds the asset spent there) to its cell, in place, so a heatmap is built
+incrementally as the data arrives and never by reading the logs back. Two variants:
+- DecayedHeatmap: every contribution fades with a half life, recent time counts most. Instead of decaying the whole
+  grid at every update, contributions are added scaled up by 2 ** (age / half_life) relative to a reference time. The
+  grid is only scaled back when it is read, and renormalized in place when the scale would overflow.
+- WindowedHeatmap: only the last window seconds count. The window is split into buckets, each with its own grid; when a
+  bucket expires its grid is cleared and reused, so the cost of expiry is one grid per bucket, not one per update.
+
+Both are aligned to an extent [min_x, max_x, min_y, max_y], row 0 at min_y and column 0 at min_x. Locations outside
+the extent are not counted.
+"""
+
+import math
+import os
+from abc import ABC, abstractmethod
+import numpy as np
+
+HEATMAP_VARIANTS = ("decayed", "window")
+
+
+class Heatmap(ABC):
+    """Grid over the extent and the mapping of locations to cells, shared by the variants."""
+
+    def __init__(self, extent: list, cell_size: float):
+        """
+        Args:
+            extent (list): [min_x, max_x, min_y, max_y] covered by the grid.\n
+            cell_size (float): Size of a cell, in the units of the extent.
+        """
+        self.extent = [float(value) for value in extent]
+        self.min_x, self.max_x, self.min_y, self.max_y = self.extent
+        self.cell_size = float(cell_size)
+        self.cols = max(math.ceil((self.max_x - self.min_x) / self.cell_size), 1)
+        self.rows = max(math.ceil((self.max_y - self.min_y) / self.cell_size), 1)
+
+    def cell(self, x: float, y: float):
+        "Row and column of the cell holding x, y, None if it is outside the extent."
+        col = math.floor((x - self.min_x) / self.cell_size)
+        row = math.floor((y - self.min_y) / self.cell_size)
+        if 0 <= col < self.cols and 0 <= row < self.rows:
+            return row, col
+        return None
+
+    def cells(self, xs: np.ndarray, ys: np.ndarray):
+        "Rows and columns of the cells holding xs, ys, and the mask of the locations inside the extent."
+        cols = np.floor((xs - self.min_x) / self.cell_size).astype(np.int64)
+        rows = np.floor((ys - self.min_y) / self.cell_size).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.cols) & (rows >= 0) & (rows < self.rows)
+        return rows[inside], cols[inside], inside
+
+    def add(self, x: float, y: float, timestamp: float, weight: float = 1.0):
+        """Adds weight to the cell holding x, y.
+
+        Args:
+            x (float): x_loc of the location.\n
+            y (float): y_loc of the location.\n
+            timestamp (float): unix_timestamp of the location.\n
+            weight (float, optional): Usually the seconds spent at the location. Defaults to 1.0.
+        """
+        cell = self.cell(x, y)
+        if cell is not None:
+            self.accumulate(cell, timestamp, weight)
+
+    def add_batch(self, xs, ys, timestamps, weights=None):
+        "Adds a batch of locations, same as add() for each of them."
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        timestamps = np.asarray(timestamps, dtype=float)
+        weights = np.ones(len(xs)) if weights is None else np.asarray(weights, dtype=float)
+        rows, cols, inside = self.cells(xs, ys)
+        if len(rows):
+            self.accumulate_batch(rows, cols, timestamps[inside], weights[inside])
+
+    @abstractmethod
+    def accumulate(self, cell: tuple, timestamp: float, weight: float):
+        "Adds weight to cell, a row and column inside the extent."
+
+    @abstractmethod
+    def accumulate_batch(self, rows: np.ndarray, cols: np.ndarray, timestamps: np.ndarray, weights: np.ndarray):
+        "Same as accumulate() for each cell of rows, cols."
+
+    @abstractmethod
+    def snapshot(self, now: float):
+        "Returns a copy of the grid as of now."
+
+    @abstractmethod
+    def get_state(self):
+        "Arrays and values to persist, see save()."
+
+    @abstractmethod
+    def set_state(self, state: dict):
+        "Restores the state returned by get_state()."
+
+    def parameters(self):
+        "Settings a persisted heatmap must match to be restored."
+        return {"extent": self.extent, "cell_size": self.cell_size}
+
+    def save(self, path: str):
+        "Writes the heatmap to path, through a temporary file so a crash leaves the previous file intact."
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as heatmap_file:
+            np.savez(heatmap_file, parameters=repr(self.parameters()), **self.get_state())
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        "Restores the heatmap saved at path, returns False if there is none or it was saved with other settings."
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as saved:
+            if str(saved["parameters"]) != repr(self.parameters()):
+                return False
+            self.set_state({key: saved[key] for key in saved.files if key != "parameters"})
+        return True
+
+
+class DecayedHeatmap(Heatmap):
+    # Renormalize once the scale of new contributions passes 2 ** MAX_EXPONENT, far from the float64 limit
+    MAX_EXPONENT = 256
+
+    def __init__(self, extent: list, cell_size: float, half_life: float):
+        """
+        Args:
+            extent (list): [min_x, max_x, min_y, max_y] covered by the grid.\n
+            cell_size (float): Size of a cell, in the units of the extent.\n
+            half_life (float): Seconds after which a contribution counts half.
+        """
+        Heatmap.__init__(self, extent, cell_size)
+        self.half_life = float(half_life)
+        self.grid = np.zeros((self.rows, self.cols))
+        # Grid values are as of reference_time scaled by 2 ** ((time - reference_time) / half_life)
+        self.reference_time = None
+
+    def scale(self, timestamp: float):
+        "Scale of a contribution made at timestamp, renormalizing first if it would get too large."
+        if self.reference_time is None:
+            self.reference_time = timestamp
+        exponent = (timestamp - self.reference_time) / self.half_life
+        if exponent > self.MAX_EXPONENT:
+            self.grid *= 2.0 ** -exponent
+            self.reference_time = timestamp
+            exponent = 0.0
+        return 2.0 ** exponent
+
+    def accumulate(self, cell: tuple, timestamp: float, weight: float):
+        # Scaled first, renormalizing changes the grid
+        scale = self.scale(timestamp)
+        self.grid[cell] += weight * scale
+
+    def accumulate_batch(self, rows, cols, timestamps, weights):
+        self.scale(timestamps.max())
+        np.add.at(self.grid, (rows, cols), weights * 2.0 ** ((timestamps - self.reference_time) / self.half_life))
+
+    def snapshot(self, now: float):
+        if self.reference_time is None:
+            return self.grid.copy()
+        return self.grid * 2.0 ** ((self.reference_time - now) / self.half_life)
+
+    def parameters(self):
+        return {**Heatmap.parameters(self), "half_life": self.half_life}
+
+    def get_state(self):
+        return {"grid": self.grid, "reference_time": np.nan if self.reference_time is None else self.reference_time}
+
+    def set_state(self, state: dict):
+        self.grid = state["grid"]
+        reference_time = float(state["reference_time"])
+        self.reference_time = None if math.isnan(reference_time) else reference_time
+
+
+class WindowedHeatmap(Heatmap):
+    def __init__(self, extent: list, cell_size: float, window: float, bucket: float):
+        """
+        Args:
+            extent (list): [min_x, max_x, min_y, max_y] covered by the grid.\n
+            cell_size (float): Size of a cell, in the units of the extent.\n
+            window (float): Seconds of history that count.\n
+            bucket (float): Seconds per bucket, the resolution at which old history expires.
+        """
+        Heatmap.__init__(self, extent, cell_size)
+        self.window = float(window)
+        self.bucket = float(bucket)
+        self.buckets = max(math.ceil(self.window / self.bucket), 1)
+        self.ring = np.zeros((self.buckets, self.rows, self.cols))
+        self.total = np.zeros((self.rows, self.cols))
+        # Bucket number (timestamp // bucket) of the newest bucket
+        self.current = None
+
+    def advance(self, bucket: int):
+        "Makes bucket the newest bucket, clearing the buckets that fall out of the window."
+        if self.current is None:
+            self.current = bucket
+            return
+        if bucket <= self.current:
+            return
+        expired = min(bucket - self.current, self.buckets)
+        for number in range(bucket - expired + 1, bucket + 1):
+            self.ring[number % self.buckets] = 0.0
+        self.current = bucket
+        # Recomputed rather than subtracted so rounding errors do not build up over a long run
+        np.sum(self.ring, axis=0, out=self.total)
+
+    def accumulate(self, cell: tuple, timestamp: float, weight: float):
+        bucket = math.floor(timestamp / self.bucket)
+        self.advance(bucket)
+        if bucket <= self.current - self.buckets:
+            return
+        self.ring[bucket % self.buckets][cell] += weight
+        self.total[cell] += weight
+
+    def accumulate_batch(self, rows, cols, timestamps, weights):
+        buckets = np.floor(timestamps / self.bucket).astype(np.int64)
+        self.advance(int(buckets.max()))
+        recent = buckets > self.current - self.buckets
+        rows, cols, buckets, weights = rows[recent], cols[recent], buckets[recent], weights[recent]
+        np.add.at(self.ring, (buckets % self.buckets, rows, cols), weights)
+        np.add.at(self.total, (rows, cols), weights)
+
+    def snapshot(self, now: float):
+        if self.current is not None:
+            self.advance(math.floor(now / self.bucket))
+        return self.total.copy()
+
+    def parameters(self):
+        return {**Heatmap.parameters(self), "window": self.window, "bucket": self.bucket}
+
+    def get_state(self):
+        return {"ring": self.ring, "current": -1 if self.current is None else self.current}
+
+    def set_state(self, state: dict):
+        self.ring = state["ring"]
+        current = int(state["current"])
+        self.current = None if current < 0 else current
+        np.sum(self.ring, axis=0, out=self.total)
+
+
+def build(variant: str, extent: list, cell_size: float, half_life: float = 86400.0, window: float = 604800.0, bucket: float = 3600.0):
+    """Returns the heatmap of a variant.
+
+    Args:
+        variant (str): decayed | window.\n
+        extent (list): [min_x, max_x, min_y, max_y] covered by the grid.\n
+        cell_size (float): Size of a cell, in the units of the extent.\n
+        half_life (float, optional): Half life of the decayed variant in seconds. Defaults to 86400.0, a day.\n
+        window (float, optional): Window of the window variant in seconds. Defaults to 604800.0, a week.\n
+        bucket (float, optional): Bucket of the window variant in seconds. Defaults to 3600.0, an hour.
+    """
+    if variant == "decayed":
+        return DecayedHeatmap(extent, cell_size, half_life)
+    if variant == "window":
+        return WindowedHeatmap(extent, cell_size, window, bucket)
+    raise ValueError(f'Heatmap variant "{variant}" not supported. Accepted values are: {", ".join(HEATMAP_VARIANTS)}')
+
+
+def encode(grid: np.ndarray):
+    """Scales a grid to 0-255 levels for an image overlay. Returns the uint8 levels and the value of level 255."""
+    peak = float(grid.max()) if grid.size else 0.0
+    if peak <= 0:
+        return np.zeros(grid.shape, dtype=np.uint8), 0.0
+    return np.round(grid * (255.0 / peak)).astype(np.uint8), peak
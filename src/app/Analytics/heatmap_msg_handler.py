@@ -0,0 +1,192 @@
+"""
+Process that handles subscribing to the location topics, adding the time each asset spends at its locations to the
+occupancy heatmaps of heatmap.py, and serving snapshots of them over a local HTTP API:
+- GET /heatmap?variant=<decayed|window>: {"variant", "extent", "cell_size", "shape": [rows, cols], "peak",
+  "unix_timestamp", "levels"}. levels is the base64 of the row major uint8 grid scaled so 255 is peak seconds, row 0 at
+  min_y. variant defaults to the first configured variant.
+
+The heatmaps are saved to path every save_interval seconds and on exit, and restored on start, so a week long heatmap
+survives restarts without reading the logs back.
+"""
+
+from base64 import b64encode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import Process
+from threading import Lock, Thread
+from urllib.parse import urlparse, parse_qs
+from sys import exit
+import app.lib.message_handler as message_handler
+import app.Analytics.heatmap as heatmap
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+import json, logging, os, signal, time
+
+
+class HeatmapProcess(Process):
+    def __init__(self, client_id:str, topics_sub:list, extent:list, cell_size:float, variants:list=("decayed", "window"), half_life:float=86400.0, window:float=604800.0, bucket:float=3600.0, max_gap:float=5.0, path:str=None, save_interval:float=60.0, host:str="127.0.0.1", port:int=8766, control_queue=None, transport:dict=None, profiling:dict=None):
+        """
+        Args:
+            client_id (str): Mosquitto client id.\n
+            topics_sub (list): Broker topics with the asset locations.\n
+            extent (list): [min_x, max_x, min_y, max_y] of the heatmaps in the units of x_loc and y_loc.\n
+            cell_size (float): Size of a heatmap cell in the units of x_loc and y_loc.\n
+            variants (list, optional): Heatmaps kept, see heatmap.HEATMAP_VARIANTS. Defaults to ("decayed", "window").\n
+            half_life (float, optional): Half life of the decayed heatmap in seconds. Defaults to 86400.0.\n
+            window (float, optional): Window of the window heatmap in seconds. Defaults to 604800.0.\n
+            bucket (float, optional): Resolution in seconds at which the window heatmap expires history. Defaults to 3600.0.\n
+            max_gap (float, optional): Most seconds counted between two updates of an asset, longer silences are not
+            counted as time spent. Defaults to 5.0.\n
+            path (str, optional): Folder the heatmaps are saved to, None to not save them. Defaults to None.\n
+            save_interval (float, optional): Minimum seconds between saves. Defaults to 60.0.\n
+            host (str, optional): Address the HTTP API listens on. Defaults to "127.0.0.1", local clients only.\n
+            port (int, optional): Port of the HTTP API. Defaults to 8766.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
+        Process.__init__(self)
+        self.client_id = client_id
+        self.topics_sub = topics_sub
+        self.max_gap = max_gap
+        self.path = path
+        self.save_interval = save_interval
+        self.host = host
+        self.port = port
+        self.control_queue = control_queue
+        self.transport = transport
+        # Built here so an unsupported variant fails at startup
+        self.heatmaps = {variant: heatmap.build(variant, extent, cell_size, half_life, window, bucket) for variant in variants}
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
+        self.logger = logging.getLogger('app')
+
+    def run(self):
+        try:
+            # Setup interrupt signal handler
+            self.stopping = False
+            signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
+            self.logger.debug('Process Started')
+
+            self.lock = Lock()
+            # asset_id -> (x, y, unix_timestamp) of its previous location
+            self.previous = {}
+            self.next_save = time.monotonic() + self.save_interval
+            if self.path is not None:
+                for variant, grid in self.heatmaps.items():
+                    if grid.load(self.file(variant)):
+                        self.logger.info(f"HEATMAP {variant} RESTORED FROM: {self.file(variant)}")
+
+            self.server = ThreadingHTTPServer((self.host, self.port), self.request_handler())
+            self.server.daemon_threads = True
+            Thread(target=self.server.serve_forever, daemon=True).start()
+            self.logger.info(f"HEATMAP SERVING ON http://{self.host}:{self.port}")
+
+            self.handler = message_handler.Handler(self.client_id, self.topics_sub, on_ready=self.ready, transport=self.transport)
+            for topic in self.topics_sub:
+                self.handler.client.message_callback_add(topic, self.on_message)
+            self.handler.connect()
+            self.handler.loop()
+            if self.stopping:
+                self.stop()
+
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            exit(1)
+
+    def on_message(self, client, userdata, msg):
+        data = json.loads(msg.payload)
+        if "x_loc" not in data or "y_loc" not in data:
+            return
+        # Same convention as the fleet view: the payload's asset_id, else the last level of the topic
+        asset_id = data.get("asset_id") or msg.topic.rsplit('/', 1)[-1]
+        timestamp = data.get("unix_timestamp") or time.time()
+        previous = self.previous.get(asset_id)
+        self.previous[asset_id] = (data["x_loc"], data["y_loc"], timestamp)
+        if previous is None:
+            return
+        # The asset was at its previous location until this update
+        x, y, previous_timestamp = previous
+        spent = min(timestamp - previous_timestamp, self.max_gap)
+        if spent <= 0:
+            return
+        with self.lock:
+            for grid in self.heatmaps.values():
+                grid.add(x, y, timestamp, spent)
+        if self.path is not None and time.monotonic() >= self.next_save:
+            self.save()
+
+    def file(self, variant: str):
+        return os.path.join(self.path, f"heatmap_{variant}.npz")
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            for variant, grid in self.heatmaps.items():
+                grid.save(self.file(variant))
+        self.next_save = time.monotonic() + self.save_interval
+
+    def interrupt_handler(self, signum, frame):
+        self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
+        # The signal may interrupt on_message while it holds self.lock on this thread, so the heatmaps are saved by
+        # stop() once the event loop returned instead of here
+        self.stopping = True
+        self.handler.client.disconnect()
+
+    def stop(self):
+        "Saves the heatmaps and ends the process, called after the event loop returned."
+        self.server.shutdown()
+        if self.path is not None:
+            self.save()
+        self.logger.debug('Process Ended')
+        time.sleep(1)
+        exit(0)
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
+
+    def request_handler(self):
+        "Returns the HTTP request handler class bound to this process's heatmaps."
+        heatmaps = self.heatmaps
+        lock = self.lock
+        default_variant = next(iter(heatmaps))
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/heatmap":
+                    self.send_error(404)
+                    return
+                variant = parse_qs(url.query).get("variant", [default_variant])[0]
+                if variant not in heatmaps:
+                    self.send_error(404, "Unknown variant")
+                    return
+                now = time.time()
+                with lock:
+                    snapshot = heatmaps[variant].snapshot(now)
+                levels, peak = heatmap.encode(snapshot)
+                grid = heatmaps[variant]
+                self.send_json({
+                    "variant": variant,
+                    "extent": grid.extent,
+                    "cell_size": grid.cell_size,
+                    "shape": list(levels.shape),
+                    "peak": peak,
+                    "unix_timestamp": now,
+                    "levels": b64encode(levels.tobytes()).decode()
+                })
+
+            def send_json(self, body):
+                payload = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
@@ -0,0 +1,222 @@
+"""
+Last known state of every asset, kept in memory and served over a local HTTP API.
+
+StateTable holds one row per asset in preallocated NumPy columns (FIELDS), with a dict from asset id to row, so an
+update or a lookup is O(1) and a snapshot of the whole fleet is a single copy of the table. Every update bumps a
+global version and stamps it on the row, so clients can ask for everything that changed since the version they saw.
+
+StateCache is the process around the table. It subscribes to the linear and location topics (for the wheel totals
+and the location, both delta and full payloads work) and serves:
+- GET /snapshot: {"version": v, "assets": {asset_id: state}}
+- GET /assets/<asset_id>: state of one asset, 404 if it is unknown.
+- GET /changes?since=<v>: Server-Sent Events stream, each event is {"version": v, "assets": {...}} with the assets
+  that changed since the previous event, starting with those changed since version v.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import Process
+from threading import Condition, Thread
+from urllib.parse import urlparse, parse_qs, unquote
+from sys import exit
+import app.lib.message_handler as message_handler
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+import numpy as np
+import json, logging, signal, time
+
+FIELDS = ("x_loc", "y_loc", "heading", "LW_total", "RW_total", "unix_timestamp", "seq")
+
+
+class StateTable:
+    def __init__(self, capacity: int = 64):
+        """
+        Args:
+            capacity (int, optional): Initial number of rows, doubled when full. Defaults to 64.
+        """
+        self.columns = {field: i for i, field in enumerate(FIELDS)}
+        self.values = np.full((capacity, len(FIELDS)), np.nan)
+        self.versions = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+        self.ids = []
+        self.version = 0
+        self.cond = Condition()
+
+    def update(self, asset_id, data: dict):
+        "Stores the FIELDS present in data as the asset's latest state."
+        with self.cond:
+            row = self.rows.get(asset_id)
+            if row is None:
+                row = len(self.ids)
+                if row == len(self.values):
+                    self.grow()
+                self.rows[asset_id] = row
+                self.ids.append(asset_id)
+            values = self.values[row]
+            for field, column in self.columns.items():
+                value = data.get(field)
+                if value is not None:
+                    values[column] = value
+            self.version += 1
+            self.versions[row] = self.version
+            self.cond.notify_all()
+
+    def grow(self):
+        capacity = 2 * len(self.values)
+        values = np.full((capacity, len(FIELDS)), np.nan)
+        values[:len(self.values)] = self.values
+        versions = np.zeros(capacity, dtype=np.int64)
+        versions[:len(self.versions)] = self.versions
+        self.values, self.versions = values, versions
+
+    def get(self, asset_id):
+        "Returns the state of an asset, None if it is unknown."
+        with self.cond:
+            row = self.rows.get(asset_id)
+            if row is None:
+                return None
+            return self.state(self.values[row])
+
+    def snapshot(self, since: int = 0):
+        "Returns (version, {asset_id: state}) of the assets changed after version since, all assets by default."
+        with self.cond:
+            n = len(self.ids)
+            rows = np.flatnonzero(self.versions[:n] > since)
+            values = self.values[rows]
+            version = self.version
+            ids = [self.ids[row] for row in rows]
+        return version, {asset_id: self.state(row_values) for asset_id, row_values in zip(ids, values)}
+
+    def wait(self, version: int, timeout: float):
+        "Blocks until the table is newer than version or timeout passes, returns the current version."
+        with self.cond:
+            self.cond.wait_for(lambda: self.version > version, timeout)
+            return self.version
+
+    def state(self, row_values):
+        state = {field: float(row_values[column]) for field, column in self.columns.items() if not np.isnan(row_values[column])}
+        if "seq" in state:
+            state["seq"] = int(state["seq"])
+        return state
+
+
+class StateCache(Process):
+    def __init__(self, client_id:str, topics_sub:list, host:str="127.0.0.1", port:int=8765, control_queue=None, transport:dict=None, heartbeat:float=15, profiling:dict=None):
+        """
+        Args:
+            client_id (str): Name of this process for use by Mosquitto msg broker.\n
+            topics_sub (list): Broker topics holding asset state, e.g. ["Data/linear", "Data/location"].\n
+            host (str, optional): Address the HTTP API listens on. Defaults to "127.0.0.1", local clients only.\n
+            port (int, optional): Port of the HTTP API. Defaults to 8765.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            heartbeat (float, optional): Seconds between keep-alive comments on idle change streams. Defaults to 15.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
+        Process.__init__(self)
+        self.client_id = client_id
+        self.topics_sub = topics_sub
+        self.host = host
+        self.port = port
+        self.control_queue = control_queue
+        self.transport = transport
+        self.heartbeat = heartbeat
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
+        self.logger = logging.getLogger('app')
+
+    def run(self):
+        try:
+            # Setup interrupt signal handler
+            signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
+            self.logger.debug('Process Started')
+
+            self.table = StateTable()
+            self.server = ThreadingHTTPServer((self.host, self.port), self.request_handler())
+            self.server.daemon_threads = True
+            Thread(target=self.server.serve_forever, daemon=True).start()
+            self.logger.info(f"STATE CACHE SERVING ON http://{self.host}:{self.port}")
+
+            self.handler = message_handler.Handler(self.client_id, self.topics_sub, on_ready=self.ready, transport=self.transport)
+            for topic in self.topics_sub:
+                self.handler.client.message_callback_add(topic, self.on_message)
+            self.handler.connect()
+            self.handler.loop()
+
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            exit(1)
+
+    def on_message(self, client, userdata, msg):
+        data = json.loads(msg.payload)
+        # Same convention as the fleet view: the payload's asset_id, else the last level of the topic
+        self.table.update(data.get("asset_id") or msg.topic.rsplit('/', 1)[-1], data)
+
+    def interrupt_handler(self, signum, frame):
+        self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
+        self.handler.client.disconnect()
+        self.server.shutdown()
+        self.logger.debug('Process Ended')
+        time.sleep(1)
+        exit(0)
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
+
+    def request_handler(self):
+        "Returns the HTTP request handler class bound to this cache's table."
+        table = self.table
+        heartbeat = self.heartbeat
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/snapshot":
+                    version, assets = table.snapshot()
+                    self.send_json({"version": version, "assets": assets})
+                elif url.path.startswith("/assets/"):
+                    state = table.get(unquote(url.path[len("/assets/"):]))
+                    if state is None:
+                        self.send_error(404, "Unknown asset")
+                    else:
+                        self.send_json(state)
+                elif url.path == "/changes":
+                    try:
+                        since = int(parse_qs(url.query).get("since", ["0"])[0])
+                    except ValueError:
+                        self.send_error(400, "since must be an integer version")
+                        return
+                    self.stream_changes(since)
+                else:
+                    self.send_error(404)
+
+            def send_json(self, body):
+                payload = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def stream_changes(self, since: int):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                try:
+                    while True:
+                        if table.wait(since, heartbeat) > since:
+                            since, assets = table.snapshot(since)
+                            self.wfile.write(f"data: {json.dumps({'version': since, 'assets': assets})}\n\n".encode())
+                        else:
+                            self.wfile.write(b": heartbeat\n\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
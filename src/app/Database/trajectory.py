@@ -0,0 +1,272 @@
+"""
+Compressed long-term storage of asset trajectories.
+
+Compressor is a streaming, per asset, opening window simplification (online Douglas-Peucker): a point is only kept
+when the path from the last kept point can no longer be reconstructed within max_error and max_heading_error by
+interpolating in time. The error is measured at the timestamps of the dropped points (synchronized Euclidean
+distance), so stops are kept as well as turns, and a position lookup at any time between two kept points is within the
+error bound. Straight runs and stationary stretches collapse to their end points.
+
+Kept points are written to a trajectory file in blocks of up to block_points points of one asset. A block stores its
+timestamps (ms), x_loc and y_loc (resolution) and heading (heading_resolution) as zigzag varint deltas, column by
+column. Each block header holds the asset id and the time span, so TrajectoryReader indexes a file by reading only the
+headers and decodes only the blocks a query needs.
+
+File layout: MAGIC, resolution and heading_resolution (<dd), then blocks of HEADER, asset id (utf-8) and payload.
+"""
+
+import math
+import os
+import struct
+import numpy as np
+
+MAGIC = b"TRAJ1\n"
+# asset id length, point count, payload length, first and last unix_timestamp
+HEADER = struct.Struct("<HIIdd")
+RESOLUTIONS = struct.Struct("<dd")
+COLUMNS = ("unix_timestamp", "x_loc", "y_loc", "heading")
+
+
+class Compressor:
+    """Opening window simplification of one asset's trajectory."""
+
+    def __init__(self, max_error: float, max_heading_error: float = None, max_interval: float = None, max_window: int = 256):
+        """
+        Args:
+            max_error (float): Largest distance, in the units of x_loc and y_loc, between a dropped point and the path
+            reconstructed from the kept points at the same time.\n
+            max_heading_error (float, optional): Same for heading, in radians. None to ignore heading. Defaults to None.\n
+            max_interval (float, optional): Seconds after which a point is kept even when nothing changed, so a
+            stationary asset still shows up. None for no limit. Defaults to None.\n
+            max_window (int, optional): Most points checked per new point, bounding the cost of a long straight run.
+            Defaults to 256.
+        """
+        self.max_error = max_error
+        self.max_heading_error = max_heading_error
+        self.max_interval = max_interval
+        self.max_window = max_window
+        self.anchor = None
+        # Points since the anchor, the last one is the candidate end of the current segment
+        self.window = np.empty((max_window, 4))
+        self.size = 0
+        self.kept = 0
+        self.seen = 0
+
+    def add(self, timestamp: float, x: float, y: float, heading: float = 0.0):
+        "Adds a point, returns the list of (unix_timestamp, x_loc, y_loc, heading) points kept because of it."
+        self.seen += 1
+        point = (timestamp, x, y, heading)
+        if self.anchor is None:
+            return self.keep(point)
+        if self.size and (self.size == self.max_window or not self.fits(point)):
+            # The previous point is the furthest the segment reaches, it becomes the new anchor
+            kept = self.keep(tuple(self.window[self.size - 1]))
+            self.window[0] = point
+            self.size = 1
+            return kept
+        self.window[self.size] = point
+        self.size += 1
+        return []
+
+    def fits(self, point: tuple):
+        "True if every point in the window is within the error bounds of the segment from the anchor to point."
+        t0, x0, y0, h0 = self.anchor
+        t1, x1, y1, h1 = point
+        if self.max_interval is not None and t1 - t0 > self.max_interval:
+            return False
+        window = self.window[:self.size]
+        duration = t1 - t0
+        fraction = (window[:, 0] - t0) / duration if duration > 0 else np.zeros(self.size)
+        dx = x0 + fraction * (x1 - x0) - window[:, 1]
+        dy = y0 + fraction * (y1 - y0) - window[:, 2]
+        if np.any(dx * dx + dy * dy > self.max_error * self.max_error):
+            return False
+        if self.max_heading_error is not None:
+            if np.any(np.abs(h0 + fraction * (h1 - h0) - window[:, 3]) > self.max_heading_error):
+                return False
+        return True
+
+    def keep(self, point: tuple):
+        self.anchor = point
+        self.kept += 1
+        return [point]
+
+    def flush(self):
+        "Ends the trajectory, returns the last point if it was not kept yet. The next point starts a new trajectory."
+        kept = self.keep(tuple(self.window[self.size - 1])) if self.size else []
+        self.anchor = None
+        self.size = 0
+        return kept
+
+
+def zigzag_varints(values: np.ndarray):
+    "Encodes int64 values as zigzag LEB128 varints, returns bytes."
+    values = values.astype(np.int64)
+    encoded = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+    # Bytes per value: 7 bits each, at least one
+    lengths = np.ones(len(encoded), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += encoded >= (np.uint64(1) << np.uint64(shift))
+    offsets = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(lengths) else 0):
+        present = lengths > k
+        chunk = (encoded[present] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (lengths[present] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[present] + k] = chunk | more
+    return out.tobytes()
+
+
+def zigzag_devarints(data: bytes, count: int):
+    "Decodes count zigzag LEB128 varints from the start of data, returns the int64 values and the bytes used."
+    raw = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)[:count]
+    if len(ends) < count:
+        raise ValueError("Truncated varint data")
+    used = int(ends[-1]) + 1 if count else 0
+    raw = raw[:used]
+    starts = np.empty(count, dtype=np.int64)
+    starts[0:1] = 0
+    starts[1:] = ends[:-1] + 1
+    # Position of every byte within its value
+    positions = np.arange(used) - np.repeat(starts, ends - starts + 1)
+    parts = (raw & 0x7F).astype(np.uint64) << (np.uint64(7) * positions.astype(np.uint64))
+    encoded = np.add.reduceat(parts, starts) if count else np.zeros(0, dtype=np.uint64)
+    values = (encoded >> np.uint64(1)).astype(np.int64) ^ -(encoded & np.uint64(1)).astype(np.int64)
+    return values, used
+
+
+def encode_block(points: np.ndarray, resolution: float, heading_resolution: float):
+    "Encodes (n, 4) points as the payload of a block."
+    quantized = np.round(points / np.array([0.001, resolution, resolution, heading_resolution])).astype(np.int64)
+    return b"".join(zigzag_varints(np.diff(column, prepend=0)) for column in quantized.T)
+
+
+def decode_block(payload: bytes, count: int, resolution: float, heading_resolution: float):
+    "Decodes the payload of a block back into (count, 4) points."
+    columns = []
+    offset = 0
+    for _ in COLUMNS:
+        deltas, used = zigzag_devarints(payload[offset:], count)
+        columns.append(np.cumsum(deltas))
+        offset += used
+    return np.stack(columns, axis=1) * np.array([0.001, resolution, resolution, heading_resolution])
+
+
+class TrajectoryWriter:
+    def __init__(self, path: str, resolution: float = 1.0, heading_resolution: float = 0.001, block_points: int = 256):
+        """
+        Args:
+            path (str): Trajectory file, appended to if it exists.\n
+            resolution (float, optional): Quantum of x_loc and y_loc. Defaults to 1.0.\n
+            heading_resolution (float, optional): Quantum of heading in radians. Defaults to 0.001.\n
+            block_points (int, optional): Points of one asset collected before a block is written. Defaults to 256.
+        """
+        self.block_points = block_points
+        self.pending = {}
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            # An existing file keeps its own resolutions
+            with open(path, 'rb') as trajectory_file:
+                resolution, heading_resolution = read_preamble(trajectory_file)
+        self.resolution = resolution
+        self.heading_resolution = heading_resolution
+        self.file = open(path, 'ab')
+        if not exists:
+            self.file.write(MAGIC + RESOLUTIONS.pack(resolution, heading_resolution))
+        self.bytes_written = 0
+
+    def add(self, asset_id, points: list):
+        "Adds kept (unix_timestamp, x_loc, y_loc, heading) points of an asset, writing a block when enough are pending."
+        if not points:
+            return
+        pending = self.pending.setdefault(asset_id, [])
+        pending.extend(points)
+        if len(pending) >= self.block_points:
+            self.write(asset_id)
+
+    def write(self, asset_id):
+        points = np.array(self.pending.pop(asset_id), dtype=float)
+        key = str(asset_id).encode()
+        payload = encode_block(points, self.resolution, self.heading_resolution)
+        self.file.write(HEADER.pack(len(key), len(points), len(payload), points[0, 0], points[-1, 0]) + key + payload)
+        self.bytes_written += HEADER.size + len(key) + len(payload)
+
+    def flush(self):
+        "Writes the pending points of every asset."
+        for asset_id in list(self.pending):
+            self.write(asset_id)
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_preamble(trajectory_file):
+    if trajectory_file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{trajectory_file.name} is not a trajectory file")
+    return RESOLUTIONS.unpack(trajectory_file.read(RESOLUTIONS.size))
+
+
+class TrajectoryReader:
+    def __init__(self, path: str):
+        """Indexes the blocks of a trajectory file by reading their headers.
+
+        Args:
+            path (str): Trajectory file.
+        """
+        self.path = path
+        # asset_id -> [(first, last, payload offset, payload length, count)], in file order
+        self.blocks = {}
+        with open(path, 'rb') as trajectory_file:
+            self.resolution, self.heading_resolution = read_preamble(trajectory_file)
+            while True:
+                header = trajectory_file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                key_length, count, length, first, last = HEADER.unpack(header)
+                asset_id = trajectory_file.read(key_length).decode()
+                offset = trajectory_file.tell()
+                if os.fstat(trajectory_file.fileno()).st_size < offset + length:
+                    # Block cut off by a crash during a write
+                    break
+                self.blocks.setdefault(asset_id, []).append((first, last, offset, length, count))
+                trajectory_file.seek(length, os.SEEK_CUR)
+
+    def assets(self):
+        return list(self.blocks)
+
+    def points(self, asset_id, start: float = None, end: float = None):
+        """Returns the kept (unix_timestamp, x_loc, y_loc, heading) points of an asset as an (n, 4) array, ordered by
+        time, from the last point before start to the first point after end so interpolation covers the whole range."""
+        asset_id = str(asset_id)
+        blocks = self.blocks.get(asset_id, [])
+        chunks = []
+        with open(self.path, 'rb') as trajectory_file:
+            for i, (first, last, offset, length, count) in enumerate(blocks):
+                # Neighbouring blocks are read too, they hold the points just outside the range
+                next_first = blocks[i + 1][0] if i + 1 < len(blocks) else math.inf
+                previous_last = blocks[i - 1][1] if i else -math.inf
+                if start is not None and next_first < start:
+                    continue
+                if end is not None and previous_last > end:
+                    continue
+                trajectory_file.seek(offset)
+                chunks.append(decode_block(trajectory_file.read(length), count, self.resolution, self.heading_resolution))
+        if not chunks:
+            return np.empty((0, 4))
+        points = np.concatenate(chunks)
+        points = points[np.argsort(points[:, 0], kind='stable')]
+        lo = 0 if start is None else max(np.searchsorted(points[:, 0], start, side='right') - 1, 0)
+        hi = len(points) if end is None else np.searchsorted(points[:, 0], end, side='left') + 1
+        return points[lo:hi]
+
+    def positions(self, asset_id, timestamps):
+        """Reconstructs x_loc, y_loc and heading of an asset at the given timestamps, an (n, 3) array. Timestamps
+        outside the recorded span get the first or last recorded position."""
+        timestamps = np.asarray(timestamps, dtype=float)
+        points = self.points(asset_id, timestamps.min(), timestamps.max())
+        if not len(points):
+            return np.full((len(timestamps), 3), np.nan)
+        return np.stack([np.interp(timestamps, points[:, 0], points[:, column]) for column in (1, 2, 3)], axis=1)
@@ -0,0 +1,122 @@
+"""
+Sink that stores the locations of topic_sub compressed, see trajectory.py. Registered as the trajectory sink, so it
+is started in place of the JSON log with log_data.sink set to trajectory, with its settings in log_data.options.
+
+Each asset has its own Compressor. A reset message ends the asset's trajectory, so the jump back to the origin is not
+interpolated.
+"""
+
+from multiprocessing import Process
+from sys import exit
+import app.lib.message_handler as message_handler
+from app.Database.trajectory import Compressor, TrajectoryWriter
+from app.lib.metrics import DEFAULT_METRICS, StageMetrics
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+import json, logging, signal, time
+
+
+class TrajectorySink(Process):
+    def __init__(self, client_id:str, topic_sub:str, log_path:str, control_queue=None, transport:dict=None, reassemble_topics:list=None,
+                 max_error:float=50.0, max_heading_error:float=0.05, max_interval:float=60.0, resolution:float=1.0, heading_resolution:float=0.001,
+                 block_points:int=256, flush_interval:float=10.0, metrics:dict=None, profiling:dict=None):
+        """
+        Args:
+            client_id (str): Name of this process for use by Mosquitto msg broker.\n
+            topic_sub (str): Broker topic with the asset locations.\n
+            log_path (str): Trajectory file, appended to if it exists.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            reassemble_topics (list, optional): Not used, the location payloads hold every stored field. Defaults to None.\n
+            max_error (float, optional): Largest reconstruction error of x_loc and y_loc. Defaults to 50.0.\n
+            max_heading_error (float, optional): Largest reconstruction error of heading in radians, None to ignore heading. Defaults to 0.05.\n
+            max_interval (float, optional): Seconds after which a point is kept even if nothing changed. Defaults to 60.0.\n
+            resolution (float, optional): Quantum x_loc and y_loc are stored with. Defaults to 1.0.\n
+            heading_resolution (float, optional): Quantum heading is stored with. Defaults to 0.001.\n
+            block_points (int, optional): Points of one asset per stored block. Defaults to 256.\n
+            flush_interval (float, optional): Most seconds kept points wait in memory before they are written. Defaults to 10.0.\n
+            metrics (dict, optional): Counters, timings and resource usage reporting, see app.lib.metrics. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
+        Process.__init__(self)
+        self.client_id = client_id
+        self.topic_sub = topic_sub
+        self.log_path = log_path
+        self.control_queue = control_queue
+        self.transport = transport
+        self.max_error = max_error
+        self.max_heading_error = max_heading_error
+        self.max_interval = max_interval
+        self.resolution = resolution
+        self.heading_resolution = heading_resolution
+        self.block_points = block_points
+        self.flush_interval = flush_interval
+        self.metrics_config = dict(DEFAULT_METRICS)
+        if metrics is not None:
+            self.metrics_config.update(metrics)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
+        self.logger = logging.getLogger('app')
+
+    def run(self):
+        try:
+            # Setup interrupt signal handler
+            signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
+            self.logger.debug('Process Started')
+
+            self.compressors = {}
+            self.writer = TrajectoryWriter(self.log_path, self.resolution, self.heading_resolution, self.block_points)
+            self.next_flush = time.monotonic() + self.flush_interval
+
+            self.handler = message_handler.Handler(self.client_id, self.topic_sub, on_ready=self.ready, transport=self.transport)
+            self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            self.metrics = StageMetrics(self.client_id, self.handler, **self.metrics_config)
+            self.handler.connect()
+            self.metrics.start()
+            self.handler.loop()
+
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            exit(1)
+
+    def on_message(self, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
+        data = json.loads(msg.payload)
+        if start:
+            start = self.metrics.decode_time.since(start)
+        # Same convention as the fleet view: the payload's asset_id, else the last level of the topic
+        asset_id = data.get("asset_id") or msg.topic.rsplit('/', 1)[-1]
+        compressor = self.compressors.get(asset_id)
+        if compressor is None:
+            compressor = self.compressors[asset_id] = Compressor(self.max_error, self.max_heading_error, self.max_interval)
+        if data.get("reset") == True:
+            self.writer.add(asset_id, compressor.flush())
+        if "x_loc" in data and "y_loc" in data:
+            timestamp = data.get("unix_timestamp") or time.time()
+            self.writer.add(asset_id, compressor.add(timestamp, data["x_loc"], data["y_loc"], data.get("heading", 0.0)))
+        if time.monotonic() >= self.next_flush:
+            self.writer.flush()
+            self.next_flush = time.monotonic() + self.flush_interval
+        self.metrics.processed += 1
+        if start:
+            self.metrics.process_time.since(start)
+
+    def interrupt_handler(self, signum, frame):
+        self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
+        self.handler.client.disconnect()
+        for asset_id, compressor in self.compressors.items():
+            self.writer.add(asset_id, compressor.flush())
+        self.writer.close()
+        kept = sum(compressor.kept for compressor in self.compressors.values())
+        seen = sum(compressor.seen for compressor in self.compressors.values())
+        self.logger.info(f"TRAJECTORY KEPT {kept} OF {seen} LOCATIONS, {self.writer.bytes_written} BYTES WRITTEN")
+        self.logger.debug('Process Ended')
+        time.sleep(1)
+        exit(0)
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
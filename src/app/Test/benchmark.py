@@ -0,0 +1,811 @@
+"""
+Benchmarks for the performance sensitive parts of the application.
+Run from the src folder: python3 -m app.Test.benchmark [benchmark] [options]
+Use python3 -m app.Test.benchmark -h to list the available benchmarks.
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+
+
+def fleet(args):
+    """Renders a fleet of assets updating at a fixed rate and reports the achieved frame rate of Fleet.redraw()"""
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtCore import QTimer
+    import pyqtgraph as pg
+    from app.Visualization.Components.fleet import Fleet
+
+    with open('config.json') as config_file:
+        settings = json.load(config_file).get("visualization_PyQt.py")
+
+    app = QApplication([])
+    plot_widget = pg.PlotWidget()
+    plot_widget.setRange(xRange=[settings["min_x"], settings["max_x"]], yRange=[settings["min_y"], settings["max_y"]])
+    plot_widget.resize(1600, 900)
+    plot_widget.show()
+    layer = Fleet(plot_widget, settings)
+
+    # Random walk for every asset, published from a background thread like the message broker thread would
+    stop = threading.Event()
+    state = [[random.uniform(settings["min_x"], settings["max_x"]),
+              random.uniform(settings["min_y"], settings["max_y"]),
+              random.uniform(0, 2 * math.pi)] for _ in range(args.assets)]
+
+    def publisher():
+        period = 1 / args.hz
+        while not stop.is_set():
+            start = time.perf_counter()
+            for i, s in enumerate(state):
+                s[2] += random.uniform(-0.2, 0.2)
+                s[0] += 5 * math.sin(-s[2])
+                s[1] += 5 * math.cos(s[2])
+                layer.update_asset(str(i), s[0], s[1], s[2])
+            time.sleep(max(0.0, period - (time.perf_counter() - start)))
+
+    for i in range(args.selected):
+        layer.update_asset(str(i), 0.0, 0.0, 0.0)
+        layer.select(str(i))
+
+    frame_times = []
+
+    def frame():
+        start = time.perf_counter()
+        layer.redraw()
+        app.processEvents()
+        frame_times.append(time.perf_counter() - start)
+        if len(frame_times) * settings["draw_fleet_frequency"] >= args.seconds * 1000:
+            stop.set()
+            app.quit()
+
+    thread = threading.Thread(target=publisher, daemon=True)
+    thread.start()
+    timer = QTimer()
+    timer.timeout.connect(frame)
+    wall_start = time.perf_counter()
+    timer.start(settings["draw_fleet_frequency"])
+    app.exec_()
+    wall = time.perf_counter() - wall_start
+
+    frame_times.sort()
+    print(f"assets={args.assets} hz={args.hz} selected={args.selected}")
+    print(f"frames={len(frame_times)} fps={len(frame_times) / wall:.1f}")
+    print(f"redraw ms: median={1000 * frame_times[len(frame_times) // 2]:.2f} "
+          f"p99={1000 * frame_times[int(len(frame_times) * 0.99)]:.2f} max={1000 * frame_times[-1]:.2f}")
+
+
+def transport(args):
+    """Publishes a burst of raw sized messages through each transport profile and reports the delivered throughput. Requires a running broker."""
+    from paho.mqtt.client import MQTT_ERR_SUCCESS
+    from app.lib.message_handler import Handler, transport_profile
+    from app.lib.messages import Message
+
+    with open('config.json') as config_file:
+        config = json.load(config_file)
+
+    names = args.profiles or list(config.get("transport_profiles", {}))
+    payload = json.dumps(Message("D2:25:5D:F8:2C:F3", "DE:C8:99:45:BC:03").payload)
+    print(f"messages={args.messages} payload={len(payload)} bytes host={args.host}")
+    print(f"{'profile':<12}{'qos':>4}{'inflight':>10}{'publish/s':>12}{'deliver/s':>12}{'delivered':>11}{'rejected':>10}")
+
+    for name in names:
+        profile = transport_profile(config, name)
+        topic = f"Bench/{name}"
+        received = [0, None]
+        ready = threading.Event()
+
+        def on_message(client, userdata, msg):
+            received[0] += 1
+            received[1] = time.perf_counter()
+
+        subscriber = Handler(f"bench_sub_{name}", topic, host=args.host, port=args.port, on_ready=ready.set, transport=profile)
+        subscriber.client.message_callback_add(topic, on_message)
+        subscriber.connect()
+        subscriber.client.loop_start()
+        publisher = Handler(f"bench_pub_{name}", f"Bench/unused/{name}", topic, host=args.host, port=args.port, transport=profile)
+        publisher.connect()
+        publisher.client.loop_start()
+        if not ready.wait(10):
+            raise TimeoutError(f"Subscriber for profile {name} was not ready")
+
+        rejected = 0
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            if publisher.publish(payload).rc != MQTT_ERR_SUCCESS:
+                rejected += 1
+        publish_time = time.perf_counter() - start
+
+        # Wait until delivery stops
+        last_count = -1
+        while received[0] != last_count and received[0] < args.messages - rejected:
+            last_count = received[0]
+            time.sleep(args.idle)
+        deliver_time = (received[1] or start) - start
+
+        publisher.client.disconnect()
+        publisher.client.loop_stop()
+        subscriber.client.disconnect()
+        subscriber.client.loop_stop()
+
+        print(f"{name:<12}{profile['qos']:>4}{profile['max_inflight_messages']:>10}"
+              f"{args.messages / publish_time:>12.0f}{received[0] / deliver_time if deliver_time > 0 else 0:>12.0f}"
+              f"{received[0]:>11}{rejected:>10}")
+
+
+def checkpoint(args):
+    """Runs the raw and linear transformations of many assets over simulated time with and without checkpointing and reports the snapshot overhead."""
+    import copy
+    import os
+    import tempfile
+    from app.lib.checkpoint import Checkpoint
+    from app.lib.messages import Message
+    from app.Transformation.raw_to_linear import Transformer
+    from app.Transformation.linear_to_location import Tracking
+
+    template = Message("D2:25:5D:F8:2C:F3", "DE:C8:99:45:BC:03").payload
+    readings = []
+    for i in range(args.assets):
+        data = copy.deepcopy(template)
+        data["asset_id"] = str(i)
+        data["LSensor"]["gyroZ"] = random.uniform(-200, 200)
+        data["RSensor"]["gyroZ"] = random.uniform(-200, 200)
+        readings.append(data)
+
+    def run(path):
+        assets = {str(i): (Transformer(609.6, 0), Tracking(549.0, 0)) for i in range(args.assets)}
+        store = Checkpoint(path, args.interval)
+        store.next_save = args.interval
+
+        def snapshot():
+            return {asset_id: {"transformer": transformer.get_state(), "tracking": tracking.get_state()}
+                    for asset_id, (transformer, tracking) in assets.items()}
+
+        save_times = []
+        start = time.perf_counter()
+        for step in range(int(args.seconds * args.hz)):
+            now = step / args.hz
+            for data in readings:
+                data["LSensor"]["timestamp"] = data["RSensor"]["timestamp"] = now
+                transformer, tracking = assets[data["asset_id"]]
+                transformer.transform(data)
+                tracking.track(data)
+                if path is not None and now >= store.next_save:
+                    save_start = time.perf_counter()
+                    store.tick(snapshot, now)
+                    save_times.append(time.perf_counter() - save_start)
+        return time.perf_counter() - start, save_times
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkpoint.json")
+        baseline, _ = run(None)
+        total, save_times = run(path)
+        size = os.path.getsize(path)
+
+    messages = args.assets * int(args.seconds * args.hz)
+    save_times.sort()
+    print(f"assets={args.assets} hz={args.hz} seconds={args.seconds} interval={args.interval}")
+    print(f"without checkpoint: {1e6 * baseline / messages:.1f} us/message")
+    print(f"with checkpoint:    {1e6 * total / messages:.1f} us/message ({100 * (total - baseline) / baseline:+.1f}%)")
+    print(f"snapshots={len(save_times)} size={size / 1024:.1f} KiB ms: median={1000 * save_times[len(save_times) // 2]:.2f} max={1000 * save_times[-1]:.2f}")
+    print(f"snapshot time per second of data: {100 * sum(save_times) / args.seconds:.2f}% of one core")
+
+
+def geofence(args):
+    """Evaluates a random walk of several assets against random zones and reports the cost per location as the number of zones grows."""
+    from app.Analytics.geofence import Geofence, Zone
+
+    print(f"assets={args.assets} points/asset={args.points} zone_size={args.zone_size} cell_size={args.cell_size}")
+    print(f"{'zones':>8}{'us/point':>12}{'candidates':>12}{'events':>8}")
+    for count in args.zones:
+        rng = random.Random(1)
+        zones = []
+        for i in range(count):
+            cx = rng.uniform(-args.extent, args.extent)
+            cy = rng.uniform(-args.extent, args.extent)
+            radius = rng.uniform(0.25, 0.5) * args.zone_size
+            sides = rng.randint(4, 10)
+            zones.append(Zone(str(i), [[cx + radius * math.cos(2 * math.pi * k / sides),
+                                        cy + radius * math.sin(2 * math.pi * k / sides)] for k in range(sides)], dwell=30))
+        fence = Geofence(zones, args.cell_size)
+
+        walks = [[rng.uniform(-args.extent, args.extent), rng.uniform(-args.extent, args.extent)] for _ in range(args.assets)]
+        points = []
+        for step in range(args.points):
+            for asset, position in enumerate(walks):
+                position[0] += rng.uniform(-50, 50)
+                position[1] += rng.uniform(-50, 50)
+                points.append((str(asset), position[0], position[1], step * 0.04))
+
+        candidates = sum(len(fence.index.candidates(x, y)) for _, x, y, _ in points)
+        events = 0
+        start = time.perf_counter()
+        for asset_id, x, y, timestamp in points:
+            events += len(fence.evaluate(asset_id, x, y, timestamp))
+        elapsed = time.perf_counter() - start
+        print(f"{count:>8}{1e6 * elapsed / len(points):>12.1f}{candidates / len(points):>12.2f}{events:>8}")
+
+
+def mapmatch(args):
+    """Builds the map matching grid of the floor plan at several cell sizes, uncached and cached, and reports the cost of matching a location."""
+    import tempfile
+    from app.Transformation.map_matching import MapMatcher, load_grid
+
+    with open('config.json') as config_file:
+        settings = json.load(config_file)["visualization_PyQt.py"]
+    # The GUI's extent is in cm, locations are in mm
+    extent = [10 * settings[key] for key in ("min_x", "max_x", "min_y", "max_y")]
+    rng = random.Random(1)
+    points = [(rng.uniform(extent[0], extent[1]), rng.uniform(extent[2], extent[3])) for _ in range(args.points)]
+
+    print(f"map={args.map_path or settings['map_path']} extent={extent} locations={args.points}")
+    print(f"{'cell':>8}{'cells':>10}{'build ms':>10}{'cached ms':>11}{'us/loc':>8}{'snapped':>9}")
+    for cell_size in args.cell_sizes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            start = time.perf_counter()
+            load_grid(args.map_path or settings["map_path"], extent, cell_size, args.threshold, cache_dir)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            grid = load_grid(args.map_path or settings["map_path"], extent, cell_size, args.threshold, cache_dir)
+            cached = time.perf_counter() - start
+        matcher = MapMatcher(grid)
+        start = time.perf_counter()
+        for x, y in points:
+            matcher.match(x, y)
+        elapsed = time.perf_counter() - start
+        print(f"{cell_size:>8g}{grid.walkable.size:>10}{1000 * build:>10.1f}{1000 * cached:>11.1f}{1e6 * elapsed / len(points):>8.2f}{matcher.snapped:>9}")
+
+
+def heatmap(args):
+    """Adds simulated fleet locations to the occupancy heatmaps per location and per batch, and projects the cost of a week of fleet data."""
+    import numpy as np
+    from app.Analytics.heatmap import HEATMAP_VARIANTS, build
+
+    with open('config.json') as config_file:
+        config = json.load(config_file)
+    settings = config["visualization_PyQt.py"]
+    heatmap_config = config["heatmap_msg_handler.py"]
+    # The GUI's extent is in cm, locations are in mm
+    extent = heatmap_config["extent"] or [10 * settings[key] for key in ("min_x", "max_x", "min_y", "max_y")]
+
+    rng = np.random.default_rng(1)
+    steps = args.points // args.assets
+    walks = np.cumsum(rng.normal(0, 50, (steps, args.assets, 2)), axis=0) + rng.uniform(-3000, 3000, (1, args.assets, 2))
+    xs = walks[:, :, 0].ravel()
+    ys = walks[:, :, 1].ravel()
+    # A week of readings at hz per asset, spread over the simulated points
+    timestamps = np.repeat(np.arange(steps) * (604800.0 / steps), args.assets)
+    week = args.assets * args.hz * 604800
+
+    print(f"extent={extent} cell_size={heatmap_config['cell_size']} locations={len(xs)} batch={args.batch}")
+    print(f"{'variant':>8}{'us/loc':>9}{'us/loc batch':>14}{'snapshot ms':>13}{'MiB':>7}{'week cpu s':>12}")
+    for variant in HEATMAP_VARIANTS:
+        grid = build(variant, extent, heatmap_config["cell_size"], heatmap_config["half_life"], heatmap_config["window"], heatmap_config["bucket"])
+        start = time.perf_counter()
+        for x, y, timestamp in zip(xs.tolist(), ys.tolist(), timestamps.tolist()):
+            grid.add(x, y, timestamp, 1.0 / args.hz)
+        single = (time.perf_counter() - start) / len(xs)
+
+        batched = build(variant, extent, heatmap_config["cell_size"], heatmap_config["half_life"], heatmap_config["window"], heatmap_config["bucket"])
+        start = time.perf_counter()
+        for i in range(0, len(xs), args.batch):
+            batched.add_batch(xs[i:i + args.batch], ys[i:i + args.batch], timestamps[i:i + args.batch], np.full(len(xs[i:i + args.batch]), 1.0 / args.hz))
+        batch = (time.perf_counter() - start) / len(xs)
+        now = timestamps[-1]
+        assert np.allclose(grid.snapshot(now), batched.snapshot(now))
+
+        start = time.perf_counter()
+        grid.snapshot(now)
+        snapshot = time.perf_counter() - start
+        memory = sum(value.nbytes for value in grid.get_state().values() if isinstance(value, np.ndarray))
+        print(f"{variant:>8}{1e6 * single:>9.2f}{1e6 * batch:>14.3f}{1000 * snapshot:>13.2f}{memory / 2 ** 20:>7.1f}{week * single:>12.0f}")
+
+
+def trajectory(args):
+    """Compresses a simulated 25 Hz wheelchair path (straight runs, turns and stops) and reports the storage saved against JSON lines and the reconstruction error."""
+    import os
+    import tempfile
+    import numpy as np
+    from app.Database.trajectory import Compressor, TrajectoryReader, TrajectoryWriter
+
+    rng = np.random.default_rng(1)
+    steps = int(args.minutes * 60 * args.hz)
+    # Segments of straight runs (turn rate 0), turns, and stops (speed 0), with sensor noise
+    kinds = rng.integers(0, 3, steps // 100 + 1)
+    lengths = rng.integers(50, 500, len(kinds))
+    rates = np.where(kinds == 1, rng.uniform(-0.5, 0.5, len(kinds)), 0.0)
+    speeds = np.where(kinds == 2, 0.0, rng.uniform(200, 1200, len(kinds)))
+    rate = np.repeat(rates, lengths)[:steps]
+    speed = np.repeat(speeds, lengths)[:steps]
+    dt = 1 / args.hz
+    timestamps = 1.7e9 + np.arange(len(rate)) * dt
+    headings = np.cumsum(rate * dt)
+    xs = np.cumsum(-np.sin(headings) * speed * dt) + rng.normal(0, 0.5, len(rate))
+    ys = np.cumsum(np.cos(headings) * speed * dt) + rng.normal(0, 0.5, len(rate))
+
+    records = [json.dumps({"asset_id": "chair", "x_loc": x, "y_loc": y, "heading": h, "unix_timestamp": t, "seq": i})
+               for i, (t, x, y, h) in enumerate(zip(timestamps.tolist(), xs.tolist(), ys.tolist(), headings.tolist()))]
+    json_bytes = sum(len(record) + 1 for record in records)
+
+    print(f"locations={len(timestamps)} ({args.minutes} min at {args.hz} Hz) json={json_bytes / 2 ** 20:.1f} MiB")
+    print(f"{'max_error':>10}{'kept':>8}{'ratio':>9}{'bytes':>10}{'vs json':>9}{'err max':>9}{'head err':>10}{'us/loc':>8}{'query ms':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for max_error in args.errors:
+            path = os.path.join(folder, f"{max_error}.traj")
+            compressor = Compressor(max_error, args.heading_error, args.interval)
+            writer = TrajectoryWriter(path)
+            start = time.perf_counter()
+            for t, x, y, h in zip(timestamps.tolist(), xs.tolist(), ys.tolist(), headings.tolist()):
+                writer.add("chair", compressor.add(t, x, y, h))
+            writer.add("chair", compressor.flush())
+            writer.close()
+            elapsed = time.perf_counter() - start
+
+            reader = TrajectoryReader(path)
+            positions = reader.positions("chair", timestamps)
+            error = np.hypot(positions[:, 0] - xs, positions[:, 1] - ys).max()
+            heading_error = np.abs(positions[:, 2] - headings).max()
+            # Five minutes in the middle of the run
+            middle = timestamps[len(timestamps) // 2]
+            start = time.perf_counter()
+            reader.positions("chair", np.arange(middle, middle + 300, dt))
+            query = time.perf_counter() - start
+            size = os.path.getsize(path)
+            print(f"{max_error:>10g}{compressor.kept:>8}{len(timestamps) / compressor.kept:>8.1f}x{size:>10}{json_bytes / size:>8.0f}x"
+                  f"{error:>9.1f}{heading_error:>10.3f}{1e6 * elapsed / len(timestamps):>8.1f}{1000 * query:>10.2f}")
+
+
+def logseek(args):
+    """Writes a JSON lines log like location_to_log.py with its sidecar index and compares reading a five minute window with the index against a scan from the start."""
+    import os
+    import tempfile
+    from app.lib.log_index import IndexWriter, build_index, read_window
+
+    record = {"seq": 0, "asset_id": "chair", "unix_timestamp": 0.0, "x_loc": 0.0, "y_loc": 0.0, "heading": 0.0, "LW_dis": 0.0, "RW_dis": 0.0,
+              "LSensor": {"accX": 0.0, "accY": 0.0, "accZ": 0.0, "gyroX": 0.0, "gyroY": 0.0, "gyroZ": 0.0, "timestamp": 0.0},
+              "RSensor": {"accX": 0.0, "accY": 0.0, "accZ": 0.0, "gyroX": 0.0, "gyroY": 0.0, "gyroZ": 0.0, "timestamp": 0.0}}
+    count = int(args.hours * 3600 * args.hz)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "run.log")
+        index = IndexWriter(path, args.every)
+        start = time.perf_counter()
+        with open(path, 'w') as log_file:
+            for i in range(count):
+                record["seq"] = i
+                record["unix_timestamp"] = 1.7e9 + i / args.hz
+                record["x_loc"] = float(i)
+                line = json.dumps(record) + '\n'
+                log_file.write(line)
+                index.record(line, record)
+        write = time.perf_counter() - start
+        index.close()
+        size = os.path.getsize(path)
+        print(f"records={count} log={size / 2 ** 20:.0f} MiB index={os.path.getsize(path + '.idx') / 1024:.0f} KiB every={args.every}")
+        print(f"indexing while writing: {1e6 * write / count:.1f} us/record including the write")
+
+        start = time.perf_counter()
+        build_index(path, args.every)
+        print(f"indexing an existing log: {time.perf_counter() - start:.1f} s")
+
+        window_start = 1.7e9 + count / args.hz * 0.8
+        start = time.perf_counter()
+        indexed = sum(1 for _ in read_window(path, window_start, window_start + 300))
+        seek = time.perf_counter() - start
+        os.remove(path + '.idx')
+        start = time.perf_counter()
+        scanned = sum(1 for _ in read_window(path, window_start, window_start + 300))
+        scan = time.perf_counter() - start
+        assert indexed == scanned
+        print(f"5 min window ({indexed} records): indexed {1000 * seek:.1f} ms, scan {1000 * scan:.0f} ms ({scan / seek:.0f}x)")
+
+
+def shard_worker(stream, start, results):
+    "Worker process of the shards benchmark: the raw and linear work of a stage worker on the messages of its partitions."
+    from app.lib.sequence import Resequencer
+    from app.Transformation.raw_to_linear import Transformer
+    from app.Transformation.linear_to_location import Tracking
+
+    assets = {}
+    start.wait()
+    begin = time.perf_counter()
+    for topic, payload in stream:
+        data = json.loads(payload)
+        asset = assets.get(data["asset_id"])
+        if asset is None:
+            asset = assets[data["asset_id"]] = (Resequencer(), Transformer(609.6, 0), Tracking(549.0, 0))
+        resequencer, transformer, tracking = asset
+        for data, gap in resequencer.push(data):
+            transformer.transform(data, gap)
+            tracking.track(data)
+            json.dumps(data)
+    results.put(time.perf_counter() - begin)
+
+
+def shards(args):
+    """Spreads a fleet over sharded stage workers: balance of the hash ring, partitions moved when a worker is added, throughput per worker count and a check that a handoff keeps every asset's location."""
+    import copy
+    import os
+    import sys
+    from multiprocessing import Event, Process, Queue
+    from app.lib.messages import Message
+    from app.lib.sharding import HashRing, Router, partition_of
+    from app.Transformation.raw_to_linear import Transformer
+    from app.Transformation.linear_to_location import Tracking
+
+    asset_ids = [f"asset-{i}" for i in range(args.assets)]
+    print(f"assets={args.assets} readings/asset={args.readings} partitions={args.partitions} replicas={args.replicas} cores={os.cpu_count()}")
+
+    print(f"{'workers':>8}{'partitions/worker':>20}{'assets/worker':>16}{'moved +1 worker':>17}{'ideal':>8}")
+    for workers in args.workers:
+        owners = HashRing([f"worker-{i}" for i in range(workers)], args.replicas).assignment(args.partitions)
+        grown = HashRing([f"worker-{i}" for i in range(workers + 1)], args.replicas).assignment(args.partitions)
+        per_worker = [owners.count(f"worker-{i}") for i in range(workers)]
+        assets = [sum(owners[partition_of(asset_id, args.partitions)] == f"worker-{i}" for asset_id in asset_ids) for i in range(workers)]
+        moved = sum(a != b for a, b in zip(owners, grown)) / args.partitions
+        print(f"{workers:>8}{f'{min(per_worker)}-{max(per_worker)}':>20}{f'{min(assets)}-{max(assets)}':>16}{100 * moved:>16.1f}%{100 / (workers + 1):>7.1f}%")
+
+    # The fleet's raw messages in arrival order, on the topics a sharded raw stage receives them
+    template = Message("D2:25:5D:F8:2C:F3", "DE:C8:99:45:BC:03").payload
+    router = Router("Data/raw", args.partitions)
+    readings = []
+    for step in range(args.readings):
+        for asset_id in asset_ids:
+            data = copy.deepcopy(template)
+            data["asset_id"] = asset_id
+            data["seq"] = step + 1
+            data["LSensor"]["gyroZ"] = random.uniform(-200, 200)
+            data["RSensor"]["gyroZ"] = random.uniform(-200, 200)
+            data["LSensor"]["timestamp"] = data["RSensor"]["timestamp"] = step / 25
+            readings.append(data)
+    stream = [(router.topic(data["asset_id"]), json.dumps(data)) for data in readings]
+
+    print(f"{'workers':>8}{'messages/s':>12}{'speedup':>9}{'efficiency':>12}{'busiest worker':>16}")
+    baseline = None
+    for workers in args.workers:
+        names = [f"worker-{i}" for i in range(workers)]
+        owners = HashRing(names, args.replicas).assignment(args.partitions)
+        # The broker's routing: every worker only receives the topics of its partitions
+        streams = {name: [] for name in names}
+        for topic, payload in stream:
+            streams[owners[int(topic.rsplit('/', 1)[-1])]].append((topic, payload))
+        start = Event()
+        results = Queue()
+        processes = [Process(target=shard_worker, args=(streams[name], start, results)) for name in names]
+        for process in processes:
+            process.start()
+        time.sleep(0.5)
+        begin = time.perf_counter()
+        start.set()
+        busiest = max(results.get() for _ in processes)
+        wall = time.perf_counter() - begin
+        for process in processes:
+            process.join()
+        rate = len(stream) / wall
+        baseline = baseline or rate / workers
+        speedup = rate / baseline
+        print(f"{workers:>8}{rate:>12.0f}{speedup:>9.2f}{100 * speedup / workers:>11.0f}%{1000 * busiest:>13.0f} ms")
+
+    # Handoff check: a worker is added halfway and the moved partitions continue from the handed over state
+    def new_asset():
+        return Transformer(609.6, 0), Tracking(549.0, 0)
+
+    def process(assets, data):
+        transformer, tracking = assets.setdefault(data["asset_id"], new_asset())
+        transformer.transform(data)
+        tracking.track(data)
+
+    reference = {}
+    for topic, payload in stream:
+        process(reference, json.loads(payload))
+
+    workers = max(args.workers)
+    names = [f"worker-{i}" for i in range(workers + 1)]
+    before = HashRing(names[:-1], args.replicas).assignment(args.partitions)
+    after = HashRing(names, args.replicas).assignment(args.partitions)
+    held = {name: {} for name in names}
+    half = len(stream) // 2
+    for i, (topic, payload) in enumerate(stream):
+        partition = int(topic.rsplit('/', 1)[-1])
+        if i == half:
+            for asset_id in asset_ids:
+                moved_partition = partition_of(asset_id, args.partitions)
+                source, target = before[moved_partition], after[moved_partition]
+                if source != target and asset_id in held[source]:
+                    transformer, tracking = held[source].pop(asset_id)
+                    state = json.loads(json.dumps({"transformer": transformer.get_state(), "tracking": tracking.get_state()}))
+                    held[target][asset_id] = new_asset()
+                    held[target][asset_id][0].set_state(state["transformer"])
+                    held[target][asset_id][1].set_state(state["tracking"])
+        owners = before if i < half else after
+        process(held[owners[partition]], json.loads(payload))
+
+    mismatched = 0
+    for asset_id, (transformer, tracking) in reference.items():
+        owner = after[partition_of(asset_id, args.partitions)]
+        other = held[owner][asset_id][1]
+        if (other.x, other.y, other.heading) != (tracking.x, tracking.y, tracking.heading):
+            mismatched += 1
+    moved = sum(before[partition_of(asset_id, args.partitions)] != after[partition_of(asset_id, args.partitions)] for asset_id in asset_ids)
+    print(f"handoff {workers} -> {workers + 1} workers: {moved} assets moved, {mismatched} locations differ from a single worker")
+    if mismatched:
+        sys.exit(1)
+
+
+def metrics(args):
+    """Overhead of app.lib.metrics on the message path of the raw and linear stages: decoding, queueing, transforming, tracking, encoding and publishing a message with and without the instrumentation, exits with an error above --budget percent if given."""
+    import statistics
+    import sys
+    import timeit
+    import paho.mqtt.client as mqtt
+    from app.lib import messages
+    from app.lib.backpressure import LagMonitor, StageQueue
+    from app.lib.metrics import StageMetrics, prometheus
+    from app.Transformation.raw_to_linear import Transformer
+    from app.Transformation.linear_to_location import Tracking
+    from app.Transformation.raw_to_linear_msg_handler import PUBLISHED_FIELDS
+
+    template = messages.Message("D2:25:5D:F8:2C:F3", "DE:C8:99:45:BC:03").payload
+    payloads = []
+    for i in range(args.readings):
+        template["seq"] = i + 1
+        template["LSensor"]["gyroZ"] = random.uniform(-200, 200)
+        template["RSensor"]["gyroZ"] = random.uniform(-200, 200)
+        template["LSensor"]["timestamp"] = template["RSensor"]["timestamp"] = i / 25
+        payloads.append(json.dumps(template))
+
+    # The path of RawProcess.on_message() and process(): the queue to the processing thread, the lag monitor and
+    # paho's publish. The client is not connected, it builds the message but nothing is written to a socket, and
+    # paho's reading of the incoming messages is left out.
+    queue = StageQueue(args.readings, "block")
+    monitor = LagMonitor("benchmark", None, queue, "Debug/lag", math.inf)
+    client = mqtt.Client("benchmark")
+
+    def plain():
+        transformer = Transformer(609.6, 0)
+        tracking = Tracking(549.0, 0)
+        for payload in payloads:
+            data = json.loads(payload)
+            queue.put(data["asset_id"], data)
+            enqueue_time, data = queue.get(timeout=0)
+            transformer.transform(data)
+            tracking.track(data)
+            info = client.publish("Data/linear", json.dumps(messages.delta(data, PUBLISHED_FIELDS)), 0)
+            monitor.record(enqueue_time, data, info.rc)
+            queue.task_done()
+
+    # The same path instrumented like RawProcess.on_message() and process(), sampled by a thread like the stage's
+    # reporting thread
+    stage = StageMetrics("benchmark", sample_interval=args.sample_interval)
+    stop = threading.Event()
+
+    def sampler():
+        while not stop.wait(args.sample_interval):
+            stage.sample()
+
+    def instrumented():
+        transformer = Transformer(609.6, 0)
+        tracking = Tracking(549.0, 0)
+        for payload in payloads:
+            stage.received += 1
+            start = stage.sample_receive and stage.start_receive()
+            data = json.loads(payload)
+            if start:
+                stage.decode_time.since(start)
+            queue.put(data["asset_id"], data)
+            enqueue_time, data = queue.get(timeout=0)
+            stage.processed += 1
+            start = stage.sample_process and stage.start_process()
+            transformer.transform(data)
+            tracking.track(data)
+            if start:
+                start = stage.process_time.since(start)
+            payload = json.dumps(messages.delta(data, PUBLISHED_FIELDS))
+            if start:
+                stage.encode_time.since(start)
+            info = client.publish("Data/linear", payload, 0)
+            stage.published += 1
+            monitor.record(enqueue_time, data, info.rc)
+            queue.task_done()
+
+    def hooks():
+        for payload in payloads:
+            stage.received += 1
+            start = stage.sample_receive and stage.start_receive()
+            if start:
+                stage.decode_time.since(start)
+            stage.processed += 1
+            start = stage.sample_process and stage.start_process()
+            if start:
+                start = stage.process_time.since(start)
+            if start:
+                stage.encode_time.since(start)
+            stage.published += 1
+
+    threading.Thread(target=sampler, daemon=True).start()
+    # A difference of 1 % is below the noise of a single run, so the paths run in pairs, in alternating order so
+    # neither always runs first, and the overhead is the median of the pairs' ratios. The ratio of two runs of the
+    # plain path is the noise floor the overhead is read against.
+    ratios, controls = [], []
+    for i in range(args.repeat):
+        if i % 2:
+            measured = timeit.timeit(instrumented, number=1)
+            message = timeit.timeit(plain, number=1)
+        else:
+            message = timeit.timeit(plain, number=1)
+            measured = timeit.timeit(instrumented, number=1)
+        ratios.append(measured / message)
+        controls.append(timeit.timeit(plain, number=1) / message)
+    overhead = 100 * (statistics.median(ratios) - 1)
+    noise = 100 * (statistics.median(controls) - 1)
+    message = 1e6 * message / args.readings
+    hook = 1e6 * min(timeit.repeat(hooks, number=1, repeat=5)) / args.readings
+    report = 1e6 * timeit.timeit(lambda: prometheus({"benchmark": stage.snapshot()}), number=100) / 100
+    snapshot = 1e6 * timeit.timeit(lambda: json.dumps(stage.snapshot()), number=100) / 100
+    stop.set()
+
+    print(f"readings={args.readings} sample_interval={args.sample_interval} repeat={args.repeat}")
+    print(f"message path: {message:.2f} us/message, instrumentation alone {1000 * hook:.0f} ns/message")
+    budget = f" (budget {args.budget} %)" if args.budget is not None else ""
+    print(f"end to end: {overhead:+.2f} % instrumented against plain, median of {args.repeat} pairs{budget}, "
+          f"plain against plain {noise:+.2f} %")
+    print(f"snapshot: {snapshot:.0f} us every interval, /metrics of one stage: {report:.0f} us")
+    if args.budget is not None and overhead > args.budget:
+        sys.exit(1)
+
+
+def profiling(args):
+    """Cost of app.lib.profiling while a profile runs: the time of one sample of the stacks and the slowdown of the raw and linear stages' message path, exits with an error above --budget percent."""
+    import os
+    import signal
+    import sys
+    import tempfile
+    import timeit
+    from app.lib import messages
+    from app.lib.profiling import SamplingProfiler
+    from app.Transformation.raw_to_linear import Transformer
+    from app.Transformation.linear_to_location import Tracking
+    from app.Transformation.raw_to_linear_msg_handler import PUBLISHED_FIELDS
+
+    template = messages.Message("D2:25:5D:F8:2C:F3", "DE:C8:99:45:BC:03").payload
+    payloads = []
+    for i in range(args.readings):
+        template["seq"] = i + 1
+        template["LSensor"]["gyroZ"] = random.uniform(-200, 200)
+        template["RSensor"]["gyroZ"] = random.uniform(-200, 200)
+        template["LSensor"]["timestamp"] = template["RSensor"]["timestamp"] = i / 25
+        payloads.append(json.dumps(template))
+
+    def path():
+        transformer = Transformer(609.6, 0)
+        tracking = Tracking(549.0, 0)
+        for payload in payloads:
+            data = json.loads(payload)
+            transformer.transform(data)
+            tracking.track(data)
+            json.dumps(messages.delta(data, PUBLISHED_FIELDS))
+
+    # A stage's threads besides the one processing: paho's network loop and a reporter, both idle
+    idle = threading.Event()
+    for _ in range(2):
+        threading.Thread(target=idle.wait, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        profiler = SamplingProfiler("benchmark", duration=3600, interval=args.interval, path=folder)
+        if not profiler.install():
+            sys.exit(f"{profiler.signal} is not available on this platform")
+        # Alternated and best of the repeats, a profile is started and stopped with the signal like on site
+        off_seconds, on_seconds = [], []
+        for _ in range(args.repeat):
+            off_seconds.append(timeit.timeit(path, number=1))
+            os.kill(os.getpid(), signal.SIGUSR1)
+            on_seconds.append(timeit.timeit(path, number=1))
+            os.kill(os.getpid(), signal.SIGUSR1)
+            while len(os.listdir(folder)) < len(on_seconds):
+                time.sleep(0.01)
+        with open(os.path.join(folder, sorted(os.listdir(folder))[-1])) as profile_file:
+            stacks = [line.rsplit(' ', 1) for line in profile_file]
+        sample = 1e6 * timeit.timeit(lambda: profiler.sample({}, threading.get_ident()), number=1000) / 1000
+    idle.set()
+
+    off = 1e6 * min(off_seconds) / args.readings
+    on = 1e6 * min(on_seconds) / args.readings
+    # Share of one core the sampling thread takes, it holds the GIL while it walks the stacks
+    overhead = 100 * sample * 1e-6 / args.interval
+
+    print(f"readings={args.readings} interval={args.interval} s repeat={args.repeat} threads={threading.active_count()}")
+    print(f"message path: {off:.2f} us/message, profiled {on:.2f} us/message ({100 * (on - off) / off:+.2f} % measured end to end)")
+    print(f"sample: {sample:.1f} us every {1000 * args.interval:g} ms, {overhead:.2f} % of a core (budget {args.budget} %)")
+    print(f"last profile: {sum(int(count) for _, count in stacks)} samples in {len(stacks)} stacks")
+    if overhead > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('fleet', help=fleet.__doc__)
+    p.add_argument('--assets', type=int, default=1000)
+    p.add_argument('--hz', type=float, default=5)
+    p.add_argument('--selected', type=int, default=3, help='Number of assets with a trail drawn.')
+    p.add_argument('--seconds', type=float, default=10)
+    p.set_defaults(func=fleet)
+
+    p = subparsers.add_parser('transport', help=transport.__doc__)
+    p.add_argument('profiles', nargs='*', help='Profiles to compare. Defaults to all profiles in config.json.')
+    p.add_argument('--messages', type=int, default=20000)
+    p.add_argument('--host', default='localhost')
+    p.add_argument('--port', type=int, default=1883)
+    p.add_argument('--idle', type=float, default=1.0, help='Seconds without a delivery before the burst is considered done.')
+    p.set_defaults(func=transport)
+
+    p = subparsers.add_parser('checkpoint', help=checkpoint.__doc__)
+    p.add_argument('--assets', type=int, default=100)
+    p.add_argument('--hz', type=float, default=25)
+    p.add_argument('--seconds', type=float, default=20, help='Simulated seconds of data.')
+    p.add_argument('--interval', type=float, default=1.0, help='Seconds between snapshots.')
+    p.set_defaults(func=checkpoint)
+
+    p = subparsers.add_parser('geofence', help=geofence.__doc__)
+    p.add_argument('zones', nargs='*', type=int, default=[100, 1000, 10000], help='Zone counts to compare.')
+    p.add_argument('--assets', type=int, default=100)
+    p.add_argument('--points', type=int, default=100, help='Locations per asset.')
+    p.add_argument('--extent', type=float, default=50000, help='Half width of the map in map units.')
+    p.add_argument('--zone-size', type=float, default=1000, help='Approximate zone diameter in map units.')
+    p.add_argument('--cell-size', type=float, default=500)
+    p.set_defaults(func=geofence)
+
+    p = subparsers.add_parser('mapmatch', help=mapmatch.__doc__)
+    p.add_argument('cell_sizes', nargs='*', type=float, default=[100, 50, 20], help='Cell sizes to compare, in mm.')
+    p.add_argument('--map-path', default=None, help="Floor plan image. Defaults to the GUI's map_path.")
+    p.add_argument('--threshold', type=int, default=250, help='Grey level from which a cell is walkable.')
+    p.add_argument('--points', type=int, default=100000, help='Random locations to match.')
+    p.set_defaults(func=mapmatch)
+
+    p = subparsers.add_parser('heatmap', help=heatmap.__doc__)
+    p.add_argument('--assets', type=int, default=100)
+    p.add_argument('--hz', type=float, default=1, help='Location updates per second per asset, for the week projection.')
+    p.add_argument('--points', type=int, default=200000, help='Simulated locations.')
+    p.add_argument('--batch', type=int, default=1000, help='Locations per batch.')
+    p.set_defaults(func=heatmap)
+
+    p = subparsers.add_parser('trajectory', help=trajectory.__doc__)
+    p.add_argument('errors', nargs='*', type=float, default=[10, 50, 200], help='max_error values to compare, in mm.')
+    p.add_argument('--minutes', type=float, default=60)
+    p.add_argument('--hz', type=float, default=25)
+    p.add_argument('--heading-error', type=float, default=0.05, help='max_heading_error in radians.')
+    p.add_argument('--interval', type=float, default=60, help='max_interval in seconds.')
+    p.set_defaults(func=trajectory)
+
+    p = subparsers.add_parser('logseek', help=logseek.__doc__)
+    p.add_argument('--hours', type=float, default=2)
+    p.add_argument('--hz', type=float, default=25)
+    p.add_argument('--every', type=int, default=1000, help='Records between index entries.')
+    p.set_defaults(func=logseek)
+
+    p = subparsers.add_parser('shards', help=shards.__doc__)
+    p.add_argument('workers', nargs='*', type=int, default=[1, 2, 4], help='Worker counts to compare.')
+    p.add_argument('--assets', type=int, default=200)
+    p.add_argument('--readings', type=int, default=250, help='Readings per asset.')
+    p.add_argument('--partitions', type=int, default=64)
+    p.add_argument('--replicas', type=int, default=64)
+    p.set_defaults(func=shards)
+
+    p = subparsers.add_parser('metrics', help=metrics.__doc__)
+    p.add_argument('--readings', type=int, default=500)
+    p.add_argument('--sample-interval', type=float, default=0.05, help='Seconds between timed messages.')
+    p.add_argument('--repeat', type=int, default=400, help='Pairs of plain and instrumented runs.')
+    p.add_argument('--budget', type=float, default=None, help='Most overhead in percent, not checked by default.')
+    p.set_defaults(func=metrics)
+
+    p = subparsers.add_parser('profiling', help=profiling.__doc__)
+    p.add_argument('--readings', type=int, default=20000)
+    p.add_argument('--interval', type=float, default=0.01, help='Seconds between samples.')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--budget', type=float, default=1.0, help='Most overhead in percent.')
+    p.set_defaults(func=profiling)
+
+    args = parser.parse_args()
+    args.func(args)
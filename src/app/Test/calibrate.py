@@ -0,0 +1,389 @@
+"""
+Searches the dps filter constants and the wheel and axle geometry that best reproduce the ground truth of recorded
+runs, replacing the hand tuning of the values in raw_to_linear.Transformer and config.json.
+
+The runs and their <run name>.truth.json files are those of evaluate.py. Runs are grouped by sensor pair, the
+"sensor_pair" field of the truth file, defaulting to the device (testbed or chair) the run was recorded with, and each
+group is calibrated on its own.
+
+Every candidate is scored with vectorized versions of the transformation layer: the filter chains run through
+FilterChain.batch, the integration of Transformer.calculate_distance_over_interval and the turns of Tracking.turn are
+array expressions with the heading as a cumulative sum. Their results match the streaming classes up to rounding, so
+they are only usable for runs without reset messages. The score of a candidate is the mean over the runs of
+|distance error| / distance + position error / distance + heading_weight * |heading error|, with the terms the truth
+file has. Candidates are spread over a process pool, every worker loads the runs once.
+
+Search:
+- grid: steps values across the bounds of every searched parameter.
+- random: samples candidates drawn uniformly within the bounds.
+- --descend: coordinate descent from the best candidate found. Every round the candidates one step up and down each
+  parameter are scored together, the best move is taken, and the steps are halved when no move improves the score.
+
+The result is written as a config.json fragment per sensor pair.
+
+Run from the src folder:
+python3 -m app.Test.calibrate [runs folder] [--mode grid|random] [--steps N] [--samples N] [--descend]
+                              [--params NAME ...] [--space FILE] [--workers N] [--output FILE]
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from app.lib import filters
+from app.Test.evaluate import TRUTH_SUFFIX, find_runs, geometry, load_records, settings, wrap_angle
+from app.Transformation.raw_to_linear import Transformer
+
+DPS_PARAMETERS = ("cutoff", "cutoff_multiplier", "additive_factor", "percentage", "left_wheel_exponent",
+                  "right_wheel_exponent")
+PARAMETERS = DPS_PARAMETERS + ("wheel_diameter", "axle_length")
+SENSOR_FIELDS = ("accX", "accY", "accZ", "gyroX", "gyroY", "gyroZ", "timestamp")
+# Search bounds, geometry bounds are relative to the configured value
+DEFAULT_BOUNDS = {
+    "cutoff": (0.0, 3.0),
+    "cutoff_multiplier": (1.0, 4.0),
+    "additive_factor": (0.0, 1.0),
+    "percentage": (0.0, 0.02),
+    "left_wheel_exponent": (1.0, 3.0),
+    "right_wheel_exponent": (1.0, 3.0),
+    "wheel_diameter": (0.95, 1.05),
+    "axle_length": (0.9, 1.1),
+}
+
+# Runs of every sensor pair, loaded once per worker process by load_groups()
+GROUPS = {}
+SETTINGS = {}
+
+
+def load_run(path: str, truth_path: str, run_settings: dict):
+    "Columns of a run the vectorized pipeline reads, with its ground truth and device."
+    with open(truth_path) as truth_file:
+        truth = json.load(truth_file)
+    records = load_records(path)
+    if any(data.get("reset") == True for data in records):
+        raise ValueError(f"{path} contains a reset, it can not be calibrated against one final position")
+    seqs = np.array([data.get("seq", -1) for data in records], dtype=np.int64)
+    gaps = np.zeros(len(records), dtype=np.int64)
+    # Same gaps as evaluate.py, readings without seq have none
+    known = (seqs[1:] >= 0) & (seqs[:-1] >= 0)
+    gaps[1:] = np.where(known, np.maximum(seqs[1:] - seqs[:-1] - 1, 0), 0)
+    run = {
+        "name": os.path.basename(path),
+        "truth": truth,
+        "device": ("testbed" if truth["testbed"] else "chair") if "testbed" in truth else run_settings["device"],
+        "geometry": geometry(run_settings, truth),
+        "gaps": gaps,
+        "cache": {},
+    }
+    for wheel, sensor in (("left", "LSensor"), ("right", "RSensor")):
+        run[wheel] = {field: np.array([data[sensor].get(field, 0.0) for data in records], dtype=float) for field in SENSOR_FIELDS}
+    return run
+
+
+def load_groups(groups: dict, run_settings: dict):
+    """Worker initializer, loads the runs of every sensor pair.
+
+    Args:
+        groups (dict): sensor pair -> list of (run path, truth path).\n
+        run_settings (dict): See evaluate.settings().
+    """
+    SETTINGS.update(run_settings)
+    for pair, runs in groups.items():
+        GROUPS[pair] = [load_run(path, truth_path, run_settings) for path, truth_path in runs]
+
+
+def pair_of(truth_path: str, run_settings: dict):
+    with open(truth_path) as truth_file:
+        truth = json.load(truth_file)
+    if truth.get("sensor_pair"):
+        return str(truth["sensor_pair"])
+    if "testbed" in truth:
+        return "testbed" if truth["testbed"] else "chair"
+    return run_settings["device"]
+
+
+def dps_chain(spec: list, params: dict):
+    "The raw filter chain with params set on its dps filters."
+    return [{**config, **{name: params[name] for name in DPS_PARAMETERS}} if config["type"] == "dps" else config
+            for config in spec]
+
+
+def filtered_dps(run: dict, params: dict):
+    """Output of the raw filter chain for both wheels. Only the last dps parameters are cached, candidates that share
+    them (the grid varies the geometry fastest) skip the filtering."""
+    key = tuple(params[name] for name in DPS_PARAMETERS)
+    if key not in run["cache"]:
+        spec = dps_chain(SETTINGS["raw_filter_chain"], params)
+        run["cache"].clear()
+        run["cache"][key] = {wheel: filters.build_chain(spec, wheel).batch(run[wheel]["gyroZ"], run[wheel])
+                             for wheel in ("left", "right")}
+    return run["cache"][key]
+
+
+def linear_distances(dps, timestamps, gaps, circumference: float, gap_strategy: str):
+    "Transformer.calculate_distance_over_interval for a whole run, the distance of every reading."
+    distances = np.zeros(len(dps))
+    if len(dps) < 2:
+        return distances
+    previous = dps[:-1]
+    current = np.where(gaps[1:] > 0, previous, dps[1:]) if gap_strategy == "hold" else dps[1:]
+    delta_time = np.diff(timestamps)
+    acceleration = np.divide(current - previous, delta_time, out=np.zeros(len(previous)), where=delta_time != 0)
+    rotational = (previous + current) / 2 * delta_time + .5 * acceleration * delta_time ** 2
+    distances[1:] = rotational / 360 * circumference
+    if gap_strategy == "reset":
+        # Integration restarts at the reading after the gap
+        distances[1:][gaps[1:] > 0] = 0.0
+    return distances
+
+
+def track(left, right, axle_length: float):
+    "Tracking.turn for a whole run, returns the final x, y and heading."
+    with np.errstate(divide='ignore', invalid='ignore'):
+        left_abs = np.abs(left)
+        right_abs = np.abs(right)
+        # Direction of the turn and side of the turn center, in the order of the cases of Tracking.turn
+        forward = (left >= 0) & (right >= 0)
+        reverse = ~forward & (left <= 0) & (right <= 0)
+        spin_positive = ~forward & ~reverse & (left <= 0) & (right >= 0)
+        spin_negative = ~forward & ~reverse & ~spin_positive
+        rotation = np.select([forward, reverse, spin_positive, spin_negative],
+                             [np.where(left_abs < right_abs, 1, -1), np.where(left_abs < right_abs, -1, 1), 1, -1])
+        r_adj = np.select([forward, reverse, spin_positive, spin_negative],
+                          [np.where(left_abs < right_abs, -1, 1), np.where(left_abs < right_abs, -1, 1),
+                           np.where(left_abs > right_abs, 1, -1), np.where(left_abs < right_abs, -1, 1)])
+        outer = np.where(left_abs > right_abs, left_abs, right_abs)
+        inner = np.where(left_abs > right_abs, right_abs, left_abs)
+        half_axle = axle_length / 2
+        opposite = ((left > 0) & (right < 0)) | ((left < 0) & (right > 0))
+        outer_r = outer * axle_length / (outer + inner)
+        radius = np.select([inner == 0, opposite],
+                           [r_adj * half_axle, r_adj * (outer_r - half_axle)],
+                           r_adj * (inner * axle_length / (outer - inner) + half_axle))
+        turn_angle = np.select([inner == 0, opposite],
+                               [rotation * (outer / half_axle), rotation * (outer / outer_r)],
+                               rotation * (inner * (outer - inner)) / (inner * axle_length))
+        straight = left == right
+        turn_angle = np.where(straight, 0.0, turn_angle)
+        # Displacement in the frame of the heading before the reading: a rotation of the origin around (radius, 0)
+        local_x = np.where(straight, 0.0, radius - radius * np.cos(turn_angle))
+        local_y = np.where(straight, left, -radius * np.sin(turn_angle))
+    heading = np.cumsum(turn_angle)
+    before = heading - turn_angle
+    x = np.sum(local_x * np.cos(before) - local_y * np.sin(before))
+    y = np.sum(local_x * np.sin(before) + local_y * np.cos(before))
+    return float(x), float(y), float(heading[-1]) if len(heading) else 0.0
+
+
+def simulate(run: dict, params: dict):
+    "Final distance, x_loc, y_loc and heading of a run processed with params."
+    dps = filtered_dps(run, params)
+    circumference = math.pi * params["wheel_diameter"]
+    distances = {wheel: linear_distances(dps[wheel], run[wheel]["timestamp"], run["gaps"], circumference,
+                                         SETTINGS["gap_strategy"]) for wheel in ("left", "right")}
+    distance = (np.sum(distances["left"]) + np.sum(distances["right"])) / 2
+    linear_chain = SETTINGS["linear_filter_chain"]
+    if linear_chain:
+        distances = {wheel: filters.build_chain(linear_chain, wheel).batch(distances[wheel]) for wheel in distances}
+    return (float(distance), *track(distances["left"], distances["right"], params["axle_length"]))
+
+
+def loss(run: dict, result: tuple, heading_weight: float):
+    "Error of a run's result relative to its ground truth."
+    distance, x, y, heading = result
+    truth = run["truth"]
+    scale = truth.get("distance") or max(math.hypot(truth.get("x_loc") or 0.0, truth.get("y_loc") or 0.0), run["geometry"][1])
+    total = 0.0
+    if truth.get("distance") is not None:
+        total += abs(distance - truth["distance"]) / scale
+    if truth.get("x_loc") is not None and truth.get("y_loc") is not None:
+        total += math.hypot(x - truth["x_loc"], y - truth["y_loc"]) / scale
+    if truth.get("heading") is not None:
+        total += heading_weight * abs(wrap_angle(heading - truth["heading"]))
+    return total
+
+
+def score_chunk(job: tuple):
+    """Scores of a list of candidates on the runs of a sensor pair. Runs in a worker process.
+
+    Args:
+        job (tuple): (sensor pair, candidates, heading weight).
+    """
+    pair, candidates, heading_weight = job
+    runs = GROUPS[pair]
+    scores = []
+    for params in candidates:
+        value = sum(loss(run, simulate(run, params), heading_weight) for run in runs) / len(runs)
+        scores.append(value if math.isfinite(value) else math.inf)
+    return scores
+
+
+class Scorer:
+    """Scores candidates in a pool of workers, or in this process with one worker."""
+
+    def __init__(self, groups: dict, run_settings: dict, workers: int = None, heading_weight: float = 1.0):
+        self.workers = workers or os.cpu_count()
+        self.heading_weight = heading_weight
+        if self.workers == 1:
+            load_groups(groups, run_settings)
+            self.executor = None
+        else:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=load_groups, initargs=(groups, run_settings))
+
+    def score(self, pair: str, candidates: list):
+        # A few chunks per worker balances the load without sending every candidate on its own
+        size = max(1, math.ceil(len(candidates) / (4 * self.workers)))
+        chunks = [(pair, candidates[i:i + size], self.heading_weight) for i in range(0, len(candidates), size)]
+        mapped = map(score_chunk, chunks) if self.executor is None else self.executor.map(score_chunk, chunks)
+        return [value for scores in mapped for value in scores]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def baseline(run_settings: dict, run_geometry: tuple):
+    "The parameters the pipeline uses now: Transformer's dps defaults, the config's dps filter and the geometry."
+    params = Transformer(run_geometry[0], 0, []).dps_parameters()
+    for config in run_settings["raw_filter_chain"]:
+        if config["type"] == "dps":
+            params.update({name: value for name, value in config.items() if name in DPS_PARAMETERS})
+    params["wheel_diameter"], params["axle_length"] = run_geometry
+    return params
+
+
+def search_bounds(params: dict, searched: list, space: dict):
+    "(low, high) of every searched parameter."
+    bounds = {}
+    for name in searched:
+        low, high = space.get(name, DEFAULT_BOUNDS[name])
+        if name in ("wheel_diameter", "axle_length") and name not in space:
+            low, high = low * params[name], high * params[name]
+        bounds[name] = (float(low), float(high))
+    return bounds
+
+
+def grid_candidates(params: dict, bounds: dict, steps: int):
+    "Every combination of steps values per parameter, the geometry varying fastest."
+    names = sorted(bounds, key=lambda name: name in ("wheel_diameter", "axle_length"))
+    values = [np.linspace(*bounds[name], steps) if steps > 1 else [sum(bounds[name]) / 2] for name in names]
+    return [{**params, **dict(zip(names, map(float, combination)))} for combination in itertools.product(*values)]
+
+
+def random_candidates(params: dict, bounds: dict, samples: int, rng: random.Random):
+    candidates = [{**params, **{name: rng.uniform(*bounds[name]) for name in bounds}} for _ in range(samples)]
+    # Grouping by dps parameters lets the workers reuse the filtered dps, see filtered_dps()
+    return sorted(candidates, key=lambda params: tuple(params[name] for name in DPS_PARAMETERS))
+
+
+def descend(scorer: Scorer, pair: str, best: dict, best_score: float, bounds: dict, steps: int, rounds: int, tolerance: float = 1e-3):
+    "Coordinate descent from best, returns the best candidate found and its score."
+    step = {name: (high - low) / (2 * max(steps, 2)) for name, (low, high) in bounds.items()}
+    for _ in range(rounds):
+        if all(step[name] <= tolerance * (high - low) for name, (low, high) in bounds.items()):
+            break
+        moves = []
+        for name, (low, high) in bounds.items():
+            for direction in (-1, 1):
+                value = min(max(best[name] + direction * step[name], low), high)
+                if value != best[name]:
+                    moves.append((name, {**best, name: value}))
+        scores = scorer.score(pair, [candidate for name, candidate in moves])
+        if scores and min(scores) < best_score:
+            i = int(np.argmin(scores))
+            best, best_score = moves[i][1], scores[i]
+        else:
+            step = {name: value / 2 for name, value in step.items()}
+    return best, best_score
+
+
+def fragment(params: dict, device: str, run_settings: dict, searched: list):
+    "config.json fragment with the calibrated values of a sensor pair."
+    raw = {}
+    linear = {}
+    if any(name in DPS_PARAMETERS for name in searched):
+        raw["filter_chain"] = dps_chain(run_settings["raw_filter_chain"], params)
+    if "wheel_diameter" in searched:
+        raw[f"{device}_wheel_diameter"] = round(params["wheel_diameter"], 3)
+    if "axle_length" in searched:
+        linear[f"{device}_axle_length"] = round(params["axle_length"], 3)
+    return {section: values for section, values in (("raw_to_linear_msg_handler.py", raw), ("linear_to_location_msg_handler.py", linear)) if values}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help=f"Folder with the runs and their {TRUTH_SUFFIX} files")
+    parser.add_argument('--mode', choices=("grid", "random"), default="random")
+    parser.add_argument('--steps', type=int, default=3, help="Grid values per parameter, also sets the first descent step")
+    parser.add_argument('--samples', type=int, default=500, help="Random candidates")
+    parser.add_argument('--max-candidates', type=int, default=100000, help="Largest grid searched")
+    parser.add_argument('--descend', action='store_true', help="Refine the best candidate with coordinate descent")
+    parser.add_argument('--rounds', type=int, default=50, help="Most coordinate descent rounds")
+    parser.add_argument('--params', nargs='+', choices=PARAMETERS, default=list(PARAMETERS), help="Parameters searched, the others keep their configured values")
+    parser.add_argument('--space', help='JSON file with {"parameter": [low, high]} bounds replacing the defaults')
+    parser.add_argument('--heading-weight', type=float, default=1.0, help="Weight of the heading error in radians against the relative distance errors")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes, defaults to one per core")
+    parser.add_argument('--config', default="config.json")
+    device_group = parser.add_mutually_exclusive_group()
+    device_group.add_argument('--testbed', dest='testbed', action='store_true', default=None, help="Runs without a testbed field use the testbed geometry")
+    device_group.add_argument('--chair', dest='testbed', action='store_false', help="Runs without a testbed field use the wheelchair geometry")
+    parser.add_argument('--output', help="Write the config fragments to this json file")
+    args = parser.parse_args()
+
+    run_settings = settings(args.config, args.testbed)
+    # Transformer's default chain
+    if run_settings["raw_filter_chain"] is None:
+        run_settings["raw_filter_chain"] = [{"type": "dps"}]
+    searched = list(args.params)
+    if not any(config["type"] == "dps" for config in run_settings["raw_filter_chain"]):
+        searched = [name for name in searched if name not in DPS_PARAMETERS]
+        print("The raw filter chain has no dps filter, only the geometry is calibrated")
+    space = {}
+    if args.space:
+        with open(args.space) as space_file:
+            space = json.load(space_file)
+
+    groups = {}
+    for path, truth_path in find_runs(args.folder):
+        groups.setdefault(pair_of(truth_path, run_settings), []).append((path, truth_path))
+    if not groups:
+        parser.exit(1, f"No runs with a {TRUTH_SUFFIX} file in {args.folder}\n")
+    if args.mode == "grid" and args.steps ** len(searched) > args.max_candidates:
+        parser.exit(1, f"A grid of {args.steps ** len(searched)} candidates is larger than --max-candidates, search fewer --params or use --mode random\n")
+
+    rng = random.Random(args.seed)
+    scorer = Scorer(groups, run_settings, args.workers, args.heading_weight)
+    fragments = {}
+    try:
+        for pair, runs in groups.items():
+            first = load_run(*runs[0], run_settings)
+            params = baseline(run_settings, first["geometry"])
+            bounds = search_bounds(params, searched, space)
+            if args.mode == "grid":
+                candidates = grid_candidates(params, bounds, args.steps)
+            else:
+                candidates = random_candidates(params, bounds, args.samples, rng)
+            baseline_score = scorer.score(pair, [params])[0]
+            # The configured values compete too, the result is never worse than what is running
+            scores = scorer.score(pair, candidates + [params])
+            best_index = int(np.argmin(scores))
+            best, best_score = (candidates + [params])[best_index], scores[best_index]
+            if args.descend:
+                best, best_score = descend(scorer, pair, best, best_score, bounds, args.steps, args.rounds)
+
+            print(f"{pair}: {len(runs)} runs, {len(candidates)} candidates, score {baseline_score:.4f} -> {best_score:.4f}")
+            for name in searched:
+                print(f"  {name:<22} {params[name]:>12.6g} -> {best[name]:>12.6g}")
+            fragments[pair] = fragment(best, first["device"], run_settings, searched)
+    finally:
+        scorer.close()
+
+    print(json.dumps(fragments, indent=4))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(fragments, output_file, indent=4)
@@ -3,17 +3,42 @@ Process that mimics the data aggregation layer by publishing previous run data f
 """
 
 from multiprocessing import Process, Queue
-from time import sleep
+from time import sleep, time
 import paho.mqtt.publish as publish
 from paho.mqtt.client import MQTTv5
 import json
 import csv
 import logging
 import signal
+from app.lib.sharding import Router
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+
+
+def csv_record(row: dict):
+    "Raw record (the sensor_to_raw payload) of a row of a legacy csv recording, without seq."
+    record = {
+        "start_time": float(row["Start_time"]),
+        "LW_dis": 0.0,
+        "RW_dis": 0.0,
+        "unix_timestamp": 0.0,
+        "x_loc": 0.0,
+        "y_loc": 0.0,
+    }
+    for sensor, prefix in (("LSensor", "L"), ("RSensor", "R")):
+        record[sensor] = {
+            "accX": float(row[f"{prefix}-ACC.X"]),
+            "accY": float(row[f"{prefix}-ACC.Y"]),
+            "accZ": float(row[f"{prefix}-ACC.Z"]),
+            "gyroX": float(row[f"{prefix}-GYRO.X"]),
+            "gyroY": float(row[f"{prefix}-GYRO.Y"]),
+            "gyroZ": float(row[f"{prefix}-GYRO.Z"]),
+            "timestamp": float(row[f"{prefix}-Timestamp"]),
+        }
+    return record
 
 
 class CsvToRaw(Process):
-    def __init__(self, client_id: str, topic_pub: str, csv_path: str, hz: int, queue: Queue):
+    def __init__(self, client_id: str, topic_pub: str, csv_path: str, hz: int, queue: Queue, transport: dict = None, seek: dict = None, partitions: int = None, profiling: dict = None):
         """
         Args:
             client_id (str): Mosquitto client id
@@ -21,6 +46,12 @@ class CsvToRaw(Process):
             csv_path (str): Full path to the csv file with previous run data.
             hz (int): Hz that the previous data was generated at.
             queue (multiprocessing Queue): Allows for communication with parent process.
+            transport (dict, optional): Transport profile, only its qos is used. Defaults to None (qos 1).
+            seek (dict, optional): Window to replay: seq (first row, from 1) and max_records. The csv exports have no
+            unix_timestamp and no index, rows before seq are skipped. Defaults to None, the whole run.
+            partitions (int, optional): Partitions of topic_pub when the raw stage is sharded. The recordings have no
+            asset_id, every row goes to the partition of asset None. Defaults to None.
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
         """
         Process.__init__(self)
         self.client_id = client_id
@@ -28,37 +59,21 @@ class CsvToRaw(Process):
         self.csv_path = csv_path
         self.hz = hz
         self.queue = queue
+        self.qos = transport["qos"] if transport is not None else 1
+        self.seek = seek or {}
+        self.router = Router(topic_pub, partitions)
+        if self.seek.get("start") is not None or self.seek.get("end") is not None:
+            raise ValueError("CSV recordings have no unix_timestamp, seek them by seq")
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
         self.logger = logging.getLogger('app')
-        self.data = {
-            "start_time": 0.0,
-            "LW_dis": 0.0,
-            "RW_dis": 0.0,
-            "unix_timestamp": 0.0,
-            "x_loc": 0.0,
-            "y_loc": 0.0,
-            "LSensor": {
-                "accX": 0.0,
-                "accY": 0.0,
-                "accZ": 0.0,
-                "gyroX": 0.0,
-                "gyroY": 0.0,
-                "gyroZ": 0.0,
-                "timestamp": 0.0,
-            },
-            "RSensor": {
-                "accX": 0.0,
-                "accY": 0.0,
-                "accZ": 0.0,
-                "gyroX": 0.0,
-                "gyroY": 0.0,
-                "gyroZ": 0.0,
-                "timestamp": 0.0,
-            }
-        }
+        self.seq = 0
 
     def run(self):
         try:
             signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
             
             self.logger.debug('Process Started')
             
@@ -66,31 +81,25 @@ class CsvToRaw(Process):
             reader = csv.DictReader(self.csv_file)
             self.logger.info(f"STREAMING LEGACY DATA FROM: {self.csv_path}")
                 
-            for row in reader:    
-                self.data["start_time"] = float(row["Start_time"])
+            run = int(time() * 1000)
+            first = self.seek.get("seq") or 1
+            max_records = self.seek.get("max_records")
+            for row_number, row in enumerate(reader, 1):
+                if row_number < first:
+                    continue
+                if max_records is not None and row_number >= first + max_records:
+                    break
+                self.seq += 1
+                self.data = csv_record(row)
+                self.data["seq"] = self.seq
+                self.data["run"] = run
 
-                self.data["LSensor"]["accX"] = float(row["L-ACC.X"])
-                self.data["LSensor"]["accY"] = float(row["L-ACC.Y"])
-                self.data["LSensor"]["accZ"] = float(row["L-ACC.Z"])
-                self.data["LSensor"]["gyroX"] = float(row["L-GYRO.X"])
-                self.data["LSensor"]["gyroY"] = float(row["L-GYRO.Y"])
-                self.data["LSensor"]["gyroZ"] = float(row["L-GYRO.Z"])
-                self.data["LSensor"]["timestamp"] = float(row["L-Timestamp"])
-                    
-                self.data["RSensor"]["accX"] = float(row["R-ACC.X"])
-                self.data["RSensor"]["accY"] = float(row["R-ACC.Y"])
-                self.data["RSensor"]["accZ"] = float(row["R-ACC.Z"])
-                self.data["RSensor"]["gyroX"] = float(row["R-GYRO.X"])
-                self.data["RSensor"]["gyroY"] = float(row["R-GYRO.Y"])
-                self.data["RSensor"]["gyroZ"] = float(row["R-GYRO.Z"])
-                self.data["RSensor"]["timestamp"] = float(row["R-Timestamp"])
-                    
                 publish.single(
-                    topic=self.topic_pub,
+                    topic=self.router.topic(None),
                     payload=json.dumps(self.data),
                     hostname="localhost",
                     port=1883,
-                    qos=1,
+                    qos=self.qos,
                     protocol=MQTTv5
                 )
                     
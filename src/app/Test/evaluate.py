@@ -0,0 +1,243 @@
+"""
+Reprocesses a folder of recorded runs through Transformer and Tracking and compares the result with ground truth,
+replacing the one run at a time comparisons of the legacy errorMargin.py and testError.py scripts.
+
+A run is a JSON lines log of raw records (json_to_raw.py, .log/.json/.jsonl) or a legacy csv recording (csv_to_raw.py,
+.csv), with its ground truth next to it in <run name>.truth.json:
+    {"distance": 5000.0, "x_loc": 0.0, "y_loc": 5000.0, "heading": 0.0}
+distance is the distance travelled by the center of the axle in mm, x_loc and y_loc the final position in mm, heading
+the final heading in radians. Every field is optional, the errors of missing fields are left empty. "testbed" (bool),
+"wheel_diameter" and "axle_length" override the geometry of config.json for that run.
+
+Runs are independent, each one is processed in a worker of a process pool, largest first so the pool stays busy, and
+the throughput scales with the number of cores.
+
+Run from the src folder: python3 -m app.Test.evaluate [runs folder] [--workers N] [--testbed] [--csv FILE] [--json FILE]
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from app.Test.csv_to_raw import csv_record
+from app.Transformation.raw_to_linear import Transformer
+from app.Transformation.linear_to_location import Tracking
+
+RUN_SUFFIXES = (".log", ".json", ".jsonl", ".csv")
+TRUTH_SUFFIX = ".truth.json"
+# Errors reported per run and aggregated over the runs that have them
+ERRORS = ("distance_error", "distance_error_pct", "position_error", "heading_error")
+
+
+def settings(config_path: str = "config.json", testbed: bool = None):
+    """Pipeline settings of config.json used to reprocess the runs.
+
+    Args:
+        config_path (str, optional): Application config. Defaults to "config.json".\n
+        testbed (bool, optional): Use the testbed geometry. Defaults to None, use_testbed of the config.
+    """
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    raw_config = config["raw_to_linear_msg_handler.py"]
+    linear_config = config["linear_to_location_msg_handler.py"]
+    if testbed is None:
+        testbed = config["initialize.py"].get("use_testbed") == True
+    device = "testbed" if testbed else "chair"
+    return {
+        "device": device,
+        "wheel_diameter": raw_config[f"{device}_wheel_diameter"],
+        "axle_length": linear_config[f"{device}_axle_length"],
+        "testbed_wheel_diameter": raw_config["testbed_wheel_diameter"],
+        "testbed_axle_length": linear_config["testbed_axle_length"],
+        "chair_wheel_diameter": raw_config["chair_wheel_diameter"],
+        "chair_axle_length": linear_config["chair_axle_length"],
+        "raw_filter_version": raw_config["filter_version"],
+        "raw_filter_chain": raw_config.get("filter_chain"),
+        "gap_strategy": (raw_config.get("sequencing") or {}).get("gap_strategy", "interpolate"),
+        "linear_filter_version": linear_config["filter_version"],
+        "linear_filter_chain": linear_config.get("filter_chain"),
+    }
+
+
+def find_runs(folder: str):
+    "(run path, truth path) of every run in folder that has ground truth, sorted by name."
+    runs = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(TRUTH_SUFFIX) or not name.endswith(RUN_SUFFIXES):
+            continue
+        truth_path = os.path.join(folder, name.rsplit('.', 1)[0] + TRUTH_SUFFIX)
+        if os.path.exists(truth_path):
+            runs.append((os.path.join(folder, name), truth_path))
+    return runs
+
+
+def load_records(path: str):
+    "Raw records of a run, in recorded order."
+    with open(path, newline='') as run_file:
+        if path.endswith(".csv"):
+            return [csv_record(row) for row in csv.DictReader(run_file)]
+        return [json.loads(line) for line in run_file if line.strip()]
+
+
+def geometry(run_settings: dict, truth: dict):
+    "wheel_diameter and axle_length of a run, with the overrides of its ground truth."
+    wheel_diameter = run_settings["wheel_diameter"]
+    axle_length = run_settings["axle_length"]
+    if "testbed" in truth:
+        device = "testbed" if truth["testbed"] else "chair"
+        wheel_diameter = run_settings[f"{device}_wheel_diameter"]
+        axle_length = run_settings[f"{device}_axle_length"]
+    return truth.get("wheel_diameter", wheel_diameter), truth.get("axle_length", axle_length)
+
+
+def wrap_angle(angle: float):
+    "angle in (-pi, pi]."
+    return math.pi - (math.pi - angle) % (2 * math.pi)
+
+
+def evaluate_run(job: tuple):
+    """Reprocesses one run and returns its row of the report. Runs in a worker process.
+
+    Args:
+        job (tuple): (run path, truth path, settings).
+    """
+    path, truth_path, run_settings = job
+    with open(truth_path) as truth_file:
+        truth = json.load(truth_file)
+    start = time.perf_counter()
+    records = load_records(path)
+    load_seconds = time.perf_counter() - start
+
+    wheel_diameter, axle_length = geometry(run_settings, truth)
+    transformer = Transformer(wheel_diameter, run_settings["raw_filter_version"], run_settings["raw_filter_chain"],
+                              run_settings["gap_strategy"])
+    tracker = Tracking(axle_length, run_settings["linear_filter_version"], run_settings["linear_filter_chain"])
+    previous_seq = None
+    start = time.perf_counter()
+    for data in records:
+        # Readings lost while recording are the gaps the live pipeline's resequencer would report
+        seq = data.get("seq")
+        gap = seq - previous_seq - 1 if seq is not None and previous_seq is not None and seq > previous_seq + 1 else 0
+        if seq is not None:
+            previous_seq = seq
+        transformer.transform(data, gap)
+        tracker.track(data)
+    seconds = time.perf_counter() - start
+
+    row = {
+        "run": os.path.basename(path),
+        "records": len(records),
+        "duration": records[-1]["LSensor"]["timestamp"] - records[0]["LSensor"]["timestamp"] if records else 0.0,
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "records_per_second": len(records) / seconds if seconds > 0 else 0.0,
+        "distance": (transformer.total_distance_left_wheel + transformer.total_distance_right_wheel) / 2,
+        "x_loc": tracker.x,
+        "y_loc": tracker.y,
+        "heading": tracker.heading,
+    }
+    row.update(dict.fromkeys(ERRORS))
+    if truth.get("distance") is not None:
+        row["distance_error"] = row["distance"] - truth["distance"]
+        if truth["distance"]:
+            row["distance_error_pct"] = 100 * row["distance_error"] / truth["distance"]
+    if truth.get("x_loc") is not None and truth.get("y_loc") is not None:
+        row["position_error"] = math.hypot(tracker.x - truth["x_loc"], tracker.y - truth["y_loc"])
+    if truth.get("heading") is not None:
+        row["heading_error"] = wrap_angle(tracker.heading - truth["heading"])
+    return row
+
+
+def evaluate(runs: list, run_settings: dict, workers: int = None):
+    """Reprocesses runs in a pool of workers, returns (rows in the order of runs, wall seconds).
+
+    Args:
+        runs (list): (run path, truth path) tuples, see find_runs().\n
+        run_settings (dict): See settings().\n
+        workers (int, optional): Worker processes, 1 to process in this process. Defaults to None, one per core.
+    """
+    # Largest runs first, so a long run does not start last and keep a single worker busy at the end
+    order = sorted(range(len(runs)), key=lambda i: os.path.getsize(runs[i][0]), reverse=True)
+    jobs = [(*runs[i], run_settings) for i in order]
+    start = time.perf_counter()
+    if workers == 1:
+        results = [evaluate_run(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(evaluate_run, jobs))
+    wall = time.perf_counter() - start
+    rows = [None] * len(runs)
+    for i, row in zip(order, results):
+        rows[i] = row
+    return rows, wall
+
+
+def aggregate(rows: list, wall: float):
+    "Summary of the rows of evaluate(): absolute errors over the runs that have them, and throughput."
+    summary = {"runs": len(rows), "records": sum(row["records"] for row in rows), "wall_seconds": wall}
+    busy = sum(row["load_seconds"] + row["seconds"] for row in rows)
+    summary["records_per_second"] = summary["records"] / wall if wall > 0 else 0.0
+    # Worker seconds per wall second, the number of cores the evaluation kept busy
+    summary["parallelism"] = busy / wall if wall > 0 else 0.0
+    for error in ERRORS:
+        values = [abs(row[error]) for row in rows if row[error] is not None]
+        summary[error] = {
+            "runs": len(values),
+            "mean": statistics.fmean(values) if values else None,
+            "median": statistics.median(values) if values else None,
+            "max": max(values) if values else None,
+        }
+    return summary
+
+
+def print_report(rows: list, summary: dict):
+    def cell(value, digits=1):
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    print(f"{'run':<32} {'records':>8} {'rec/s':>9} {'dist mm':>9} {'dist err':>9} {'err %':>7} {'pos err':>9} {'head err':>9}")
+    for row in rows:
+        print(f"{row['run'][:32]:<32} {row['records']:>8} {row['records_per_second']:>9.0f} {row['distance']:>9.1f} "
+              f"{cell(row['distance_error']):>9} {cell(row['distance_error_pct'], 2):>7} {cell(row['position_error']):>9} "
+              f"{cell(row['heading_error'], 3):>9}")
+    print()
+    print(f"{summary['runs']} runs, {summary['records']} records in {summary['wall_seconds']:.2f} s: "
+          f"{summary['records_per_second']:.0f} records/s, {summary['parallelism']:.1f} workers busy")
+    for error in ERRORS:
+        values = summary[error]
+        if values["runs"]:
+            digits = 3 if error == "heading_error" else 2
+            print(f"|{error}| over {values['runs']} runs: mean {cell(values['mean'], digits)} "
+                  f"median {cell(values['median'], digits)} max {cell(values['max'], digits)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help="Folder with the runs and their .truth.json files")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes, defaults to one per core")
+    parser.add_argument('--config', default="config.json")
+    device = parser.add_mutually_exclusive_group()
+    device.add_argument('--testbed', dest='testbed', action='store_true', default=None, help="Use the testbed geometry")
+    device.add_argument('--chair', dest='testbed', action='store_false', help="Use the wheelchair geometry")
+    parser.add_argument('--csv', help="Write the per run rows to this csv file")
+    parser.add_argument('--json', help="Write the rows and the summary to this json file")
+    args = parser.parse_args()
+
+    runs = find_runs(args.folder)
+    if not runs:
+        parser.exit(1, f"No runs with a {TRUTH_SUFFIX} file in {args.folder}\n")
+    rows, wall = evaluate(runs, settings(args.config, args.testbed), args.workers)
+    summary = aggregate(rows, wall)
+    print_report(rows, summary)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({"runs": rows, "summary": summary}, json_file, indent=4)
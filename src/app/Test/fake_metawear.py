@@ -0,0 +1,138 @@
+"""
+Fake libmetawear for exercising sensors.Sensor without hardware or mbientlab installed.
+
+FakeLibMetaWear records every call made to it, hands out fake signal pointers, and calls data processor created
+callbacks immediately, so the processor graph Sensor.setup() builds can be inspected. FakeBindings stands in for
+mbientlab's cbindings and parse_value:
+
+    lib = FakeLibMetaWear()
+    sensor = sensors.Sensor(FakeDevice(), cond, message, 'LSensor', handler, logger, gyro_only=True, averaging_depth=4,
+                            decimate_ms=40, lib=lib, bindings=FakeBindings)
+    sensor.setup()
+    lib.processor_graph()  ->  [('lowpass', 'gyro', (4,)), ('time', 'lowpass#1', (0, 40))]
+    lib.subscribed  ->  ['time#2']
+
+Run from the src folder to print the graph for the sampling settings in config.json:
+python3 -m app.Test.fake_metawear
+"""
+
+import json
+import logging
+from threading import Condition
+
+
+class FakeDevice:
+    def __init__(self, address: str = "00:00:00:00:00:00"):
+        self.address = address
+        self.board = 1
+
+    def disconnect(self):
+        pass
+
+
+class FakeBindings:
+    """The libmetawear callback types and enums Sensor uses, with the rates and ranges of the MMR board. Callback types
+    return the Python function unwrapped, parse_value returns the data it is given."""
+
+    class AccBmi270Odr:
+        _0_78125Hz, _1_5625Hz, _3_125Hz, _6_25Hz, _12_5Hz, _25Hz, _50Hz, _100Hz, _200Hz, _400Hz, _800Hz, _1600Hz = range(1, 13)
+
+    class AccBoschRange:
+        _2G, _4G, _8G, _16G = range(4)
+
+    class GyroBoschOdr:
+        _25Hz, _50Hz, _100Hz, _200Hz, _400Hz, _800Hz, _1600Hz, _3200Hz = range(6, 14)
+
+    class GyroBoschRange:
+        _2000dps, _1000dps, _500dps, _250dps, _125dps = range(5)
+
+    class TimeMode:
+        ABSOLUTE, DIFFERENTIAL = range(2)
+
+    @staticmethod
+    def FnVoid_VoidP_DataP(fn):
+        return fn
+
+    @staticmethod
+    def FnVoid_VoidP_VoidP(fn):
+        return fn
+
+    @staticmethod
+    def parse_value(data, n_elem=1):
+        return data
+
+
+class FakeLibMetaWear:
+    """Records calls to any mbl_mw_* function. Signal getters return fake pointers and *_create processor functions
+    call their created callback with a new fake pointer before returning. Pointers are plain ints so they pass through
+    ctypes callbacks and arrays, name() translates them back to readable names."""
+
+    SIGNALS = {
+        "mbl_mw_gyro_bmi270_get_rotation_data_signal": "gyro",
+        "mbl_mw_acc_get_acceleration_data_signal": "acc",
+    }
+
+    def __init__(self):
+        self.calls = []
+        self.pointers = {1: "board"}
+        self.processors = []
+        self.subscribed = []
+
+    def new_pointer(self, name: str):
+        pointer = 0x1000 + len(self.pointers)
+        self.pointers[pointer] = name
+        return pointer
+
+    def name(self, pointer):
+        return self.pointers.get(pointer, repr(pointer))
+
+    def __getattr__(self, name: str):
+        if not name.startswith("mbl_mw_"):
+            raise AttributeError(name)
+
+        def call(*args):
+            self.calls.append((name, args))
+            if name in self.SIGNALS:
+                return self.new_pointer(self.SIGNALS[name])
+            if name.startswith("mbl_mw_dataprocessor_") and name.endswith("_create"):
+                kind = name[len("mbl_mw_dataprocessor_"):-len("_create")]
+                processor = self.new_pointer(f"{kind}#{len(self.processors) + 1}")
+                # (source, *parameters, context, created_callback)
+                self.processors.append((processor, kind, args[0], args[1:-2]))
+                args[-1](args[-2], processor)
+                return None
+            if name == "mbl_mw_datasignal_subscribe":
+                self.subscribed.append(self.name(args[0]))
+            return None
+
+        call.__name__ = name
+        return call
+
+    def processor_graph(self):
+        """Returns (kind, source, parameters) for each created data processor, in creation order."""
+        graph = []
+        for processor, kind, source, parameters in self.processors:
+            if kind == "fuser":
+                # ops is a ctypes array of the fused signals
+                parameters = ([self.name(op) for op in parameters[0]],) + tuple(parameters[1:])
+            graph.append((kind, self.name(source), parameters))
+        return graph
+
+    def called(self, name: str):
+        return [args for call, args in self.calls if call == name]
+
+
+if __name__ == '__main__':
+    import app.Aggregator.sensors as sensors
+
+    with open('config.json') as config_file:
+        sampling = json.load(config_file)["sensor_to_raw_msg_handler.py"].get("sampling", {})
+
+    lib = FakeLibMetaWear()
+    sensors.sleep = lambda seconds: None
+    sensor = sensors.Sensor(FakeDevice(), Condition(), None, 'LSensor', None, logging.getLogger('app'), lib=lib, bindings=FakeBindings, **sampling)
+    sensor.setup()
+    print(f"sampling: {sampling}")
+    for kind, source, parameters in lib.processor_graph():
+        print(f"  {kind:<8} <- {source:<12} {parameters}")
+    print(f"  subscribed: {lib.subscribed}")
@@ -0,0 +1,84 @@
+"""
+Reports the import time of each application entry point and the modules it pulls in.
+Each entry point is imported in a fresh interpreter with python -X importtime so results are not skewed by caching.
+Entry point scripts are run without their __main__ block, so only their imports are measured.
+
+Run from the src folder: python3 -m app.Test.import_time [entry ...] [--top N] [--budget-ms MS]
+With no entries given, initialize.py, visualization-PyQt.py and every registered source and sink are measured.
+"""
+
+import argparse
+import subprocess
+import sys
+from app.lib import registry
+
+ENTRY_SCRIPTS = ["initialize.py", "visualization-PyQt.py"]
+
+
+def measure(entry: str):
+    """Imports entry in a new interpreter and returns (rows, error). Rows are (self_us, cumulative_us, module) tuples.
+
+    Args:
+        entry (str): Path of a .py script, or a dotted module name. None measures interpreter startup only.
+    """
+    if entry is None:
+        code = "pass"
+    elif entry.endswith('.py'):
+        code = f"import runpy; runpy.run_path({entry!r}, run_name='__import_time__')"
+    else:
+        code = f"import importlib; importlib.import_module({entry!r})"
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    rows = []
+    error = None
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            # Column header line
+            continue
+        rows.append((int(fields[0]), int(fields[1]), fields[2].rstrip()))
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1]
+    return rows, error
+
+
+def report(entry: str, top: int, startup_modules: set):
+    """Prints the most expensive modules imported by entry and returns its total import time in ms.
+    Modules in startup_modules are imported by every interpreter at startup and are left out."""
+    rows, error = measure(entry)
+    rows = [row for row in rows if row[2].strip() not in startup_modules]
+    # Top level imports of the entry point are the rows with no indentation, their cumulative times add up to the total
+    total_us = sum(cumulative for _, cumulative, module in rows if not module.startswith('  '))
+    print(f"\n{entry}: {total_us / 1000:.1f} ms, {len(rows)} modules")
+    if error is not None:
+        print(f"  FAILED: {error}")
+    print(f"  {'self ms':>9} {'cumul ms':>9}  module")
+    for self_us, cumulative_us, module in sorted(rows, key=lambda r: r[1], reverse=True)[:top]:
+        print(f"  {self_us / 1000:9.1f} {cumulative_us / 1000:9.1f}  {module.strip()}")
+    return total_us / 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('entries', nargs='*', help='Scripts (.py) or dotted module names to measure.')
+    parser.add_argument('--top', type=int, default=15, help='Number of modules to list per entry point.')
+    parser.add_argument('--budget-ms', type=float, default=None, help='Exit with status 1 if any entry point exceeds this.')
+    args = parser.parse_args()
+
+    entries = args.entries
+    if not entries:
+        entries = ENTRY_SCRIPTS + [e.split(':')[0] for e in list(registry.SOURCES.values()) + list(registry.SINKS.values())]
+
+    startup_modules = {module.strip() for _, _, module in measure(None)[0]}
+
+    over_budget = []
+    for entry in entries:
+        total_ms = report(entry, args.top, startup_modules)
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(f"{entry} ({total_ms:.1f} ms)")
+
+    if over_budget:
+        print(f"\nOver the {args.budget_ms} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
@@ -1,17 +1,22 @@
 """ 
 Process that mimics the data aggregation layer by publishing previous run data from a text file
 where each line is a JSON string.
+With seek only a window of the run is replayed, located with the log's sidecar index (app/lib/log_index.py) when it has
+one instead of reading the log from the start.
 """
 
 from multiprocessing import Process, Queue
-from time import sleep
+from time import sleep, time
 import paho.mqtt.publish as publish
 from paho.mqtt.client import MQTTv5
+from app.lib.log_index import read_window
+from app.lib.sharding import Router
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
 import json, logging, signal
 
 
 class JsonToRaw(Process):
-    def __init__(self, client_id: str, topic_pub: str, json_path: str, hz: int, queue: Queue):
+    def __init__(self, client_id: str, topic_pub: str, json_path: str, hz: int, queue: Queue, transport: dict = None, seek: dict = None, partitions: int = None, profiling: dict = None):
         """
         Args:
             client_id (str): Mosquitto client id
@@ -19,6 +24,12 @@ class JsonToRaw(Process):
             csv_path (str): Full path to text file with previous json run data.
             hz (int): Hz that the previous data was generated at.
             queue (multiprocessing Queue): Allows for communication with parent process.
+            transport (dict, optional): Transport profile, only its qos is used. Defaults to None (qos 1).
+            seek (dict, optional): Window to replay, the keyword arguments of log_index.read_window: start, end, seq
+            and max_records. Defaults to None, the whole run.
+            partitions (int, optional): Partitions of topic_pub when the raw stage is sharded, each record is published
+            to the partition of its asset_id. Defaults to None.
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
         """
         Process.__init__(self)
         self.client_id = client_id
@@ -26,31 +37,40 @@ class JsonToRaw(Process):
         self.json_path = json_path
         self.hz = hz
         self.queue = queue
+        self.qos = transport["qos"] if transport is not None else 1
+        self.seek = seek or {}
+        self.router = Router(topic_pub, partitions)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
         self.logger = logging.getLogger('app')
 
     def run(self):
         try:
             signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
 
             self.logger.debug('Process Started')
             
-            self.json_file = open(self.json_path, 'r')
-            self.logger.info(f"STREAMING LEGACY DATA FROM: {self.json_path}")
+            self.records = read_window(self.json_path, **self.seek)
+            self.logger.info(f"STREAMING LEGACY DATA FROM: {self.json_path} {self.seek or ''}")
             
-            for line in self.json_file:
-                data = json.loads(line)
+            run = int(time() * 1000)
+            for seq, data in enumerate(self.records, 1):
+                # Logged records carry the seq and run they were recorded with, a replay is a new run
+                data["seq"] = seq
+                data["run"] = run
                 publish.single(
-                    topic=self.topic_pub,
+                    topic=self.router.topic(data.get("asset_id")),
                     payload=json.dumps(data),
                     hostname="localhost",
                     port=1883,
-                    qos=1,
+                    qos=self.qos,
                     protocol=MQTTv5
                 )
 
                 sleep((1 / self.hz))
                 
-            self.json_file.close()
             self.logger.info('FINISHED SENDING DATA.')
             self.logger.debug('Process Ended')
             self.queue.put_nowait(True)
@@ -58,11 +78,11 @@ class JsonToRaw(Process):
         
         except Exception as e:
             self.logger.error(e, exc_info=True)
-            self.json_file.close()
+            self.records.close()
             
         
     def interrupt_handler(self, signum, frame):
         self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
-        self.json_file.close()
+        self.records.close()
         self.logger.debug('Process Ended')
         exit(0)
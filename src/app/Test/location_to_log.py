@@ -1,42 +1,78 @@
 """ 
 This optional process logs the output of the transformation layer (the messages in the Data/location topic) to a 
 specified log file.
+When the stages publish delta payloads, the topics of the earlier stages are given with reassemble_topics and the full
+record of each reading is rebuilt from the parts published by every stage before it is logged.
+The sidecar index of app/lib/log_index.py is kept up to date as records are written, so a time range of the log can be
+replayed or exported without reading it from the start.
 """
 
 from multiprocessing import Process
+from functools import partial
 import app.lib.message_handler as message_handler
+from app.lib.messages import Reassembler
+from app.lib.log_index import IndexWriter
+from app.lib.metrics import DEFAULT_METRICS, StageMetrics
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
 from sys import exit
 import json, logging, signal, time
 
 class LocationToLog(Process):
-    def __init__(self, client_id:str, topic_sub:str, log_path:str):
+    def __init__(self, client_id:str, topic_sub:str, log_path:str, control_queue=None, transport:dict=None, reassemble_topics:list=None, index_every:int=1000, metrics:dict=None, profiling:dict=None):
         """
         Args:
             client_id (str): Name of this process for use by Mosquitto msg broker.\n
             topic_sub (str): Broker topic to subscribe to.\n
-            log_path (str): Location to save log file too.
+            log_path (str): Location to save log file too.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            reassemble_topics (list, optional): Topics of the stages before topic_sub, in pipeline order, e.g.
+            ["Data/raw", "Data/linear"]. Their delta payloads are merged with topic_sub's into full records. Defaults to None.\n
+            index_every (int, optional): Records between entries of the log's sidecar index, 0 for no index. Defaults to 1000.\n
+            metrics (dict, optional): Counters, timings and resource usage reporting, see app.lib.metrics. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
         """
         Process.__init__(self)
         self.client_id = client_id
         self.topic_sub = topic_sub
         self.log_path = log_path
+        self.control_queue = control_queue
+        self.transport = transport
+        self.reassemble_topics = reassemble_topics or []
+        self.index_every = index_every
+        self.metrics_config = dict(DEFAULT_METRICS)
+        if metrics is not None:
+            self.metrics_config.update(metrics)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
         self.logger = logging.getLogger('app')
         
     def run(self):
         try:
             # Setup interrupt signal handler
             signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
             self.logger.debug('Process Started')
             
-            # Open file for writing
+            # Open file for writing, and its index
+            self.index = IndexWriter(self.log_path, self.index_every) if self.index_every else None
             self.log_file = open(self.log_path, 'a+')
             
             # Setup message handler
-            self.handler = message_handler.Handler(self.client_id, self.topic_sub)
-            self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            topics = self.reassemble_topics + [self.topic_sub]
+            self.reassembler = Reassembler(len(topics))
+            self.handler = message_handler.Handler(self.client_id, topics, on_ready=self.ready, transport=self.transport)
+            self.metrics = StageMetrics(self.client_id, self.handler, **self.metrics_config)
+            if self.reassemble_topics:
+                for stage, topic in enumerate(topics):
+                    self.handler.client.message_callback_add(topic, partial(self.on_part, stage))
+            else:
+                self.handler.client.message_callback_add(self.topic_sub, self.on_message)
             
             # Start event loop
             self.handler.connect()
+            self.metrics.start()
             self.handler.loop()
             
         except Exception as e:
@@ -46,15 +82,47 @@ class LocationToLog(Process):
             exit(1)
         
     def on_message(self, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
         data = json.loads(msg.payload)
-        self.log_file.write(json.dumps(data))
-        self.log_file.write('\n')
-        
-        
+        if start:
+            start = self.metrics.decode_time.since(start)
+        self.write(data)
+        if start:
+            self.metrics.process_time.since(start)
+
+    def on_part(self, stage, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
+        data = json.loads(msg.payload)
+        if start:
+            start = self.metrics.decode_time.since(start)
+        for record in self.reassembler.add(stage, data):
+            self.write(record)
+        if start:
+            self.metrics.process_time.since(start)
+
+    def write(self, record: dict):
+        self.metrics.processed += 1
+        line = json.dumps(record) + '\n'
+        self.log_file.write(line)
+        if self.index is not None:
+            self.index.record(line, record)
+
+
     def interrupt_handler(self, signum, frame):
         self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
         self.handler.client.disconnect()
+        for record in self.reassembler.flush():
+            self.write(record)
         self.log_file.close()
+        if self.index is not None:
+            self.index.close()
         self.logger.debug('Process Ended')
         time.sleep(1)
-        exit(0)
\ No newline at end of file
+        exit(0)
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
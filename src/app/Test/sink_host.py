@@ -0,0 +1,152 @@
+"""
+Hosts several sinks in one process on a single asyncio event loop and broker connection, see
+app/lib/async_message_handler.py. Registered as the async_log sink: it always runs LogSink, the asyncio counterpart of
+LocationToLog, and any extra sinks listed in hosted_sinks.
+
+A hosted sink is a class constructed with (handler, **options) that has:
+- async start(): subscribes with handler.subscribe(), offloading heavy work with handler.run_in_executor().
+- async close(): called on shutdown.
+"""
+
+from multiprocessing import Process
+from sys import exit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from importlib import import_module
+from app.lib.async_message_handler import AsyncHandler
+from app.lib.messages import Reassembler
+from app.lib.log_index import IndexWriter
+from app.lib.metrics import DEFAULT_METRICS, StageMetrics
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+import asyncio, json, logging, signal
+
+
+class LogSink:
+    """Logs the messages of topic_sub to a file, reassembling the records of delta payloads like LocationToLog."""
+
+    def __init__(self, handler: AsyncHandler, topic_sub: str, log_path: str, reassemble_topics: list = None, index_every: int = 1000,
+                 metrics: StageMetrics = None):
+        self.handler = handler
+        self.topics = (reassemble_topics or []) + [topic_sub]
+        self.log_path = log_path
+        self.index_every = index_every
+        self.reassembler = Reassembler(len(self.topics))
+        self.metrics = metrics if metrics is not None else StageMetrics(topic_sub, enabled=False)
+
+    async def start(self):
+        self.index = IndexWriter(self.log_path, self.index_every) if self.index_every else None
+        self.log_file = open(self.log_path, 'a+')
+        await asyncio.gather(*(self.handler.subscribe(topic, partial(self.on_part, stage))
+                               for stage, topic in enumerate(self.topics)))
+
+    def on_part(self, stage, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
+        data = json.loads(msg.payload)
+        if start:
+            start = self.metrics.decode_time.since(start)
+        for record in self.reassembler.add(stage, data):
+            self.write(record)
+        if start:
+            self.metrics.process_time.since(start)
+
+    def write(self, record: dict):
+        self.metrics.processed += 1
+        line = json.dumps(record) + '\n'
+        self.log_file.write(line)
+        if self.index is not None:
+            self.index.record(line, record)
+
+    async def close(self):
+        for record in self.reassembler.flush():
+            self.write(record)
+        self.log_file.close()
+        if self.index is not None:
+            self.index.close()
+
+
+class SinkHost(Process):
+    def __init__(self, client_id:str, topic_sub:str, log_path:str, control_queue=None, transport:dict=None, reassemble_topics:list=None,
+                 hosted_sinks:list=None, executor:str="thread", workers:int=2, index_every:int=1000, metrics:dict=None, profiling:dict=None):
+        """
+        Args:
+            client_id (str): Name of this process for use by Mosquitto msg broker.\n
+            topic_sub (str): Broker topic the LogSink logs.\n
+            log_path (str): Location to save log file too.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process every sink is subscribed. Defaults to None.\n
+            transport (dict, optional): Transport profile for the shared connection. Defaults to None.\n
+            reassemble_topics (list, optional): Topics of the stages before topic_sub, see LocationToLog. Defaults to None.\n
+            hosted_sinks (list, optional): Extra sinks, each {"sink": "module:Class", **options}. Defaults to None.\n
+            executor (str, optional): thread | process, pool used for work offloaded by the sinks. Defaults to "thread".\n
+            workers (int, optional): Size of the pool. Defaults to 2.\n
+            index_every (int, optional): Records between entries of the log's sidecar index, 0 for no index. Defaults to 1000.\n
+            metrics (dict, optional): Counters, timings and resource usage reporting of the LogSink and the process, see
+            app.lib.metrics. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
+        Process.__init__(self)
+        self.client_id = client_id
+        self.topic_sub = topic_sub
+        self.log_path = log_path
+        self.control_queue = control_queue
+        self.transport = transport
+        self.reassemble_topics = reassemble_topics
+        self.hosted_sinks = hosted_sinks or []
+        self.executor = executor
+        self.workers = workers
+        self.index_every = index_every
+        self.metrics_config = dict(DEFAULT_METRICS)
+        if metrics is not None:
+            self.metrics_config.update(metrics)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
+        self.logger = logging.getLogger('app')
+
+    def run(self):
+        try:
+            self.logger.debug('Process Started')
+            asyncio.run(self.main())
+            self.logger.debug('Process Ended')
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            exit(1)
+
+    async def main(self):
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        SamplingProfiler(self.client_id, **self.profiling_config).install()
+
+        pool = ProcessPoolExecutor(self.workers) if self.executor == "process" else ThreadPoolExecutor(self.workers)
+        self.handler = AsyncHandler(self.client_id, transport=self.transport, executor=pool)
+        self.metrics = StageMetrics(self.client_id, self.handler, **self.metrics_config)
+        self.sinks = [LogSink(self.handler, self.topic_sub, self.log_path, self.reassemble_topics, self.index_every, self.metrics)]
+        for config in self.hosted_sinks:
+            options = dict(config)
+            module_name, class_name = options.pop("sink").split(':')
+            self.sinks.append(getattr(import_module(module_name), class_name)(self.handler, **options))
+
+        await self.handler.connect()
+        await asyncio.gather(*(sink.start() for sink in self.sinks))
+        self.ready()
+        # Published from the event loop, paho's client is driven by it and not thread safe
+        reporter = asyncio.create_task(self.report_metrics()) if self.metrics.enabled else None
+
+        await stop.wait()
+        if reporter is not None:
+            reporter.cancel()
+        self.logger.debug(f'Handling signal {signal.SIGTERM.value} ({signal.SIGTERM.name}).')
+        for sink in self.sinks:
+            await sink.close()
+        await self.handler.disconnect()
+        pool.shutdown()
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics.interval)
+            self.metrics.report()
+
+    def ready(self):
+        "Tells the parent process every hosted sink is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
@@ -0,0 +1,49 @@
+"""
+Tests that Transformer and Tracking process readings in steady state without heap allocations. Run from the src folder: python3 -m pytest app/Test
+"""
+
+import random
+import tracemalloc
+import pytest
+from app.lib.messages import Message
+from app.Transformation.raw_to_linear import Transformer
+from app.Transformation.linear_to_location import Tracking
+
+
+@pytest.mark.parametrize("gap_strategy", ["hold", "interpolate", "reset"])
+def test_steady_state_does_not_allocate(gap_strategy):
+    warmup = 1000
+    # Turns, straight stretches (equal wheels), spins and stops, with a missing reading every 50
+    rng = random.Random(0)
+    readings = []
+    for i in range(warmup + 5000):
+        left = rng.uniform(-200, 200)
+        kind = i % 4
+        right = left if kind == 1 else -left if kind == 2 else 0.0 if kind == 3 else rng.uniform(-200, 200)
+        readings.append((left, right, i / 25, 1 if i % 50 == 0 else 0))
+
+    # One reused payload: the floats of the previous output are released as the new ones are written, so only
+    # allocations beyond the output are counted
+    data = Message("D2:25:5D:F8:2C:F3", "DE:C8:99:45:BC:03").payload
+    transformer = Transformer(609.6, 0, gap_strategy=gap_strategy)
+    tracking = Tracking(549.0, 0)
+
+    allocating = []
+    tracemalloc.start()
+    try:
+        # The warm up readings go through the same measuring loop, so the loop's own first allocations are not counted
+        for i, (left, right, timestamp, gap) in enumerate(readings):
+            data["LSensor"]["gyroZ"] = left
+            data["RSensor"]["gyroZ"] = right
+            data["LSensor"]["timestamp"] = data["RSensor"]["timestamp"] = timestamp
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            transformer.transform(data, gap)
+            tracking.track(data)
+            allocated = tracemalloc.get_traced_memory()[1] - before
+            if allocated > 0 and i >= warmup:
+                allocating.append((i, allocated))
+    finally:
+        tracemalloc.stop()
+
+    assert allocating == []
@@ -0,0 +1,83 @@
+"""
+Tests of the StageQueue overload policies. Run from the src folder: python3 -m pytest app/Test
+"""
+
+import json
+from types import SimpleNamespace
+import threading
+from app.lib.backpressure import StageQueue
+from app.lib.metrics import StageMetrics
+from app.Transformation.linear_to_location_msg_handler import LinearProcess, merge_linear
+
+
+def linear(asset_id, lw_dis, rw_dis):
+    return {"asset_id": asset_id, "LW_dis": lw_dis, "RW_dis": rw_dis}
+
+
+def drain(queue):
+    items = []
+    while queue.depth():
+        items.append(queue.get(timeout=0)[1])
+        queue.task_done()
+    return items
+
+
+def test_coalesce_keeps_assets_apart():
+    queue = StageQueue(10, "coalesce", merge_linear)
+    for data in (linear("A", 100.0, 90.0), linear("B", 5.0, 4.0)):
+        queue.put(data["asset_id"], data)
+
+    items = drain(queue)
+    assert [(data["asset_id"], data["LW_dis"], data["RW_dis"]) for data in items] == [("A", 100.0, 90.0), ("B", 5.0, 4.0)]
+    assert queue.coalesced == 0
+
+
+def test_coalesce_sums_distances_per_asset():
+    queue = StageQueue(10, "coalesce", merge_linear)
+    for data in (linear("A", 100.0, 90.0), linear("B", 5.0, 4.0), linear("A", 1.0, 2.0), linear("B", 3.0, 3.0)):
+        queue.put(data["asset_id"], data)
+
+    items = drain(queue)
+    assert [(data["asset_id"], data["LW_dis"], data["RW_dis"]) for data in items] == [("A", 101.0, 92.0), ("B", 8.0, 7.0)]
+    assert queue.coalesced == 2
+
+
+def test_stage_coalesces_shared_topic_per_asset():
+    # Every asset publishes on the same topic, the stage must not fold one asset's distances into another's
+    stage = LinearProcess("linear", "Data/linear", "Data/location", 549.0, 0)
+    stage.metrics = StageMetrics("linear", enabled=False)
+    stage.shards = None
+    stage.queue = StageQueue(10, "coalesce", merge_linear)
+    for data in (linear("A", 100.0, 90.0), linear("B", 5.0, 4.0)):
+        stage.on_message(None, None, SimpleNamespace(topic="Data/linear", payload=json.dumps(data)))
+
+    items = drain(stage.queue)
+    assert [(data["asset_id"], data["LW_dis"], data["RW_dis"]) for data in items] == [("A", 100.0, 90.0), ("B", 5.0, 4.0)]
+
+
+def test_drain_returns_under_steady_traffic():
+    # A consumer that keeps the queue non empty: join() would not return, drain() waits for the earlier messages only
+    queue = StageQueue(10, "block")
+    queue.put("A", linear("A", 1.0, 1.0))
+    processed = []
+    stop = threading.Event()
+
+    def consumer():
+        while not stop.is_set():
+            item = queue.get(timeout=0.1)
+            if item is None:
+                continue
+            processed.append(item[1]["asset_id"])
+            queue.put("B", linear("B", 1.0, 1.0))
+            queue.task_done()
+
+    thread = threading.Thread(target=consumer, daemon=True)
+    thread.start()
+    try:
+        assert queue.drain(2)
+        assert processed[0] == "A"
+        # A later message is still queued or being processed
+        assert queue.unfinished >= 1
+    finally:
+        stop.set()
+        thread.join()
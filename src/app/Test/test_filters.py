@@ -0,0 +1,119 @@
+"""
+Tests of the filter chain's batch variants against the per value updates. Run from the src folder: python3 -m pytest app/Test
+"""
+
+import numpy as np
+from app.lib.filters import Complementary, DpsFilter, Ema, Kalman, Median, MovingAverage
+
+VALUES = [5.0, -1.0, 30.0, 2.0, 2.5, -7.0, 4.0, 0.5, -250.0, 90.0, 1.0, -2.0]
+
+
+def baseline_dps_filter(gyroDPS, wheel):
+    "raw_to_linear.Transformer.dps_filter before the filter chain, with its default parameters."
+    CUT = 1.0
+    CUT_multiplier = 2
+    factor = 0.4
+    percentage = 0.0045
+    expoL = 2
+    expoR = 2
+
+    final_dps_ = 0.0
+
+    # LOW BANDWIDTH FILTER
+    if abs(gyroDPS) > CUT:
+        final_dps_ = gyroDPS
+
+    # SENSOR DIFFERENCE FILTER
+    if abs(gyroDPS) > (CUT * CUT_multiplier):
+        # augmented 1/X applies more correction to slow-moving wheels
+        if "left" in wheel:
+            final_dps_ += ((CUT + factor) ** expoL / final_dps_)
+            final_dps_ -= (final_dps_ * percentage)
+        if "right" in wheel:
+            final_dps_ += ((CUT + factor) ** expoR / final_dps_)
+            final_dps_ += (final_dps_ * percentage)
+
+    return final_dps_
+
+
+def wheel_samples(values, dt=0.04):
+    "The accelerometer and timestamp fields of a wheel turning at values DPS."
+    angles = np.radians(np.cumsum(np.asarray(values) * dt))
+    return {"accX": np.cos(angles), "accY": -np.sin(angles), "timestamp": np.arange(1, len(values) + 1) * dt}
+
+
+def split(samples, start, stop):
+    return {key: column[start:stop] for key, column in samples.items()}
+
+
+def streamed(f, values, samples=None):
+    if samples is None:
+        return [f.update(value) for value in values]
+    return [f.update(value, {key: float(column[i]) for key, column in samples.items()}) for i, value in
+            enumerate(values)]
+
+
+def assert_batch_matches_update(make, values=VALUES, samples=None):
+    expected = make()
+    batched = make()
+    # The first batch starts from the initial state, the next ones from the state the previous one left behind
+    bounds = [0, 2, len(values) // 2, len(values)]
+    out = np.concatenate([batched.batch(values[start:stop], samples and split(samples, start, stop))
+                          for start, stop in zip(bounds, bounds[1:])])
+    np.testing.assert_allclose(out, streamed(expected, values, samples), rtol=1e-9, atol=1e-9)
+
+
+def assert_reset_restarts(make, values=VALUES, samples=None):
+    fresh = streamed(make(), values, samples)
+    f = make()
+    streamed(f, values, samples)
+    f.reset()
+    assert streamed(f, values, samples) == fresh
+    f.reset()
+    np.testing.assert_allclose(f.batch(values, samples), fresh, rtol=1e-9, atol=1e-9)
+
+
+def test_median_batch_matches_update():
+    values = [5.0, -1.0, 30.0, 2.0, 2.5, -7.0, 4.0]
+    for k in (1, 2, 3, 5):
+        expected = Median(k)
+        batched = Median(k)
+        # A first batch fills the window, the second one starts from a full window
+        out = np.concatenate([batched.batch(values[:4]), batched.batch(values[4:])])
+        assert out.tolist() == [expected.update(value) for value in values]
+
+
+def test_dps_matches_baseline_transformer():
+    for wheel in ("left", "right"):
+        expected = [baseline_dps_filter(value, wheel) for value in VALUES]
+        assert streamed(DpsFilter(wheel), VALUES) == expected
+        np.testing.assert_allclose(DpsFilter(wheel).batch(VALUES), expected, rtol=1e-12)
+
+
+def test_moving_average_batch_matches_update():
+    for k in (1, 3, 5, 20):
+        assert_batch_matches_update(lambda: MovingAverage(k))
+        assert_reset_restarts(lambda: MovingAverage(k))
+
+
+def test_ema_batch_matches_update():
+    for alpha in (0.1, 0.5, 1.0):
+        assert_batch_matches_update(lambda: Ema(alpha))
+        assert_reset_restarts(lambda: Ema(alpha))
+
+
+def test_kalman_batch_matches_update():
+    assert_batch_matches_update(Kalman)
+    assert_batch_matches_update(lambda: Kalman(q=0.01, r=10.0))
+    assert_reset_restarts(Kalman)
+
+
+def test_complementary_batch_matches_update():
+    samples = wheel_samples(VALUES)
+    assert_batch_matches_update(Complementary, samples=samples)
+    assert_batch_matches_update(lambda: Complementary(0.5), samples=samples)
+    assert_reset_restarts(Complementary, samples=samples)
+    # Without the accelerometer values pass through
+    assert_batch_matches_update(Complementary, samples=dict(samples, accX=np.zeros(len(VALUES)),
+                                                            accY=np.zeros(len(VALUES))))
+    assert Complementary().batch(VALUES).tolist() == VALUES
@@ -0,0 +1,38 @@
+"""
+Tests of the data processor graph Sensor.setup() builds, against the fake libmetawear. Run from the src folder:
+python3 -m pytest app/Test
+"""
+
+import logging
+from threading import Condition
+import pytest
+import app.Aggregator.sensors as sensors
+from app.Test.fake_metawear import FakeBindings, FakeDevice, FakeLibMetaWear
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    # setup() waits for the board after setting the connection parameters
+    monkeypatch.setattr(sensors, "sleep", lambda seconds: None)
+
+
+def set_up(**sampling):
+    lib = FakeLibMetaWear()
+    sensor = sensors.Sensor(FakeDevice(), Condition(), None, 'LSensor', None, logging.getLogger('app'), lib=lib,
+                            bindings=FakeBindings, **sampling)
+    sensor.setup()
+    return lib
+
+
+def test_default_sampling_fuses_acc_and_gyro():
+    lib = set_up()
+    assert lib.processor_graph() == [('fuser', 'acc', (['gyro'], 1))]
+    assert lib.subscribed == ['fuser#1']
+
+
+def test_decimated_sampling():
+    lib = set_up(odr_hz=100, gyro_only=True, averaging_depth=4, decimate_ms=40)
+    assert lib.processor_graph() == [('lowpass', 'gyro', (4,)), ('time', 'lowpass#1', (FakeBindings.TimeMode.ABSOLUTE, 40))]
+    assert lib.subscribed == ['time#2']
+    assert lib.called('mbl_mw_gyro_bmi270_set_odr') == [(1, FakeBindings.GyroBoschOdr._100Hz)]
+    assert lib.called('mbl_mw_acc_bmi270_set_odr') == []
@@ -0,0 +1,230 @@
+"""
+Tests of the partitioning and of the membership, claim and handoff protocol of sharded workers, against an in memory
+broker. Run from the src folder: python3 -m pytest app/Test
+"""
+
+import json
+import threading
+import time
+import zlib
+from collections import deque
+from types import SimpleNamespace
+from paho.mqtt.client import topic_matches_sub
+from app.lib.backpressure import StageQueue
+from app.lib.sharding import HashRing, Router, ShardMember, partition_of
+from app.Transformation.raw_to_linear_msg_handler import RawProcess
+
+
+def test_partition_of_is_crc32():
+    # The same partition in every process and on every host, unlike hash()
+    for asset_id in ("D2:25:5D:F8:2C:F3", "chair-7", 42):
+        assert partition_of(asset_id, 64) == zlib.crc32(str(asset_id).encode()) % 64
+    assert Router("Data/raw", 64).topic("chair-7") == f"Data/raw/{partition_of('chair-7', 64)}"
+    assert Router("Data/raw").topic("chair-7") == "Data/raw"
+
+
+def test_hash_ring_moves_partitions_only_to_the_new_worker():
+    before = HashRing([f"raw-{i}" for i in range(4)]).assignment(256)
+    after = HashRing([f"raw-{i}" for i in range(5)]).assignment(256)
+    moved = [p for p in range(256) if before[p] != after[p]]
+
+    assert all(after[p] == "raw-4" for p in moved)
+    # About 1/5 of the partitions
+    assert 256 // 10 < len(moved) < 256 // 2
+
+
+class FakeBroker:
+    """Delivers published messages to the subscribed clients when pumped, from the test's thread like paho's network
+    thread. Publishes from other threads (the handoff threads) are queued the same way."""
+
+    def __init__(self):
+        self.events = deque()
+        self.retained = {}
+        self.handlers = []
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if retain:
+            self.retained[topic] = payload
+        for handler in self.handlers:
+            if any(topic_matches_sub(sub, topic) for sub in handler.subscriptions):
+                self.events.append(lambda handler=handler: handler.deliver(topic, payload))
+
+    def pump(self, until, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not until():
+            if time.monotonic() > deadline:
+                raise TimeoutError("broker pumped until the timeout")
+            if self.events:
+                self.events.popleft()()
+            else:
+                time.sleep(0.005)
+
+
+class FakeClient:
+    def __init__(self, broker):
+        self.broker = broker
+        self.callbacks = []
+        self.will = None
+
+    def will_set(self, topic, payload, qos=0, retain=False):
+        self.will = (topic, payload, retain)
+
+    def message_callback_add(self, sub, callback):
+        self.callbacks.append((sub, callback))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.broker.publish(topic, payload, retain)
+
+    def disconnect(self, reasoncode=None):
+        self.broker.publish(*self.will)
+
+
+class FakeHandler:
+    """The parts of message_handler.Handler ShardMember uses. Acknowledgements are delivered like messages."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.client = FakeClient(broker)
+        self.subscriptions = set()
+        self.topic_sub = None
+        self.on_ready = None
+        broker.handlers.append(self)
+
+    def connect(self):
+        self.subscribe(self.topic_sub, lambda reason_codes: self.on_ready())
+
+    def subscribe(self, topics, callback=None):
+        self.subscriptions.update(topics)
+        for topic, payload in list(self.broker.retained.items()):
+            if payload and any(topic_matches_sub(sub, topic) for sub in topics):
+                self.broker.events.append(lambda topic=topic, payload=payload: self.deliver(topic, payload))
+        if callback is not None:
+            self.broker.events.append(lambda: callback([0] * len(topics)))
+
+    def unsubscribe(self, topics, callback=None):
+        self.subscriptions.difference_update(topics)
+        if callback is not None:
+            self.broker.events.append(callback)
+
+    def deliver(self, topic, payload):
+        for sub, callback in self.client.callbacks:
+            if topic_matches_sub(sub, topic):
+                callback(self.client, None, SimpleNamespace(topic=topic, payload=payload))
+                return
+
+
+class Worker:
+    """A sharded stage reduced to counting the messages of each asset on a processing thread, which waits for go."""
+
+    def __init__(self, broker, name, sharding):
+        self.queue = StageQueue(1000)
+        self.counts = {}
+        self.adopted = {}
+        self.lock = threading.Lock()
+        self.go = threading.Event()
+        self.handler = FakeHandler(broker)
+        self.member = ShardMember("raw", name, "Data/raw", sharding, self.handler, self.queue, self.release, self.adopt,
+                                  lambda: {})
+        self.handler.client.message_callback_add("Data/raw/+", self.on_message)
+        threading.Thread(target=self.process_loop, daemon=True).start()
+
+    def on_message(self, client, userdata, msg):
+        data = json.loads(msg.payload)
+        if self.member.accept(msg.topic, data):
+            self.queue.put(data["asset_id"], data)
+
+    def process_loop(self):
+        while not self.queue.closed:
+            item = self.queue.get(timeout=0.1)
+            if item is None:
+                continue
+            self.go.wait()
+            with self.lock:
+                asset_id = item[1]["asset_id"]
+                self.counts[asset_id] = self.counts.get(asset_id, 0) + 1
+            self.queue.task_done()
+
+    def release(self, partition):
+        with self.lock:
+            return {asset_id: {"count": self.counts.pop(asset_id)} for asset_id in list(self.counts)
+                    if partition_of(asset_id, 8) == partition}
+
+    def adopt(self, states, handed_off=False):
+        with self.lock:
+            for asset_id, state in states.items():
+                self.adopted[asset_id] = (state, handed_off)
+                self.counts[asset_id] = state["count"]
+
+
+def publish_readings(broker, assets, seqs):
+    for seq in seqs:
+        for asset_id in assets:
+            broker.publish(Router("Data/raw", 8).topic(asset_id), json.dumps({"asset_id": asset_id, "seq": seq}))
+
+
+def test_partition_released_with_queued_messages_is_handed_off():
+    broker = FakeBroker()
+    sharding = {"workers": 2, "partitions": 8, "replicas": 16, "control_topic": "Control/shards", "handoff_timeout": 5.0}
+    assets = [f"chair-{i}" for i in range(20)]
+    a = Worker(broker, "raw-0", sharding)
+    a.go.set()
+    a.handler.connect()
+    broker.pump(lambda: len(a.member.owned) == 8 and not a.member.subscribing)
+
+    # raw-0 owns every partition, its processing thread holds back while raw-1 joins
+    a.go.clear()
+    publish_readings(broker, assets, range(1, 6))
+    broker.pump(lambda: not broker.events)
+    b = Worker(broker, "raw-1", sharding)
+    b.go.set()
+    b.handler.connect()
+    # raw-1 waits for the handoffs, raw-0 got the UNSUBACKs and dropped the partitions while its queue is still full:
+    # the broker thread went on while the handoffs wait for the queue
+    broker.pump(lambda: not broker.events and b.member.pending and a.member.owned.isdisjoint(b.member.owned))
+    assert a.queue.depth() > 0
+    assert not b.adopted
+
+    a.go.set()
+    broker.pump(lambda: a.member.is_ready and b.member.is_ready)
+
+    moved = [asset_id for asset_id in assets if partition_of(asset_id, 8) in b.member.owned]
+    assert moved
+    assert a.member.owned | b.member.owned == set(range(8))
+    # Every message queued at raw-0 before the handoff was counted in the state handed to raw-1
+    assert {asset_id: b.adopted[asset_id] for asset_id in moved} == {asset_id: ({"count": 5}, True) for asset_id in moved}
+    assert set(a.counts) == set(assets) - set(moved)
+
+    # Later messages of the moved assets only reach raw-1
+    publish_readings(broker, assets, [6])
+    broker.pump(lambda: not broker.events)
+    a.queue.join(1)
+    b.queue.join(1)
+    assert all(b.counts[asset_id] == 6 for asset_id in moved)
+    assert all(a.counts[asset_id] == 6 for asset_id in set(assets) - set(moved))
+    a.queue.close()
+    b.queue.close()
+
+
+def test_handed_off_state_keeps_sequence_however_old():
+    # A handoff is applied at the asset's next reading, usually later than max_delay, its source kept running
+    sender = RawProcess("raw", "Data/raw", "Data/linear", 609.6, 0)
+    sender.assets, sender.restored, sender.handed_off = {}, {}, set()
+    transformer, resequencer = sender.asset("A")
+    for seq in range(1, 11):
+        reading = {"asset_id": "A", "seq": seq, "run": 1, "LSensor": {"gyroZ": 90.0, "timestamp": seq / 25},
+                   "RSensor": {"gyroZ": 90.0, "timestamp": seq / 25}}
+        for data, gap in resequencer.push(reading):
+            transformer.transform(data, gap)
+    state = dict(sender.asset_state(transformer, resequencer), unix_timestamp=time.time() - 60)
+
+    receiver = RawProcess("raw", "Data/raw", "Data/linear", 609.6, 0)
+    receiver.assets, receiver.restored, receiver.handed_off = {}, {}, set()
+    receiver.lock = threading.Lock()
+    receiver.adopt({"A": state}, handed_off=True)
+    transformer, resequencer = receiver.asset("A")
+
+    assert resequencer.next_seq == 11
+    assert transformer.started
+    assert receiver.handed_off == set()
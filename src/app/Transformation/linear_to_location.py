@@ -1,47 +1,52 @@
 # Class for transforming linear wheel distance data into x, y location data.
 
-from app.lib.filters import Filters
+from app.lib import filters
 import math
 
 class Tracking():
-    def __init__(self, axle_length, filter_version):
+    # Fixed attribute set, a reading is tracked without building containers
+    __slots__ = ("axle_length", "filter_version", "filter_chain", "filters", "left_filter", "right_filter", "x", "y",
+                 "heading", "cached_heading", "heading_sin", "heading_cos")
+
+    def __init__(self, axle_length, filter_version, filter_chain=None):
         self.axle_length = axle_length
         self.filter_version = filter_version
-        # TODO: Add conditional statement based on filter_version to define what callbacks from Filter class to use in
-        # the track function.
-        self.callback1 = None  
+        # filters applied to each wheel's linear distance before tracking, see app.lib.filters
+        self.filter_chain = filter_chain or []
+        self.filters = {wheel: filters.build_chain(self.filter_chain, wheel) for wheel in ("left", "right")}
+        self.left_filter = self.filters["left"]
+        self.right_filter = self.filters["right"]
         # current x,y coordinates of asset
         self.x = 0
         self.y = 0 
         # current heading in radians
         self.heading = 0
+        # sin and cos of cached_heading, recomputed only when the heading changes
+        self.cached_heading = 0
+        self.heading_sin = 0.0
+        self.heading_cos = 1.0
+
+    def get_state(self):
+        '''Position and heading of the asset, see app.lib.checkpoint'''
+        return {"x": self.x, "y": self.y, "heading": self.heading}
 
-    def rotate(self, point: list, pivot: list, angle: float):
-        '''Helper method for the turn method. Rotates one point (point) around another point (pivot) by the specified angle (angle)'''
-        s = math.sin(angle)
-        c = math.cos(angle)
-        # translate the point such that pivot sits at the origin
-        point[0] -= pivot[0]
-        point[1] -= pivot[1]
-        # rotate
-        xnew = (point[0] * c) - (point[1] * s)
-        ynew = (point[0] * s) + (point[1] * c)
-        # translate back after rotation
-        point[0] = xnew + pivot[0]
-        point[1] = ynew + pivot[1]
-        return point
+    def set_state(self, state: dict):
+        '''Restores a state returned by get_state()'''
+        self.x = state["x"]
+        self.y = state["y"]
+        self.heading = state["heading"]
 
     def turn(self, LW_dis: float, RW_dis: float):
         '''Transforms linear distance of two wheels into x,y coordinates along with directional heading (in radians). Combines the generated data with the previously stored data, then updates instance variables x, y, and heading to reflect current location of asset on a cartesian plane relative to the original starting position.'''
         # stores the direction of turn (-1 for clockwise, 1 for counterclockwise)
         rotation = 0
         r_adj = 1  # 1 or -1, adjustment to radius calculation (determined by class of movement)
-        temp_xy = [0, 0] # generated coordinate prior to current heading adjustment
+        dx = 0  # generated coordinate prior to current heading adjustment
+        dy = 0
         inner = None  # distance traveled by inner wheel
         outer = None  # distance traveled by outer wheel
         turn_angle = 0  # angle of turn
-        radius = 0  # turn radius (calculated value will be negative or positive depending on class of movement)
-        turn_center = [0, 0]  # center point of turn
+        radius = 0  # turn radius (calculated value will be negative or positive depending on class of movement), the turn center is (radius, 0)
 
         # check if a turn is initiated
         if LW_dis != RW_dis:
@@ -99,33 +104,41 @@ class Tracking():
                 radius = r_adj * ((inner * self.axle_length / (outer - inner)) + (self.axle_length / 2))
                 turn_angle = rotation * \
                     (inner * (outer - inner)) / (inner * self.axle_length)
-            # set pivot
-            turn_center[0] = radius
-            temp_xy = self.rotate([0, 0], turn_center, turn_angle)
+            # rotate the origin around the turn center (radius, 0)
+            dx = radius - radius * math.cos(turn_angle)
+            dy = -radius * math.sin(turn_angle)
 
         # no turn detected - straight movement
         else:  # LW_dis == RW_dis :
-            temp_xy[0] = 0
-            temp_xy[1] = LW_dis
-        
+            dx = 0
+            dy = LW_dis
+
         # adjust rotation based on current heading
-        final = self.rotate(temp_xy, [0, 0], self.heading)
+        if self.heading != self.cached_heading:
+            self.cached_heading = self.heading
+            self.heading_sin = math.sin(self.heading)
+            self.heading_cos = math.cos(self.heading)
 
         # add new coordinates to previous coordinates
-        self.x += final[0]
-        self.y += final[1]
+        self.x += dx * self.heading_cos - dy * self.heading_sin
+        self.y += dx * self.heading_sin + dy * self.heading_cos
 
         # update heading
         self.heading += turn_angle
     
     def track(self, data):
-        if 'reset' in data and data["reset"] == True:
+        if data.get("reset") == True:
             self.x = 0
             self.y = 0 
             self.heading = 0
-            
+            self.left_filter.reset()
+            self.right_filter.reset()
+
         L_Dis = data.get("LW_dis")
         R_Dis = data.get("RW_dis")
+        if self.filter_chain:
+            L_Dis = data["LW_dis"] = self.left_filter.update(L_Dis, data)
+            R_Dis = data["RW_dis"] = self.right_filter.update(R_Dis, data)
         self.turn(L_Dis, R_Dis)
         data["x_loc"] = self.x
         data["y_loc"] = self.y
@@ -5,40 +5,130 @@ linear_to_location.Tracking class.
 
 from sys import exit
 from multiprocessing import Process
+from threading import Lock, Thread
 import app.lib.message_handler as message_handler
+import app.lib.backpressure as backpressure
+from app.lib.metrics import DEFAULT_METRICS, StageMetrics
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+from app.lib.checkpoint import Checkpoint, DEFAULT_CHECKPOINT
+from app.lib.sharding import DEFAULT_SHARDING, ShardMember, partition_of
 import app.Transformation.linear_to_location as linear_to_location
+from app.Transformation.map_matching import DEFAULT_MAP_MATCHING, MATCH_MODES, MapMatcher, load_grid
+from app.lib import messages
 import json, logging, time, signal
 
+# Fields produced by this stage, the only ones published in delta payload mode
+PUBLISHED_FIELDS = ("x_loc", "y_loc", "heading")
+
+
+def merge_linear(old: dict, new: dict):
+    """Coalesce merge for linear messages. The wheel distances are deltas, so the distances of a replaced message are
+    added to its successor instead of being lost."""
+    new["LW_dis"] += old["LW_dis"]
+    new["RW_dis"] += old["RW_dis"]
+    return backpressure.keep_reset(old, new)
+
 
 class LinearProcess(Process):
-    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, axle_length:float, filter_version:int):
+    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, axle_length:float, filter_version:int, control_queue=None, transport:dict=None, overload:dict=None, filter_chain:list=None, payload_mode:str="full", checkpoint:dict=None, map_matching:dict=None, sharding:dict=None, shard:int=None, metrics:dict=None, profiling:dict=None):
         """
         Args:
             client_id (str): Mosquitto client id.\n
             topic_sub (str): Broker topic to subscribe to.\n
             topic_pub (str): Broker topic to publish messages to.\n
             axle_length (float): The length in mm of the asset's axle.\n
-            filter_version (int): Deprecated.
+            filter_version (int): Deprecated.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            overload (dict, optional): Overload policy and lag metrics settings, see backpressure.DEFAULT_OVERLOAD. Defaults to None.\n
+            filter_chain (list, optional): Filter configs applied to each wheel, see app.lib.filters. Defaults to None.\n
+            payload_mode (str, optional): full | delta, see app.lib.messages. Defaults to "full".\n
+            checkpoint (dict, optional): Snapshot file and interval, see app.lib.checkpoint. Defaults to None.\n
+            map_matching (dict, optional): Floor plan constraint, see app.Transformation.map_matching. Defaults to None.\n
+            sharding (dict, optional): Worker count, partitions and handoff settings, see app.lib.sharding. Defaults to None.\n
+            shard (int, optional): Index of this worker when the stage is sharded, its client id is client_id-shard and it
+            only receives the assets of its partitions of topic_sub. Defaults to None, not sharded.\n
+            metrics (dict, optional): Counters, timings and resource usage reporting, see app.lib.metrics. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
         """
         Process.__init__(self)
-        self.client_id = client_id
+        self.stage_id = client_id
+        self.client_id = client_id if shard is None else f"{client_id}-{shard}"
         self.topic_sub = topic_sub
         self.topic_pub = topic_pub
         self.axle_length = axle_length
         self.filter_version = filter_version
+        self.control_queue = control_queue
+        self.transport = transport
+        self.overload = dict(backpressure.DEFAULT_OVERLOAD)
+        if overload is not None:
+            self.overload.update(overload)
+        self.filter_chain = filter_chain
+        if payload_mode not in messages.PAYLOAD_MODES:
+            raise ValueError(f'Payload mode "{payload_mode}" not supported. Accepted values are: {", ".join(messages.PAYLOAD_MODES)}')
+        self.payload_mode = payload_mode
+        # Filtered wheel distances are produced here too when the stage filters them
+        self.published_fields = PUBLISHED_FIELDS + (("LW_dis", "RW_dis") if filter_chain else ())
+        self.checkpoint_config = dict(DEFAULT_CHECKPOINT)
+        if checkpoint is not None:
+            self.checkpoint_config.update(checkpoint)
+        self.map_matching = dict(DEFAULT_MAP_MATCHING)
+        if map_matching is not None:
+            self.map_matching.update(map_matching)
+        if self.map_matching["mode"] not in MATCH_MODES:
+            raise ValueError(f'Map matching mode "{self.map_matching["mode"]}" not supported. Accepted values are: {", ".join(MATCH_MODES)}')
+        if self.map_matching["enabled"]:
+            # The dead reckoned location is published next to the matched one
+            self.published_fields += ("raw_x_loc", "raw_y_loc")
+        self.sharding = dict(DEFAULT_SHARDING)
+        if sharding is not None:
+            self.sharding.update(sharding)
+        self.shard = shard
+        self.metrics_config = dict(DEFAULT_METRICS)
+        if metrics is not None:
+            self.metrics_config.update(metrics)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
         self.logger = logging.getLogger('app')
 
     def run(self):
         try:
             # Setup interrupt signal handler
             signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
             
             self.logger.debug('Process Started')
         
-            # Create transformer and msg handler 
-            self.data_transformer = linear_to_location.Tracking(self.axle_length, self.filter_version)
-            self.handler = message_handler.Handler(self.client_id, self.topic_sub, self.topic_pub)
-            self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            # Trackers are created per asset as its first message arrives, from the last snapshot if there is one
+            self.trackers = {}
+            self.checkpoint = Checkpoint(self.checkpoint_config["path"], self.checkpoint_config["interval"], self.shard)
+            self.restored = self.checkpoint.load()
+            # Held by the processing thread per message, and while a sharded worker hands assets over
+            self.lock = Lock()
+            self.matcher = None
+            if self.map_matching["enabled"]:
+                grid = load_grid(self.map_matching["map_path"], self.map_matching["extent"], self.map_matching["cell_size"],
+                                 self.map_matching["walkable_threshold"], self.map_matching["cache_dir"])
+                self.matcher = MapMatcher(grid, self.map_matching["max_snap"])
+                self.logger.info(f"MAP MATCHING ON {self.map_matching['map_path']}: {grid.walkable.shape[1]}x{grid.walkable.shape[0]} cells, {100 * grid.walkable.mean():.0f}% walkable")
+            self.handler = message_handler.Handler(self.client_id, self.topic_sub, self.topic_pub, on_ready=self.ready, transport=self.transport)
+
+            # Messages are processed on their own thread so a slow stage backs up in a bounded queue
+            self.queue = backpressure.StageQueue(self.overload["max_depth"], self.overload["policy"], merge_linear)
+            self.monitor = backpressure.LagMonitor(self.client_id, self.handler, self.queue, self.overload["metrics_topic"], self.overload["metrics_interval"])
+            self.metrics = StageMetrics(self.client_id, self.handler, self.queue, **self.metrics_config)
+
+            # A sharded worker only subscribes to the partitions of topic_sub it owns
+            self.shards = None
+            if self.shard is None:
+                self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            else:
+                self.shards = ShardMember(self.stage_id, self.client_id, self.topic_sub, self.sharding, self.handler, self.queue,
+                                          self.release, self.adopt, self.checkpoint.load, on_ready=self.ready)
+                self.handler.client.message_callback_add(f"{self.topic_sub}/+", self.on_message)
+            Thread(target=self.process_loop, daemon=True).start()
+            self.metrics.start()
         
             # Start event loop
             self.handler.connect()
@@ -49,16 +139,122 @@ class LinearProcess(Process):
         
     def interrupt_handler(self, signum, frame):
         self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
-        self.handler.client.disconnect()
-        self.logger.debug('Process Ended')
+        if self.shards is not None:
+            # A sharded worker keeps processing until its partitions are handed to the other workers, stop() then
+            # ends the event loop and with it the process
+            self.shards.leave(self.stop)
+            return
+        self.stop()
         time.sleep(1)
         exit(0)
+
+    def stop(self):
+        "Saves the last snapshot and disconnects."
+        self.queue.close()
+        if self.checkpoint.path is not None:
+            self.checkpoint.save(self.snapshot())
+        if self.shards is not None:
+            self.shards.disconnect()
+        else:
+            self.handler.client.disconnect()
+        self.logger.debug('Process Ended')
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
         
     def on_message(self, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
         data = json.loads(msg.payload)
-        err = self.data_transformer.track(data)
-        if err != 0:
-            self.logger.error('linear_to_location.track returned with errno: ' + err)
-        self.handler.publish(json.dumps(data))
-        
-    
\ No newline at end of file
+        if start:
+            self.metrics.decode_time.since(start)
+        if self.shards is None or self.shards.accept(msg.topic, data):
+            self.queue.put(data.get("asset_id"), data)
+
+    def process_loop(self):
+        """Tracks and publishes queued messages until the queue is closed. A message that fails is logged and skipped,
+        the thread keeps serving the queue so the broker thread is never blocked on a dead consumer."""
+        while not self.queue.closed:
+            item = self.queue.get(timeout=self.overload["metrics_interval"])
+            try:
+                if item is None:
+                    with self.lock:
+                        self.monitor.tick()
+                        self.checkpoint.tick(self.snapshot)
+                    continue
+                enqueue_time, data = item
+                with self.lock:
+                    self.metrics.processed += 1
+                    start = self.metrics.sample_process and self.metrics.start_process()
+                    tracker = self.tracker(data.get("asset_id"))
+                    err = tracker.track(data)
+                    if err != 0:
+                        self.logger.error(f'linear_to_location.track returned with errno: {err}')
+                    if self.matcher is not None:
+                        self.match(tracker, data)
+                    if start:
+                        start = self.metrics.process_time.since(start)
+                    if self.payload_mode == "delta":
+                        payload = json.dumps(messages.delta(data, self.published_fields))
+                    else:
+                        payload = json.dumps(data)
+                    if start:
+                        self.metrics.encode_time.since(start)
+                    info = self.handler.publish(payload)
+                    self.metrics.published += 1
+                    self.monitor.record(enqueue_time, data, info.rc)
+                    self.checkpoint.tick(self.snapshot)
+            except Exception as e:
+                self.logger.error(e, exc_info=True)
+            finally:
+                if item is not None:
+                    self.queue.task_done()
+
+    def match(self, tracker, data: dict):
+        """Moves the location into walkable space, keeping the dead reckoned one as raw_x_loc and raw_y_loc. In correct
+        mode the tracker continues from the matched location, in snap mode only the published location changes."""
+        x, y = self.matcher.match(data["x_loc"], data["y_loc"])
+        data["raw_x_loc"] = data["x_loc"]
+        data["raw_y_loc"] = data["y_loc"]
+        data["x_loc"] = x
+        data["y_loc"] = y
+        if self.map_matching["mode"] == "correct":
+            tracker.x = x
+            tracker.y = y
+
+    def tracker(self, asset_id):
+        "Returns the Tracking of an asset, creating it for a new asset."
+        if asset_id not in self.trackers:
+            self.trackers[asset_id] = linear_to_location.Tracking(self.axle_length, self.filter_version, self.filter_chain)
+            if asset_id in self.restored:
+                self.trackers[asset_id].set_state(self.restored.pop(asset_id))
+        return self.trackers[asset_id]
+
+    def snapshot(self):
+        """State of every asset for the checkpoint file. Restored assets not seen since the restart keep their restored
+        state, else a second restart would move them back to the origin."""
+        # A sharded worker restored the assets of every worker, it only keeps those of the partitions it owns
+        states = {asset_id: state for asset_id, state in list(self.restored.items())
+                  if self.shards is None or partition_of(asset_id, self.sharding["partitions"]) in self.shards.owned}
+        states.update((asset_id, tracker.get_state()) for asset_id, tracker in list(self.trackers.items()))
+        return states
+
+    def release(self, partition):
+        "Removes the assets of a partition handed to another worker and returns their state."
+        with self.lock:
+            states = {}
+            for asset_id in [asset_id for asset_id in self.trackers if partition_of(asset_id, self.sharding["partitions"]) == partition]:
+                states[asset_id] = self.trackers.pop(asset_id).get_state()
+            for asset_id in [asset_id for asset_id in self.restored if partition_of(asset_id, self.sharding["partitions"]) == partition]:
+                states[asset_id] = self.restored.pop(asset_id)
+            return states
+
+    def adopt(self, states, handed_off=False):
+        """Takes over the state of assets handed over by another worker (handed_off), or restored from the checkpoint
+        files. A location is resumed the same either way."""
+        with self.lock:
+            for asset_id, state in states.items():
+                self.trackers.pop(asset_id, None)
+                self.restored[asset_id] = state
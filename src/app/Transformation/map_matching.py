@@ -0,0 +1,191 @@
+"""
+Keeps dead reckoned locations inside the walkable area of the floor plan.
+
+The floor plan image (the GUI's map_path, stretched over the min_x/max_x/min_y/max_y extent the same way the GUI draws
+it, in the units of x_loc and y_loc) is rasterized once into a grid of cells: cells at least as light as walkable_threshold are walkable, darker ones
+are walls and obstacles. The bundled map_01.png draws its obstacles light grey (245) on white, hence the default of
+250. An exact Euclidean distance transform of that grid gives, for every cell, the distance to the nearest walkable
+cell and which cell that is. Matching a location is then two array lookups, whatever the shape of the floor plan.
+
+The rasterization and distance transform are cached in cache_dir as map_<hash>.npz, keyed by a hash of the image and the
+grid parameters, so they only run again when the map or the parameters change.
+"""
+
+import hashlib
+import os
+import numpy as np
+
+DEFAULT_MAP_MATCHING = {
+    "enabled": False,
+    "map_path": None,
+    "extent": None,
+    "cell_size": 50.0,
+    "walkable_threshold": 250,
+    "max_snap": 1000.0,
+    "mode": "correct",
+    "cache_dir": "map_cache"
+}
+
+MATCH_MODES = ("snap", "correct")
+
+
+class MapGrid:
+    def __init__(self, walkable: np.ndarray, extent: list, cell_size: float):
+        """
+        Args:
+            walkable (np.ndarray): Boolean grid, row 0 at min_y and column 0 at min_x.\n
+            extent (list): [min_x, max_x, min_y, max_y] covered by the grid, in map units.\n
+            cell_size (float): Size of a cell in map units.
+        """
+        self.walkable = walkable
+        self.min_x, self.max_x, self.min_y, self.max_y = extent
+        self.cell_size = cell_size
+        self.distance = None
+        self.nearest_rows = None
+        self.nearest_cols = None
+
+    def build(self):
+        "Computes the distance to and the index of the nearest walkable cell of every cell."
+        distance, self.nearest_rows, self.nearest_cols = distance_transform(self.walkable)
+        self.distance = (distance * self.cell_size).astype(np.float32)
+        return self
+
+    def cell(self, x: float, y: float):
+        "Row and column of the cell holding x, y, clamped to the grid."
+        rows, cols = self.walkable.shape
+        row = min(max(int((y - self.min_y) / self.cell_size), 0), rows - 1)
+        col = min(max(int((x - self.min_x) / self.cell_size), 0), cols - 1)
+        return row, col
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            np.savez(cache_file, walkable=self.walkable, distance=self.distance, nearest_rows=self.nearest_rows,
+                     nearest_cols=self.nearest_cols, extent=[self.min_x, self.max_x, self.min_y, self.max_y],
+                     cell_size=self.cell_size)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as cache:
+            grid = cls(cache["walkable"], cache["extent"].tolist(), float(cache["cell_size"]))
+            grid.distance = cache["distance"]
+            grid.nearest_rows = cache["nearest_rows"]
+            grid.nearest_cols = cache["nearest_cols"]
+        return grid
+
+
+def distance_transform(walkable: np.ndarray, block: int = 64):
+    """Exact Euclidean distance transform, in cells, from every cell to the nearest walkable cell.
+
+    Separable: the nearest walkable cell in the same column first, then for every row the best of those over all
+    columns, evaluated block by block of columns so memory stays at rows * cols * block.
+
+    Args:
+        walkable (np.ndarray): Boolean grid.\n
+        block (int, optional): Columns compared at once in the row pass. Defaults to 64.
+
+    Returns:
+        (distance, nearest_rows, nearest_cols): float64 distances and the int32 index of the nearest walkable cell.
+    """
+    if not walkable.any():
+        raise ValueError("Map has no walkable cells, check map_path and walkable_threshold")
+    rows, cols = walkable.shape
+    index = np.arange(rows)[:, None]
+    # Column pass: nearest walkable row at or above, and at or below, every cell
+    above = np.maximum.accumulate(np.where(walkable, index, -rows), axis=0)
+    below = np.minimum.accumulate(np.where(walkable, index, 2 * rows)[::-1], axis=0)[::-1]
+    column_nearest = np.where(index - above <= below - index, above, below)
+    # Columns without any walkable cell are never the nearest
+    column_distance = np.where(walkable.any(axis=0), (index - column_nearest).astype(float) ** 2, np.inf)
+
+    # Row pass: min over columns c' of (c - c')**2 + column_distance[row, c']
+    best = np.full((rows, cols), np.inf)
+    best_cols = np.zeros((rows, cols), dtype=np.int32)
+    col_index = np.arange(cols)
+    for start in range(0, cols, block):
+        candidates = col_index[start:start + block]
+        cost = (col_index[None, :, None] - candidates[None, None, :]) ** 2 + column_distance[:, None, start:start + block]
+        block_best = cost.argmin(axis=2)
+        block_cost = np.take_along_axis(cost, block_best[:, :, None], axis=2)[:, :, 0]
+        better = block_cost < best
+        best[better] = block_cost[better]
+        best_cols[better] = candidates[block_best[better]]
+    best_rows = column_nearest[np.arange(rows)[:, None], best_cols].astype(np.int32)
+    return np.sqrt(best), best_rows, best_cols
+
+
+def rasterize(map_path: str, extent: list, cell_size: float, walkable_threshold: int = 250):
+    """Walkable cells of the floor plan image, stretched over extent like the GUI draws it.
+
+    Args:
+        map_path (str): Floor plan image, walkable area lighter than the walls.\n
+        extent (list): [min_x, max_x, min_y, max_y] in map units.\n
+        cell_size (float): Size of a cell in map units.\n
+        walkable_threshold (int, optional): Grey level (0-255) from which a cell is walkable. Defaults to 250.
+    """
+    # Only needed to build the cache, nodes running from a cached grid do not need Pillow
+    from PIL import Image
+
+    min_x, max_x, min_y, max_y = extent
+    cols = max(int(np.ceil((max_x - min_x) / cell_size)), 1)
+    rows = max(int(np.ceil((max_y - min_y) / cell_size)), 1)
+    with Image.open(map_path) as image:
+        # Average the pixels of each cell, a cell is walkable when it is mostly free space
+        grey = np.asarray(image.convert('L').resize((cols, rows), Image.BOX))
+    # Image rows run top to bottom, grid rows run from min_y up
+    return np.flipud(grey >= walkable_threshold)
+
+
+def load_grid(map_path: str, extent: list, cell_size: float, walkable_threshold: int = 250, cache_dir: str = None):
+    """Returns the MapGrid of a floor plan, from cache_dir if it was built before with the same image and parameters.
+
+    Args:
+        map_path (str): Floor plan image.\n
+        extent (list): [min_x, max_x, min_y, max_y] in map units.\n
+        cell_size (float): Size of a cell in map units.\n
+        walkable_threshold (int, optional): Grey level (0-255) from which a cell is walkable. Defaults to 250.\n
+        cache_dir (str, optional): Directory of the cached grids, None to always build. Defaults to None.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        with open(map_path, 'rb') as map_file:
+            key.update(map_file.read())
+        key.update(repr((list(extent), float(cell_size), int(walkable_threshold))).encode())
+        cache_path = os.path.join(cache_dir, f"map_{key.hexdigest()[:16]}.npz")
+        if os.path.exists(cache_path):
+            return MapGrid.load(cache_path)
+
+    grid = MapGrid(rasterize(map_path, extent, cell_size, walkable_threshold), extent, cell_size).build()
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        grid.save(cache_path)
+    return grid
+
+
+class MapMatcher:
+    def __init__(self, grid: MapGrid, max_snap: float = None):
+        """
+        Args:
+            grid (MapGrid): Built grid of the floor plan.\n
+            max_snap (float, optional): Locations further than this from walkable space are left as they are, the
+            track is lost rather than slightly off. None to always snap. Defaults to None.
+        """
+        self.grid = grid
+        self.max_snap = max_snap
+        self.snapped = 0
+
+    def match(self, x: float, y: float):
+        "Returns the location moved to the nearest walkable cell, unchanged if it already is walkable."
+        grid = self.grid
+        row, col = grid.cell(x, y)
+        distance = grid.distance[row, col]
+        if distance == 0 and grid.min_x <= x <= grid.max_x and grid.min_y <= y <= grid.max_y:
+            return x, y
+        if self.max_snap is not None and distance > self.max_snap:
+            return x, y
+        self.snapped += 1
+        size = grid.cell_size
+        return (float(grid.min_x + (grid.nearest_cols[row, col] + 0.5) * size),
+                float(grid.min_y + (grid.nearest_rows[row, col] + 0.5) * size))
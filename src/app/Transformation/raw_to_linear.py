@@ -4,18 +4,43 @@ Currently supports devices using gyroscope information reported in degrees per s
 """
 
 import math
+from app.lib import filters
+
+# How distance is integrated across readings that were lost upstream:
+# - hold: the wheel speed of the last reading is held until the next one arrives.
+# - interpolate: the wheel speed changes linearly between the two readings (same as consecutive readings).
+# - reset: no distance is integrated across the gap, integration restarts at the next reading.
+GAP_STRATEGIES = ("hold", "interpolate", "reset")
 
 
 class Transformer:
-    def __init__(self, wheel_diameter, filter_version):
+    # Fixed attribute set, the per wheel state of the previous reading is kept in plain attributes so a reading is
+    # processed without building containers
+    __slots__ = ("gap_strategy", "filter_version", "circumference", "started", "previous_dps_left_wheel",
+                 "previous_dps_right_wheel", "previous_timestamp_left_wheel", "previous_timestamp_right_wheel",
+                 "total_distance_left_wheel", "total_distance_right_wheel", "dps_filter_cutoff",
+                 "dps_filter_cutoff_multiplier", "dps_additive_factor", "dps_percentage", "dps_left_wheel_exponent",
+                 "dps_right_wheel_exponent", "filter_chain", "filters", "left_filter", "right_filter")
+
+    def __init__(self, wheel_diameter, filter_version, filter_chain=None, gap_strategy="interpolate"):
         """
         Creates an instance of the raw-to-linear class with default values.
         @param wheel_diameter: measured diameter of the wheel that sensor is mounted to. Used for circumference.
         @param filter_version: Currently not used. Intended for testing various corrective filters.
+        @param filter_chain: filters applied to each wheel's gyroscope DPS, see app.lib.filters. Defaults to the dps filter.
+        @param gap_strategy: how distance is integrated across missing readings, one of GAP_STRATEGIES.
         """
+        if gap_strategy not in GAP_STRATEGIES:
+            raise ValueError(f'Gap strategy "{gap_strategy}" not supported. Accepted values are: {", ".join(GAP_STRATEGIES)}')
+        self.gap_strategy = gap_strategy
         self.filter_version = filter_version            # unused field
         self.circumference = math.pi * wheel_diameter
-        self.previous_run_data = {"LW": {}, "RW": {}}   # initialize to empty dict to prevent NULL error on first packet
+        # previous reading of each wheel, started is False until the first reading
+        self.started = False
+        self.previous_dps_left_wheel = 0.0
+        self.previous_dps_right_wheel = 0.0
+        self.previous_timestamp_left_wheel = 0.0
+        self.previous_timestamp_right_wheel = 0.0
         self.total_distance_left_wheel = 0.0
         self.total_distance_right_wheel = 0.0
         # variables used in dps_filter()
@@ -25,17 +50,53 @@ class Transformer:
         self.dps_percentage = 0.0045
         self.dps_left_wheel_exponent = 2
         self.dps_right_wheel_exponent = 2
-
-    def transform(self, data):
-        """Used to reset the process when the [RESET] button is activated on the visualizer."""
-        if 'reset' in data and data["reset"] is True:
-            self.previous_run_data = {"LW": {}, "RW": {}}
+        self.filter_chain = filter_chain if filter_chain is not None else [{"type": "dps"}]
+        self.filters = {wheel: filters.build_chain(self.filter_chain, wheel, self.dps_parameters())
+                        for wheel in ("left", "right")}
+        self.left_filter = self.filters["left"]
+        self.right_filter = self.filters["right"]
+
+    def transform(self, data, gap=0):
+        """Used to reset the process when the [RESET] button is activated on the visualizer.
+        gap is the number of readings missing before data, see app.lib.sequence. None when data starts a new run of its
+        source, integration then restarts at data."""
+        if data.get("reset") is True:
+            self.started = False
             self.total_distance_left_wheel = 0.0
             self.total_distance_right_wheel = 0.0
-
-        self.calculate_distance_over_interval(self.previous_run_data, data)
+            self.left_filter.reset()
+            self.right_filter.reset()
+        elif gap is None:
+            self.started = False
+            gap = 0
+        elif gap > 0 and self.gap_strategy == "reset":
+            self.started = False
+
+        self.calculate_distance_over_interval(data, gap)
         return 0
 
+    def get_state(self):
+        """State needed to continue integrating after a restart, see app.lib.checkpoint"""
+        previous_run_data = {"LW": {}, "RW": {}}
+        if self.started:
+            previous_run_data["LW"] = {"dps": self.previous_dps_left_wheel, "timestamp": self.previous_timestamp_left_wheel}
+            previous_run_data["RW"] = {"dps": self.previous_dps_right_wheel, "timestamp": self.previous_timestamp_right_wheel}
+        return {"previous_run_data": previous_run_data,
+                "total_distance_left_wheel": self.total_distance_left_wheel,
+                "total_distance_right_wheel": self.total_distance_right_wheel}
+
+    def set_state(self, state):
+        """Restores a state returned by get_state(). Filters start empty."""
+        previous_run_data = state["previous_run_data"]
+        self.started = len(previous_run_data["LW"]) > 0
+        if self.started:
+            self.previous_dps_left_wheel = previous_run_data["LW"]["dps"]
+            self.previous_timestamp_left_wheel = previous_run_data["LW"]["timestamp"]
+            self.previous_dps_right_wheel = previous_run_data["RW"]["dps"]
+            self.previous_timestamp_right_wheel = previous_run_data["RW"]["timestamp"]
+        self.total_distance_left_wheel = state["total_distance_left_wheel"]
+        self.total_distance_right_wheel = state["total_distance_right_wheel"]
+
     def calculate_linear_distance(self, previous_rotational_velocity, current_rotational_velocity,
                                   previous_time, current_time):
         """Transform data from DPS as rotational velocity to linear distance travelled (unit-less)"""
@@ -51,6 +112,15 @@ class Transformer:
         _linear_distance = ((_rotational_distance / 360) * self.circumference)
         return _linear_distance
 
+    def dps_parameters(self):
+        """Default parameters of the dps filter in the filter chain"""
+        return {"cutoff": self.dps_filter_cutoff,
+                "cutoff_multiplier": self.dps_filter_cutoff_multiplier,
+                "additive_factor": self.dps_additive_factor,
+                "percentage": self.dps_percentage,
+                "left_wheel_exponent": self.dps_left_wheel_exponent,
+                "right_wheel_exponent": self.dps_right_wheel_exponent}
+
     def dps_filter(self, current_data, wheel):
         """
         Filter the raw gyroscope DPS reading, return filtered DPS.
@@ -58,66 +128,47 @@ class Transformer:
         Sensor Difference Filter attempts to balance the variance of each sensor.
             - These values and transformations were determined from testing specific sensors
         """
-        CUT = self.dps_filter_cutoff
-        CUT_multiplier = self.dps_filter_cutoff_multiplier
-        factor = self.dps_additive_factor
-        percentage = self.dps_percentage
-        expoL = self.dps_left_wheel_exponent
-        expoR = self.dps_right_wheel_exponent
-
-        final_dps_ = 0.0
-        gyroDPS = current_data["gyroZ"]
-
-        # LOW BANDWIDTH FILTER
-        if abs(gyroDPS) > CUT:
-            final_dps_ = gyroDPS
-
-        # SENSOR DIFFERENCE FILTER
-        if abs(gyroDPS) > (CUT * CUT_multiplier):
-            # augmented 1/X applies more correction to slow-moving wheels
-            if "left" in wheel:
-                final_dps_ += ((CUT + factor) ** expoL / final_dps_)
-                final_dps_ -= (final_dps_ * percentage)
-            if "right" in wheel:
-                final_dps_ += ((CUT + factor) ** expoR / final_dps_)
-                final_dps_ += (final_dps_ * percentage)
-
-        return final_dps_
-
-    def calculate_distance_over_interval(self, previous_run_data, data):
+        return filters.dps_filter_value(current_data["gyroZ"], wheel, **self.dps_parameters())
+
+    def calculate_distance_over_interval(self, data, gap=0):
         """
         Core function. Calculates the linear distance traveled by both wheels. Updates payload accordingly.
-        PreviousData are stored in memory only, used to calculate instantaneous differences
+        The previous reading is stored in memory only, used to calculate instantaneous differences
         """
-        dps_left_wheel = 0.0
-        dps_right_wheel = 0.0
         linear_distance_left_wheel = 0.0
         linear_distance_right_wheel = 0.0
 
-        dps_left_wheel = self.dps_filter(data["LSensor"], "left")
-        dps_right_wheel = self.dps_filter(data["RSensor"], "right")
+        left = data["LSensor"]
+        right = data["RSensor"]
+        dps_left_wheel = self.left_filter.update(left["gyroZ"], left)
+        dps_right_wheel = self.right_filter.update(right["gyroZ"], right)
 
-        if len(self.previous_run_data["LW"]) > 0:
+        if self.started:
             # i.e this is not the first data point
-            linear_distance_left_wheel = self.calculate_linear_distance(self.previous_run_data["LW"]["dps"],
-                                                                        dps_left_wheel,
-                                                                        previous_run_data["LW"]["timestamp"],
-                                                                        data["LSensor"]["timestamp"])
-            linear_distance_right_wheel = self.calculate_linear_distance(self.previous_run_data["RW"]["dps"],
-                                                                         dps_right_wheel,
-                                                                         previous_run_data["RW"]["timestamp"],
-                                                                         data["RSensor"]["timestamp"])
+            # Holding across a gap integrates the last known speed up to this reading
+            hold = gap > 0 and self.gap_strategy == "hold"
+            linear_distance_left_wheel = self.calculate_linear_distance(self.previous_dps_left_wheel,
+                                                                        self.previous_dps_left_wheel if hold else dps_left_wheel,
+                                                                        self.previous_timestamp_left_wheel,
+                                                                        left["timestamp"])
+            linear_distance_right_wheel = self.calculate_linear_distance(self.previous_dps_right_wheel,
+                                                                         self.previous_dps_right_wheel if hold else dps_right_wheel,
+                                                                         self.previous_timestamp_right_wheel,
+                                                                         right["timestamp"])
 
         # Update local data
-        self.previous_run_data["LW"] = {"dps": dps_left_wheel, "timestamp": data["LSensor"]["timestamp"]}
-        self.previous_run_data["RW"] = {"dps": dps_right_wheel, "timestamp": data["RSensor"]["timestamp"]}
+        self.started = True
+        self.previous_dps_left_wheel = dps_left_wheel
+        self.previous_dps_right_wheel = dps_right_wheel
+        self.previous_timestamp_left_wheel = left["timestamp"]
+        self.previous_timestamp_right_wheel = right["timestamp"]
 
         self.total_distance_left_wheel += linear_distance_left_wheel
         self.total_distance_right_wheel += linear_distance_right_wheel
 
         # Update the message payload data
-        data["LSensor"]["F_dps"] = dps_left_wheel
-        data["RSensor"]["F_dps"] = dps_right_wheel
+        left["F_dps"] = dps_left_wheel
+        right["F_dps"] = dps_right_wheel
 
         data["LW_dis"] = linear_distance_left_wheel
         data["RW_dis"] = linear_distance_right_wheel
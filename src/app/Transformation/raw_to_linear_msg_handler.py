@@ -4,40 +4,115 @@ raw_to_linear.Transformer class and then publishing to the linear data topic.
 """
 
 import app.lib.message_handler as message_handler
+import app.lib.backpressure as backpressure
+from app.lib.metrics import DEFAULT_METRICS, StageMetrics
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+from app.lib.checkpoint import Checkpoint, DEFAULT_CHECKPOINT
+import app.lib.sequence as sequence
+from app.lib.sharding import DEFAULT_SHARDING, Router, ShardMember, partition_of
 import app.Transformation.raw_to_linear as raw_to_linear
+from app.lib import messages
 from sys import exit
 from multiprocessing import Process
-import json, logging, signal, time
+from threading import Lock, Thread
+import json, logging, math, signal, time
+
+# Fields produced by this stage, the only ones published in delta payload mode
+PUBLISHED_FIELDS = ("LW_dis", "RW_dis", "LW_total", "RW_total", "LSensor.F_dps", "RSensor.F_dps")
 
 class RawProcess(Process):
-    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, wheel_diameter:float, filter_ver:int):
+    def __init__(self, client_id:str, topic_sub:str, topic_pub:str, wheel_diameter:float, filter_ver:int, control_queue=None, transport:dict=None, overload:dict=None, filter_chain:list=None, payload_mode:str="full", sequencing:dict=None, checkpoint:dict=None, sharding:dict=None, shard:int=None, publish_partitions:int=None, metrics:dict=None, profiling:dict=None):
         """
         Args:
             client_id (str): Mosquitto client id.\n
             topic_sub (str): Broker topic to subscribe to.\n
             topic_pub (str): Broker topic to publish messages to.\n
             wheel_diameter (float): Wheel diameter of asset in mm.\n
-            filter_ver (int): Deprecated.
+            filter_ver (int): Deprecated.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            overload (dict, optional): Overload policy and lag metrics settings, see backpressure.DEFAULT_OVERLOAD. Defaults to None.\n
+            filter_chain (list, optional): Filter configs applied to each wheel, see app.lib.filters. Defaults to None.\n
+            payload_mode (str, optional): full | delta, see app.lib.messages. Defaults to "full".\n
+            sequencing (dict, optional): Reorder buffer and gap settings, see sequence.DEFAULT_SEQUENCING. Defaults to None.\n
+            checkpoint (dict, optional): Snapshot file and interval, see app.lib.checkpoint. Defaults to None.\n
+            sharding (dict, optional): Worker count, partitions and handoff settings, see app.lib.sharding. Defaults to None.\n
+            shard (int, optional): Index of this worker when the stage is sharded, its client id is client_id-shard and it
+            only receives the assets of its partitions of topic_sub. Defaults to None, not sharded.\n
+            publish_partitions (int, optional): Partitions of topic_pub when the next stage is sharded. Defaults to None.\n
+            metrics (dict, optional): Counters, timings and resource usage reporting, see app.lib.metrics. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
         """
         Process.__init__(self)
-        self.client_id = client_id
+        self.stage_id = client_id
+        self.client_id = client_id if shard is None else f"{client_id}-{shard}"
         self.topic_sub = topic_sub
         self.topic_pub = topic_pub
         self.wheel_diameter = wheel_diameter
         self.filter_ver = filter_ver
+        self.control_queue = control_queue
+        self.transport = transport
+        self.overload = dict(backpressure.DEFAULT_OVERLOAD)
+        if overload is not None:
+            self.overload.update(overload)
+        self.filter_chain = filter_chain
+        if payload_mode not in messages.PAYLOAD_MODES:
+            raise ValueError(f'Payload mode "{payload_mode}" not supported. Accepted values are: {", ".join(messages.PAYLOAD_MODES)}')
+        self.payload_mode = payload_mode
+        self.sequencing = dict(sequence.DEFAULT_SEQUENCING)
+        if sequencing is not None:
+            self.sequencing.update(sequencing)
+        self.checkpoint_config = dict(DEFAULT_CHECKPOINT)
+        if checkpoint is not None:
+            self.checkpoint_config.update(checkpoint)
+        self.sharding = dict(DEFAULT_SHARDING)
+        if sharding is not None:
+            self.sharding.update(sharding)
+        self.shard = shard
+        self.publish_partitions = publish_partitions
+        self.metrics_config = dict(DEFAULT_METRICS)
+        if metrics is not None:
+            self.metrics_config.update(metrics)
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
         self.logger = logging.getLogger('app')
         
     def run(self):
         try:
             # Setup interrupt signal handler
             signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
             
             self.logger.debug('Process Started')
             
-            # Create transformer and msg handler 
-            self.data_transformer = raw_to_linear.Transformer(self.wheel_diameter, self.filter_ver)
-            self.handler = message_handler.Handler(self.client_id, self.topic_sub, self.topic_pub)
-            self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            # Transformers and reorder buffers are created per asset as their first reading arrives, from the last
+            # snapshot if there is one
+            self.assets = {}
+            self.checkpoint = Checkpoint(self.checkpoint_config["path"], self.checkpoint_config["interval"], self.shard)
+            self.restored = self.checkpoint.load()
+            # Restored assets handed over live by another worker, the others were read from checkpoint files
+            self.handed_off = set()
+            # Held by the processing thread per message, and while a sharded worker hands assets over
+            self.lock = Lock()
+            self.router = Router(self.topic_pub, self.publish_partitions)
+            self.handler = message_handler.Handler(self.client_id, self.topic_sub, self.topic_pub, on_ready=self.ready, transport=self.transport)
+
+            # Messages are processed on their own thread so a slow stage backs up in a bounded queue
+            self.queue = backpressure.StageQueue(self.overload["max_depth"], self.overload["policy"])
+            self.monitor = backpressure.LagMonitor(self.client_id, self.handler, self.queue, self.overload["metrics_topic"], self.overload["metrics_interval"], self.sequence_counts)
+            self.metrics = StageMetrics(self.client_id, self.handler, self.queue, **self.metrics_config)
+
+            # A sharded worker only subscribes to the partitions of topic_sub it owns
+            self.shards = None
+            if self.shard is None:
+                self.handler.client.message_callback_add(self.topic_sub, self.on_message)
+            else:
+                self.shards = ShardMember(self.stage_id, self.client_id, self.topic_sub, self.sharding, self.handler, self.queue,
+                                          self.release, self.adopt, self.checkpoint.load, on_ready=self.ready)
+                self.handler.client.message_callback_add(f"{self.topic_sub}/+", self.on_message)
+            Thread(target=self.process_loop, daemon=True).start()
+            self.metrics.start()
 
             # Start event loop
             self.handler.connect()
@@ -48,15 +123,167 @@ class RawProcess(Process):
         
     def interrupt_handler(self, signum, frame):
         self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
-        self.handler.client.disconnect()
-        self.logger.debug('Process Ended')
+        if self.shards is not None:
+            # A sharded worker keeps processing until its partitions are handed to the other workers, stop() then
+            # ends the event loop and with it the process
+            self.shards.leave(self.stop)
+            return
+        self.stop()
         time.sleep(1)
         exit(0)
+
+    def stop(self):
+        "Saves the last snapshot and disconnects."
+        self.queue.close()
+        if self.checkpoint.path is not None:
+            self.checkpoint.save(self.snapshot())
+        if self.shards is not None:
+            self.shards.disconnect()
+        else:
+            self.handler.client.disconnect()
+        self.logger.debug('Process Ended')
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
         
     def on_message(self, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
         data = json.loads(msg.payload)
-        err = self.data_transformer.transform(data)
+        if start:
+            self.metrics.decode_time.since(start)
+        if self.shards is None or self.shards.accept(msg.topic, data):
+            self.queue.put(data.get("asset_id"), data)
+
+    def process_loop(self):
+        """Transforms and publishes queued messages until the queue is closed. A message that fails is logged and
+        skipped, the thread keeps serving the queue so the broker thread is never blocked on a dead consumer."""
+        # Wake up often enough to release readings held in the reorder buffers
+        timeout = min(self.overload["metrics_interval"], self.sequencing["max_delay"])
+        # Held readings of every asset are released on this period, also while other assets keep the queue busy, so a
+        # reading waits at most max_delay plus half of it
+        release_period = self.sequencing["max_delay"] / 2
+        next_release = time.monotonic() + release_period
+        while not self.queue.closed:
+            item = self.queue.get(timeout=timeout)
+            try:
+                if item is not None:
+                    enqueue_time, data = item
+                    with self.lock:
+                        transformer, resequencer = self.asset(data.get("asset_id"))
+                        for data, gap in resequencer.push(data):
+                            self.process(transformer, enqueue_time, data, gap)
+                        self.checkpoint.tick(self.snapshot)
+                now = time.monotonic()
+                if item is None or now >= next_release:
+                    with self.lock:
+                        self.release_held(now)
+                        self.monitor.tick()
+                        self.checkpoint.tick(self.snapshot)
+                    next_release = now + release_period
+            except Exception as e:
+                self.logger.error(e, exc_info=True)
+            finally:
+                if item is not None:
+                    self.queue.task_done()
+
+    def release_held(self, now: float):
+        "Processes the readings of every asset that waited longer than max_delay in its reorder buffer."
+        for transformer, resequencer in self.assets.values():
+            if resequencer.buffer:
+                for data, gap in resequencer.release(now):
+                    self.process(transformer, None, data, gap)
+
+    def asset(self, asset_id):
+        "Returns the Transformer and Resequencer of an asset, creating them for a new asset."
+        if asset_id not in self.assets:
+            self.assets[asset_id] = (
+                raw_to_linear.Transformer(self.wheel_diameter, self.filter_ver, self.filter_chain, self.sequencing["gap_strategy"]),
+                sequence.Resequencer(self.sequencing["reorder_window"], self.sequencing["max_delay"])
+            )
+            if asset_id in self.restored:
+                state = self.restored.pop(asset_id)
+                handed_off = asset_id in self.handed_off
+                self.handed_off.discard(asset_id)
+                self.assets[asset_id][0].set_state(state["transformer"])
+                if not handed_off and time.time() - state.get("unix_timestamp", 0) > self.sequencing["max_delay"]:
+                    # Read from a checkpoint file after this stage was down for longer than a reading is ever held
+                    # for, bridging the downtime as one gap would integrate the last wheel speed over it. Integration
+                    # restarts at the next reading, the total distance is kept.
+                    self.assets[asset_id][0].started = False
+                else:
+                    # Handed over by another worker while its source kept running, however long ago the handoff was
+                    self.assets[asset_id][1].set_state(state["sequence"])
+        return self.assets[asset_id]
+
+    def asset_state(self, transformer, resequencer):
+        "State of an asset for the checkpoint file or a handoff, with the time it was taken."
+        return {"transformer": transformer.get_state(), "sequence": resequencer.get_state(), "unix_timestamp": time.time()}
+
+    def snapshot(self):
+        """State of every asset for the checkpoint file. Restored assets not seen since the restart keep their restored
+        state, else a second restart would reset them."""
+        # A sharded worker restored the assets of every worker, it only keeps those of the partitions it owns
+        states = {asset_id: state for asset_id, state in list(self.restored.items())
+                  if self.shards is None or partition_of(asset_id, self.sharding["partitions"]) in self.shards.owned}
+        states.update((asset_id, self.asset_state(transformer, resequencer))
+                      for asset_id, (transformer, resequencer) in list(self.assets.items()))
+        return states
+
+    def release(self, partition):
+        "Removes the assets of a partition handed to another worker and returns their state."
+        with self.lock:
+            states = {}
+            for asset_id in [asset_id for asset_id in self.assets if partition_of(asset_id, self.sharding["partitions"]) == partition]:
+                transformer, resequencer = self.assets.pop(asset_id)
+                # The reorder buffer is not part of the state, held readings are released before the handoff
+                for data, gap in resequencer.release(math.inf):
+                    self.process(transformer, None, data, gap)
+                states[asset_id] = self.asset_state(transformer, resequencer)
+            for asset_id in [asset_id for asset_id in self.restored if partition_of(asset_id, self.sharding["partitions"]) == partition]:
+                states[asset_id] = self.restored.pop(asset_id)
+                self.handed_off.discard(asset_id)
+            return states
+
+    def adopt(self, states, handed_off=False):
+        """Takes over the state of assets handed over by another worker (handed_off), or restored from the checkpoint
+        files."""
+        with self.lock:
+            for asset_id, state in states.items():
+                self.assets.pop(asset_id, None)
+                self.restored[asset_id] = state
+                if handed_off:
+                    self.handed_off.add(asset_id)
+                else:
+                    self.handed_off.discard(asset_id)
+
+    def process(self, transformer, enqueue_time, data, gap):
+        self.metrics.processed += 1
+        start = self.metrics.sample_process and self.metrics.start_process()
+        err = transformer.transform(data, gap)
         if err != 0:
-            self.logger.error('raw_to_linear.Transformer returned with errno: ' + err)
-        self.handler.publish(json.dumps(data))
-    
\ No newline at end of file
+            self.logger.error(f'raw_to_linear.Transformer returned with errno: {err}')
+        if start:
+            start = self.metrics.process_time.since(start)
+        if self.payload_mode == "delta":
+            payload = json.dumps(messages.delta(data, PUBLISHED_FIELDS))
+        else:
+            payload = json.dumps(data)
+        if start:
+            self.metrics.encode_time.since(start)
+        info = self.handler.publish(payload, self.router.topic(data.get("asset_id")))
+        self.metrics.published += 1
+        if enqueue_time is not None:
+            self.monitor.record(enqueue_time, data, info.rc)
+
+    def sequence_counts(self):
+        "Duplicate, held and missing reading and source restart counts of all assets, reported with the lag metrics."
+        resequencers = [resequencer for transformer, resequencer in self.assets.values()]
+        return {
+            "duplicates": sum(r.duplicates for r in resequencers),
+            "held": sum(r.held for r in resequencers),
+            "missing": sum(r.missing for r in resequencers),
+            "restarts": sum(r.restarts for r in resequencers)
+        }
@@ -0,0 +1,151 @@
+from collections import deque
+import math
+import threading
+import numpy as np
+import pyqtgraph as pg
+from PyQt5 import QtGui
+
+# Fleet draws the current position and heading of every asset with a single batched ScatterPlotItem. Heading markers are precomputed rotated symbols so redrawing 1000+ assets never builds a QPainterPath per frame. Trails are only kept and drawn for assets that have been selected by clicking on their marker.
+class Fleet:
+    def __init__(self, plot_widget, settings):
+        self.plot_widget = plot_widget
+        self.trail_length = settings["queue_length"]
+        self.max_trails = settings.get("max_trails", 10)
+
+        # Number of discrete headings a marker can be drawn at, each one is a precomputed rotated arrow
+        self.symbol_steps = settings.get("heading_symbol_steps", 72)
+        self.symbol_table = np.empty(self.symbol_steps, dtype=object)
+        for i in range(self.symbol_steps):
+            self.symbol_table[i] = self.make_symbol(2 * math.pi * i / self.symbol_steps)
+
+        # Array backed state for all assets, rows are assigned in order of first appearance
+        self.capacity = 64
+        self.count = 0
+        self.x = np.zeros(self.capacity)
+        self.y = np.zeros(self.capacity)
+        self.heading = np.zeros(self.capacity)
+        self.asset_ids = []
+        self.index = {}
+        self.dirty = False
+
+        # Selected assets: asset_id -> (x deque, y deque, PlotDataItem)
+        self.selected = {}
+        self.last_selected = None
+
+        # Lock for accessing the above arrays and trail deques, they are written by the message broker thread
+        self.lock = threading.Lock()
+
+        # One item draws every asset marker
+        self.scatter = pg.ScatterPlotItem(
+            size=settings.get("marker_size", 14),
+            pen=pg.mkPen('#333333'),
+            brush=pg.mkBrush('#FFB300'),
+            pxMode=True
+        )
+        self.scatter.sigClicked.connect(self.on_click)
+        self.plot_widget.addItem(self.scatter)
+
+    # Builds an arrow pointing along the asset's heading. Heading 0 points up the y-axis and positive headings turn counterclockwise, matching Tracking.turn
+    @staticmethod
+    def make_symbol(radians):
+        arrow = QtGui.QPainterPath()
+        arrow.moveTo(0, -0.5)
+        arrow.lineTo(-0.35, 0.45)
+        arrow.lineTo(0, 0.25)
+        arrow.lineTo(0.35, 0.45)
+        arrow.closeSubpath()
+        # Symbol coordinates have y pointing down the screen, so a counterclockwise turn is a negative Qt rotation
+        transform = QtGui.QTransform()
+        transform.rotate(-math.degrees(radians))
+        return transform.map(arrow)
+
+    # Stores the latest position of an asset, called from the message broker thread
+    def update_asset(self, asset_id, x, y, heading):
+        with self.lock:
+            row = self.index.get(asset_id)
+            if row is None:
+                row = self.add_asset(asset_id)
+            self.x[row] = x
+            self.y[row] = y
+            self.heading[row] = heading
+            self.dirty = True
+
+            trail = self.selected.get(asset_id)
+            if trail is not None:
+                trail[0].append(x)
+                trail[1].append(y)
+
+    # Assigns an array row to a newly seen asset, growing the arrays when full. Caller must hold the lock
+    def add_asset(self, asset_id):
+        if self.count == self.capacity:
+            self.capacity *= 2
+            self.x = np.resize(self.x, self.capacity)
+            self.y = np.resize(self.y, self.capacity)
+            self.heading = np.resize(self.heading, self.capacity)
+        row = self.count
+        self.count += 1
+        self.index[asset_id] = row
+        self.asset_ids.append(asset_id)
+        return row
+
+    # Heading of the most recently selected asset, used to drive the compass
+    def selected_heading(self):
+        with self.lock:
+            row = self.index.get(self.last_selected)
+            if row is None:
+                return None
+            return float(self.heading[row])
+
+    # Repeatedly called to redraw every marker in one batch, and the trails of selected assets
+    def redraw(self):
+        with self.lock:
+            if self.dirty:
+                n = self.count
+                x = self.x[:n].copy()
+                y = self.y[:n].copy()
+                bins = np.rint(self.heading[:n] * (self.symbol_steps / (2 * math.pi))).astype(int) % self.symbol_steps
+                ids = list(self.asset_ids)
+                self.dirty = False
+            else:
+                n = None
+            trails = [(t[0].copy(), t[1].copy(), t[2]) for t in self.selected.values() if t[0]]
+
+        if n is not None:
+            self.scatter.setData(x=x, y=y, symbol=self.symbol_table[bins], data=ids)
+
+        for x_values, y_values, line in trails:
+            line.setData(x_values, y_values)
+
+    # Toggles the trail of a clicked asset
+    def on_click(self, scatter, points, *args):
+        if len(points) == 0:
+            return
+        asset_id = points[0].data()
+        if asset_id in self.selected:
+            self.deselect(asset_id)
+        else:
+            self.select(asset_id)
+
+    def select(self, asset_id):
+        with self.lock:
+            if asset_id in self.selected or len(self.selected) >= self.max_trails:
+                return
+            line = pg.PlotDataItem(pen=pg.mkPen('b', width=2))
+            self.selected[asset_id] = (deque(maxlen=self.trail_length), deque(maxlen=self.trail_length), line)
+            self.last_selected = asset_id
+        self.plot_widget.addItem(line)
+
+    def deselect(self, asset_id):
+        with self.lock:
+            trail = self.selected.pop(asset_id, None)
+            if self.last_selected == asset_id:
+                self.last_selected = next(iter(self.selected), None)
+        if trail is not None:
+            self.plot_widget.removeItem(trail[2])
+
+    # Clears all trails, markers are kept as every asset will report its position again
+    def clear_trails(self):
+        with self.lock:
+            for trail in self.selected.values():
+                trail[0].clear()
+                trail[1].clear()
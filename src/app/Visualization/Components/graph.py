@@ -4,10 +4,11 @@ import os
 import threading
 from PyQt5.QtWidgets import QGraphicsPixmapItem, QVBoxLayout, QWidget, QMessageBox
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QRectF
 import pyqtgraph as pg
 from PIL import Image
 from PIL import ImageQt
+from app.lib.downsample import TieredTrail
 
 # Creates parent widget, pyqtgraph child widget, and data structures needed for visualizing the live sensor data. Includes class methods for adding coordinates to the respective deques and animating the resulting curve on the graph 
 class Graph(QWidget):
@@ -17,11 +18,14 @@ class Graph(QWidget):
         # Define the length of the queue
         self.queue_length = settings["queue_length"]
 
-        # Create a deque for x and y values
+        # Create a deque for x and y values, these hold the most recent points at full resolution
         self.x_queue = deque(maxlen=self.queue_length)
         self.y_queue = deque(maxlen=self.queue_length)
 
-        # Lock for accessing the above deques
+        # Points that age out of the deques are kept in progressively downsampled tiers, so the whole run stays visible with a bounded number of vertices
+        self.history = TieredTrail(settings.get("history_tier_length", 0), settings.get("history_tiers", 0))
+
+        # Lock for accessing the above deques and history
         self.lock = threading.Lock()
 
         # Domain and range of graph
@@ -59,6 +63,18 @@ class Graph(QWidget):
             self.plot_widget.addItem(image_item)
             image_item.setPos(self.min_x, self.min_y)
 
+        # Occupancy heatmap overlay between the map and the line, levels set by set_heatmap are drawn by draw_heatmap
+        self.heatmap = None
+        self.heatmap_item = None
+        if settings.get("heatmap_url"):
+            self.heatmap_item = pg.ImageItem(axisOrder='row-major')
+            lut = pg.colormap.get('inferno').getLookupTable(nPts=256, alpha=True)
+            # Cells with no time spent stay transparent
+            lut[0, 3] = 0
+            self.heatmap_item.setLookupTable(lut)
+            self.heatmap_item.setOpacity(settings.get("heatmap_opacity", 0.6))
+            self.plot_widget.addItem(self.heatmap_item)
+
         # Create artist object for adding select points to plot
         self.line = pg.PlotDataItem()
         self.plot_widget.addItem(self.line)
@@ -83,17 +99,42 @@ class Graph(QWidget):
         # Background color
         self.plot_widget.setBackground('white')
 
-    # Append coordinate values to the corresponding deques
+    # Append coordinate values to the corresponding deques, moving the oldest point to the history once the deques are full
     def add_point(self, x, y):
         with self.lock:
+            if len(self.x_queue) == self.queue_length:
+                self.history.append(self.x_queue[0], self.y_queue[0])
             self.x_queue.append(x)
             self.y_queue.append(y)
 
-    # Repeatedly called to animate the curve produced by the coordinate values stored in the deques
+    # Clears the deques and the history
+    def clear(self):
+        with self.lock:
+            self.x_queue.clear()
+            self.y_queue.clear()
+            self.history.clear()
+
+    # Stores the latest heatmap levels (row 0 at min_y) and their extent in cm, for the next draw_heatmap
+    def set_heatmap(self, levels, extent):
+        with self.lock:
+            self.heatmap = (levels, extent)
+
+    # Called with the line or fleet redraw, updates the overlay only when a new heatmap arrived
+    def draw_heatmap(self):
+        with self.lock:
+            heatmap, self.heatmap = self.heatmap, None
+        if heatmap is None or self.heatmap_item is None:
+            return
+        levels, (min_x, max_x, min_y, max_y) = heatmap
+        self.heatmap_item.setImage(levels, levels=(0, 255))
+        self.heatmap_item.setRect(QRectF(min_x, min_y, max_x - min_x, max_y - min_y))
+
+    # Repeatedly called to animate the curve produced by the coordinate values stored in the history and deques
     def update_line(self):
         with self.lock:
-            x_values = self.x_queue
-            y_values = self.y_queue
+            x_values, y_values = self.history.points()
+            x_values.extend(self.x_queue)
+            y_values.extend(self.y_queue)
 
         if not x_values or not y_values:
             return
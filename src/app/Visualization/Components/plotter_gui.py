@@ -1,14 +1,22 @@
+from base64 import b64decode
 import json
+import logging
 import os
+import threading
+import time
+from urllib.request import urlopen
+import numpy as np
 import paho.mqtt.publish as publish
 from paho.mqtt.client import MQTTv5
 from PyQt5 import QtWidgets, QtGui
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import (QLabel, QFrame, QHBoxLayout, QPushButton, QVBoxLayout, QWidget)
 from app.lib.message_handler import Handler
+from app.lib.metrics import StageMetrics
 from app.Visualization.Components.graph import Graph
 from app.Visualization.Components.scroll_label import ScrollLabel
 from app.Visualization.Components.compass import Compass
+from app.Visualization.Components.fleet import Fleet
 
 # PlotterGUI creates the main PyQt GUI window, controls the general layout and any nested layouts within the GUI, receives data from the message broker, and uses said data to animate the embedded PyQtgraph
 class PlotterGUI(QWidget):
@@ -58,6 +66,13 @@ class PlotterGUI(QWidget):
         # Create graph
         self.graph = Graph(settings)
 
+        # Fleet view draws every asset on the location topics instead of a single asset's trail
+        self.fleet = None
+        topic_sub = settings["topic_sub"]
+        if settings.get("fleet_view") is True:
+            self.fleet = Fleet(self.graph.plot_widget, settings)
+            topic_sub = settings["fleet_topic_sub"]
+
         # Create compass
         self.compass = Compass()
 
@@ -98,27 +113,104 @@ class PlotterGUI(QWidget):
         self.side_bar.setMaximumWidth(self.frame_width)
         self.side_bar.setMinimumWidth(self.frame_width)
 
+        self.logger = logging.getLogger('app')
+
+        # Show the last known state before live data arrives
+        self.bootstrap()
+
+        # Poll the occupancy heatmap (app/Analytics/heatmap_msg_handler.py) in the background, it is drawn with the line
+        if settings.get("heatmap_url"):
+            threading.Thread(target=self.poll_heatmap, daemon=True).start()
+
         # Set up MQTT client
-        self.handler = Handler(client_id='gui', topic_sub=settings["topic_sub"], host=settings["broker_host"], port=settings["port"], qos=0)
-        self.handler.client.message_callback_add(settings["topic_sub"], self.on_message)
+        self.handler = Handler(client_id='gui', topic_sub=topic_sub, host=settings["broker_host"], port=settings["port"], transport=settings.get("transport"))
+        if self.fleet is not None:
+            self.handler.client.message_callback_add(topic_sub, self.on_fleet_message)
+        else:
+            self.handler.client.message_callback_add(topic_sub, self.on_message)
+        self.metrics = StageMetrics('gui', self.handler, **(settings.get("metrics") or {}))
         self.handler.connect()
         self.handler.client.loop_start()
+        self.metrics.start()
 
         # Timer to periodically update the line on the graph
         self.timer = QTimer(self)        
-        self.timer.timeout.connect(self.update_line)
-        self.timer.start(settings["draw_line_frequency"])
+        if self.fleet is not None:
+            self.timer.timeout.connect(self.update_fleet)
+            self.timer.start(settings["draw_fleet_frequency"])
+        else:
+            self.timer.timeout.connect(self.update_line)
+            self.timer.start(settings["draw_line_frequency"])
 
     # Updates the visualization by calling graph & compass functions, redrawing the line with most recent coords and rotating the compass accordingly
     def update_line(self):
         self.graph.update_line()
+        self.graph.draw_heatmap()
         self.compass.rotate_triangle(self.heading)
 
+    # Redraws all asset markers in one batch, the compass follows the most recently selected asset
+    def update_fleet(self):
+        self.fleet.redraw()
+        self.graph.draw_heatmap()
+        heading = self.fleet.selected_heading()
+        if heading is not None and heading != self.last_heading:
+            self.last_heading = heading
+            self.compass.rotate_triangle(heading)
+
+    # Starts from the last known state of the assets in the state cache (app/Database/state_cache.py), if one is configured and reachable. Single asset view shows the most recently updated asset
+    def bootstrap(self):
+        url = self.settings.get("state_cache_url")
+        if not url:
+            return
+        try:
+            with urlopen(url.rstrip('/') + "/snapshot", timeout=1) as response:
+                assets = json.load(response)["assets"]
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"State cache not available, waiting for live data: {e}")
+            return
+        assets = {asset_id: state for asset_id, state in assets.items() if "x_loc" in state and "y_loc" in state}
+        if self.fleet is not None:
+            for asset_id, state in assets.items():
+                self.fleet.update_asset(asset_id, state["x_loc"] / 10, state["y_loc"] / 10, state.get("heading", 0.0))
+        elif assets:
+            state = max(assets.values(), key=lambda state: state.get("unix_timestamp", 0.0))
+            x = state["x_loc"] / 10
+            y = state["y_loc"] / 10
+            self.graph.add_point(x, y)
+            self.scroll.setText("{:.4f},   {:.4f}".format(x, y))
+            self.heading = state.get("heading", 0.0)
+
+    # Fetches the configured heatmap every heatmap_frequency milliseconds and hands it to the graph, positions are converted from mm to cm like the locations
+    # An unreachable heatmap service is logged once, when it goes down, and again when it is back
+    def poll_heatmap(self):
+        url = self.settings["heatmap_url"].rstrip('/') + "/heatmap?variant=" + self.settings.get("heatmap_variant", "window")
+        frequency = self.settings.get("heatmap_frequency", 5000)
+        available = True
+        while True:
+            try:
+                with urlopen(url, timeout=2) as response:
+                    heatmap = json.load(response)
+                levels = np.frombuffer(b64decode(heatmap["levels"]), dtype=np.uint8).reshape(heatmap["shape"])
+                self.graph.set_heatmap(levels, [value / 10 for value in heatmap["extent"]])
+                if not available:
+                    self.logger.info("Heatmap available again")
+                    available = True
+            except (OSError, ValueError) as e:
+                if available:
+                    self.logger.warning(f"Heatmap not available, retrying every {frequency} ms: {e}")
+                    available = False
+            time.sleep(frequency / 1000)
+
     # Appends the deques and updates the heading variable with streaming data from the message broker
     def on_message(self, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
         # Sample_data_mod is used to determine the sample rate -- how often data is processed by the visualization.
         if self.counter % self.settings["sample_data_mod"] == 0:
+            self.metrics.processed += 1
             data = json.loads(msg.payload)
+            if start:
+                start = self.metrics.decode_time.since(start)
             if "x_loc" in data and "y_loc" in data:
                 x = data["x_loc"] / 10
                 y = data["y_loc"] / 10
@@ -127,8 +219,25 @@ class PlotterGUI(QWidget):
                     self.graph.add_point(x, y)
                     self.scroll.setText("{:.4f},   {:.4f}".format(x, y))
             self.heading = data["heading"]
+            if start:
+                self.metrics.process_time.since(start)
         self.counter += 1
 
+    # Stores the latest position of the asset that sent the message. The asset id is taken from the payload if present, otherwise from the last level of the topic (e.g. Data/location/<asset_id>)
+    def on_fleet_message(self, client, userdata, msg):
+        self.metrics.received += 1
+        start = self.metrics.sample_receive and self.metrics.start_receive()
+        data = json.loads(msg.payload)
+        if start:
+            start = self.metrics.decode_time.since(start)
+        if "x_loc" not in data or "y_loc" not in data:
+            return
+        self.metrics.processed += 1
+        asset_id = data.get("asset_id") or msg.topic.rsplit('/', 1)[-1]
+        self.fleet.update_asset(asset_id, data["x_loc"] / 10, data["y_loc"] / 10, data.get("heading", 0.0))
+        if start:
+            self.metrics.process_time.since(start)
+
     # Configure keystrokes
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Escape:
@@ -156,5 +265,6 @@ class PlotterGUI(QWidget):
             protocol=MQTTv5
             )
         self.scroll.lines.clear()
-        self.graph.x_queue.clear()
-        self.graph.y_queue.clear()
\ No newline at end of file
+        self.graph.clear()
+        if self.fleet is not None:
+            self.fleet.clear_trails()
\ No newline at end of file
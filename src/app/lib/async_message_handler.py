@@ -0,0 +1,216 @@
+'''
+asyncio counterpart of message_handler.Handler, for hosting many lightweight subscribers in one process.
+
+The paho client runs on the asyncio event loop instead of its own network thread: paho's socket callbacks register the
+socket with loop.add_reader/add_writer, so reads and writes happen as the loop sees the socket ready, and loop_misc()
+(keepalive pings, retries, reconnects) runs in a periodic task. Every subscription shares the one client and connection.
+
+Callbacks are registered per topic filter with subscribe() and use paho's (client, userdata, msg) signature. They run on
+the event loop, so they must not block: plain functions are called directly, coroutine functions are scheduled as tasks
+and heavy compute should be passed to run_in_executor().
+See https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
+'''
+
+from paho.mqtt.client import Client, MQTTv5, MQTT_ERR_NO_CONN
+import paho.mqtt.properties as properties
+from app.lib.message_handler import DEFAULT_TRANSPORT
+import asyncio
+import logging
+
+
+class AsyncHandler():
+    def __init__(self, client_id: str, host='localhost', port=1883, transport: dict = None, executor=None):
+        """
+        Args:
+            client_id (str): Name of this process for use by Mosquitto msg broker.\n
+            host (str, optional): IP address of Mosquitto server. Defaults to 'localhost'.\n
+            port (int, optional): Port of Mosquitto server . Defaults to 1883.\n
+            transport (dict, optional): Transport profile, see message_handler.transport_profile(). Keys left out fall
+            back to DEFAULT_TRANSPORT. Defaults to None.\n
+            executor (concurrent.futures.Executor, optional): Thread or process pool used by run_in_executor(). Defaults
+            to None, the event loop's default thread pool.
+        """
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.transport = dict(DEFAULT_TRANSPORT)
+        if transport is not None:
+            self.transport.update(transport)
+        self.qos = self.transport["qos"]
+        self.executor = executor
+        self.loop = None
+        self.connected = None
+        self.running = False
+        self.misc_task = None
+        self.tasks = set()
+        # topic filter -> qos, renewed on every (re)connect
+        self.subscriptions = {}
+        # SUBACK futures by message id
+        self.pending_subscribes = {}
+
+        # Create client
+        self.client = Client(
+            client_id=self.client_id,
+            protocol=MQTTv5
+        )
+
+        # Configure client properties
+        self.connect_properties = properties.Properties(
+            properties.PacketTypes.CONNECT
+        )
+        self.connect_properties.SessionExpiryInterval = self.transport["session_expiry"]
+        self.client.max_inflight_messages_set(self.transport["max_inflight_messages"])
+        self.client.max_queued_messages_set(self.transport["max_queued_messages"])
+        self.client.username_pw_set(
+            username=self.client_id,
+            password="test"
+        )
+
+        self.client.on_connect = self.__on_connect
+        self.client.on_disconnect = self.__on_disconnect
+        self.client.on_subscribe = self.__on_subscribe
+        self.client.on_message = self.__on_message
+        self.client.on_socket_open = self.__on_socket_open
+        self.client.on_socket_close = self.__on_socket_close
+        self.client.on_socket_register_write = self.__on_socket_register_write
+        self.client.on_socket_unregister_write = self.__on_socket_unregister_write
+
+    # Wrapper functions
+
+    async def connect(self):
+        "Connects client to the message broker and returns once the broker accepted the connection (CONNACK)."
+        self.loop = asyncio.get_running_loop()
+        self.connected = self.loop.create_future()
+        self.running = True
+        self.client.connect(
+            host=self.host,
+            port=self.port,
+            keepalive=self.transport["keepalive"],
+            clean_start=self.transport["clean_start"],
+            properties=self.connect_properties
+        )
+        self.misc_task = self.loop.create_task(self.misc_loop())
+        await self.connected
+
+    async def subscribe(self, topic_filter: str, callback, qos: int = None):
+        """Subscribes to topic_filter and routes its messages to callback. Returns once the broker acknowledged the
+        subscription (SUBACK) when connected, otherwise the subscription is made on connect.
+
+        Args:
+            topic_filter (str): Broker topic filter, may contain wildcards.\n
+            callback (callable): callback(client, userdata, msg), a function or a coroutine function.\n
+            qos (int, optional): Quality of service level of the subscription. Defaults to None, the transport qos.
+        """
+        qos = self.qos if qos is None else qos
+        self.client.message_callback_add(topic_filter, self.dispatcher(callback))
+        self.subscriptions[topic_filter] = qos
+        if self.client.is_connected():
+            await self.send_subscribe(topic_filter, qos)
+
+    def publish(self, topic: str, payload, qos: int = None):
+        "Wrapper for paho client.publish(). Returns paho's MQTTMessageInfo."
+        return self.client.publish(topic, payload, self.qos if qos is None else qos)
+
+    def run_in_executor(self, fn, *args):
+        "Runs fn(*args) in the executor, returns an awaitable with its result."
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def outbound_depth(self):
+        "Number of messages held by paho waiting to be sent or acknowledged, None if this paho version keeps them elsewhere."
+        # Private attributes of paho-mqtt 1.x, there is no public accessor
+        out_messages = getattr(self.client, "_out_messages", None)
+        out_packet = getattr(self.client, "_out_packet", None)
+        if out_messages is None or out_packet is None:
+            return None
+        return len(out_messages) + len(out_packet)
+
+    async def disconnect(self):
+        "Disconnects from the broker and waits for running callback tasks."
+        self.running = False
+        self.client.disconnect()
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # Event loop integration
+
+    def send_subscribe(self, topic_filter: str, qos: int):
+        result, mid = self.client.subscribe(topic_filter, qos)
+        future = self.loop.create_future()
+        self.pending_subscribes[mid] = (topic_filter, future)
+        return future
+
+    def dispatcher(self, callback):
+        "Wraps callback so coroutine functions are scheduled as tasks on the event loop."
+        if not asyncio.iscoroutinefunction(callback):
+            return callback
+
+        def dispatch(client, userdata, msg):
+            task = self.loop.create_task(callback(client, userdata, msg))
+            self.tasks.add(task)
+            task.add_done_callback(self.task_done)
+        return dispatch
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"MESSAGE BROKER: cid={self.client_id}, Callback failed", exc_info=task.exception())
+
+    async def misc_loop(self):
+        "Keepalive and retries, reconnects when the connection was lost."
+        while self.running:
+            if self.client.loop_misc() == MQTT_ERR_NO_CONN and self.running:
+                try:
+                    self.client.reconnect()
+                except OSError as e:
+                    logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Reconnect failed: {e}")
+            await asyncio.sleep(1)
+
+    def __on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def __on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    # Default callbacks
+
+    def __on_connect(self, client, userdata, flags, rc, properties=None):
+        logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Session present={str(flags['session present'])} ")
+        logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Connection result={str(rc)}")
+        if rc != 0:
+            if not self.connected.done():
+                self.connected.set_exception(ConnectionError(f"Connection refused: {rc}"))
+            return
+        # Renew the subscriptions, a reconnect starts without them unless the session was kept
+        for topic_filter, qos in self.subscriptions.items():
+            self.send_subscribe(topic_filter, qos)
+        if not self.connected.done():
+            self.connected.set_result(True)
+
+    def __on_subscribe(self, client, userdata, mid, reason_codes, properties=None):
+        topic_filter, future = self.pending_subscribes.pop(mid, (None, None))
+        if future is None or future.done():
+            return
+        if any(rc.value >= 128 for rc in reason_codes):
+            logging.error(f"MESSAGE BROKER: cid={self.client_id}, Subscription to {topic_filter} refused: {reason_codes}")
+            future.set_exception(ConnectionError(f"Subscription to {topic_filter} refused: {reason_codes}"))
+            return
+        logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Subscribed to {topic_filter}")
+        future.set_result(True)
+
+    def __on_disconnect(self, client, userdata, rc, properties=None):
+        if rc != 0:
+            logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Unexpected disconnection.")
+        else:
+            logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Disconnected by client.")
+
+    def __on_message(self, client, userdata, msg):
+        "Fallback for messages that match no subscribed topic filter."
+        logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Unhandled message on {msg.topic}")
@@ -0,0 +1,220 @@
+"""
+Overload handling for pipeline stages.
+
+A stage's message broker thread decodes each message and puts it in a StageQueue. A separate processing thread takes
+messages from the queue, so a slow stage is visible as queue depth instead of unbounded growth inside paho. When the
+queue is full the configured policy is applied:
+- block: the broker thread waits for room, which stops reading from the socket so the broker holds the backlog.
+- drop_oldest: the oldest queued message is discarded.
+- coalesce: only the latest message per key (the message's asset_id, the assets share a topic) is kept. An optional
+  merge function folds the replaced message into its successor, e.g. to keep a reset flag or sum distance deltas.
+
+Outgoing messages are bounded by the transport profile's max_queued_messages, publishes rejected by paho are counted.
+LagMonitor periodically publishes the queue depths, lag and drop counts of a stage to a metrics topic.
+"""
+
+from collections import deque, OrderedDict
+import json
+import threading
+import time
+
+POLICIES = ("block", "drop_oldest", "coalesce")
+
+DEFAULT_OVERLOAD = {
+    "policy": "block",
+    "max_depth": 250,
+    "metrics_topic": "Debug/lag",
+    "metrics_interval": 5
+}
+
+
+def keep_reset(old: dict, new: dict):
+    "Default coalesce merge, a reset flag on a replaced message must not be lost."
+    if old.get("reset") is True:
+        new["reset"] = True
+    return new
+
+
+class StageQueue:
+    """Bounded queue of decoded messages between a stage's message broker thread and its processing thread."""
+
+    def __init__(self, max_depth: int, policy: str = "block", merge=keep_reset):
+        """
+        Args:
+            max_depth (int): Maximum number of queued messages.\n
+            policy (str, optional): block | drop_oldest | coalesce. Defaults to "block".\n
+            merge (callable, optional): merge(old, new) -> message, used by coalesce when a message replaces a queued
+            message with the same key. Defaults to keep_reset.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Overload policy "{policy}" not supported. Accepted values are: {", ".join(POLICIES)}')
+        self.max_depth = max_depth
+        self.policy = policy
+        self.merge = merge
+        self.cond = threading.Condition()
+        self.items = deque()
+        self.latest = OrderedDict()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        # Queued messages plus those taken by get() and not yet marked done with task_done()
+        self.unfinished = 0
+        # Messages marked done or dropped, every message ever queued is either unfinished or finished
+        self.finished = 0
+
+    def put(self, key, data: dict):
+        """Queues a message, applying the overload policy if the queue is full.
+
+        Args:
+            key (_type_): Coalescing key, the message's asset_id.\n
+            data (dict): Decoded message.
+        """
+        with self.cond:
+            item = (time.monotonic(), data)
+            if self.policy == "coalesce":
+                old = self.latest.pop(key, None)
+                if old is not None:
+                    # Keep the enqueue time of the replaced message so queue lag is not hidden by coalescing
+                    item = (old[0], self.merge(old[1], data) if self.merge is not None else data)
+                    self.coalesced += 1
+                elif len(self.latest) >= self.max_depth:
+                    self.latest.popitem(last=False)
+                    self.dropped += 1
+                    self.finished += 1
+                else:
+                    self.unfinished += 1
+                self.latest[key] = item
+            else:
+                if len(self.items) >= self.max_depth:
+                    if self.policy == "block":
+                        while len(self.items) >= self.max_depth and not self.closed:
+                            self.cond.wait()
+                    else:
+                        self.items.popleft()
+                        self.dropped += 1
+                        self.unfinished -= 1
+                        self.finished += 1
+                self.items.append(item)
+                self.unfinished += 1
+            self.cond.notify_all()
+
+    def get(self, timeout: float = None):
+        """Returns (enqueue_time, data) of the oldest message, or None if nothing arrived within timeout or the queue
+        was closed."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.latest or self.closed, timeout):
+                return None
+            if self.closed:
+                return None
+            if self.policy == "coalesce":
+                item = self.latest.popitem(last=False)[1]
+            else:
+                item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def task_done(self):
+        "Marks a message returned by get() as processed."
+        with self.cond:
+            self.unfinished -= 1
+            self.finished += 1
+            self.cond.notify_all()
+
+    def join(self, timeout: float = None):
+        "Blocks until every queued message was processed and marked done, returns False on timeout."
+        with self.cond:
+            return self.cond.wait_for(lambda: self.unfinished <= 0 or self.closed, timeout)
+
+    def drain(self, timeout: float = None):
+        """Blocks until the messages queued before the call were processed or dropped, returns False on timeout.
+        Unlike join() it does not wait for messages queued meanwhile, so it returns under steady traffic. Messages are
+        taken in queue order and a coalesced message only moves behind later ones when its key gets a new message, so
+        once this returns no message queued before the call for a key that received nothing since is left."""
+        with self.cond:
+            target = self.finished + self.unfinished
+            return self.cond.wait_for(lambda: self.finished >= target or self.closed, timeout)
+
+    def depth(self):
+        return len(self.items) + len(self.latest)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class LagMonitor:
+    """Tracks consumer lag of a stage and periodically publishes it with the queue depths and drop counts."""
+
+    def __init__(self, stage: str, handler, queue: StageQueue, topic: str, interval: float, counts=None):
+        """
+        Args:
+            stage (str): Name reported in the metrics, the stage's client_id.\n
+            handler (_type_): The stage's message_handler.Handler, used to read paho's queue depth and to publish.\n
+            queue (StageQueue): The stage's inbound queue.\n
+            topic (str): Topic to publish metrics to.\n
+            interval (float): Seconds between metrics messages.\n
+            counts (callable, optional): Returns a dict of extra stage counters added to the metrics. Defaults to None.
+        """
+        self.stage = stage
+        self.handler = handler
+        self.queue = queue
+        self.topic = topic
+        self.interval = interval
+        self.counts = counts
+        self.next_report = time.monotonic() + interval
+        self.processed = 0
+        self.rejected = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.age = None
+
+    def record(self, enqueue_time: float, data: dict, publish_rc: int = 0):
+        """Records one processed message.
+
+        Args:
+            enqueue_time (float): time.monotonic() when the message was queued.\n
+            data (dict): The message, its unix_timestamp gives the end to end age.\n
+            publish_rc (int, optional): rc of the stage's publish, non zero when paho rejected it. Defaults to 0.
+        """
+        now = time.monotonic()
+        lag = now - enqueue_time
+        self.processed += 1
+        self.lag_sum += lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+        if publish_rc != 0:
+            self.rejected += 1
+        timestamp = data.get("unix_timestamp")
+        if timestamp:
+            self.age = time.time() - timestamp
+        self.tick(now)
+
+    def tick(self, now: float = None):
+        "Publishes metrics if the interval has passed, also called while idle so a stalled stage keeps reporting."
+        if now is None:
+            now = time.monotonic()
+        if now >= self.next_report:
+            self.report(now)
+
+    def report(self, now: float):
+        metrics = {
+            "stage": self.stage,
+            "unix_timestamp": time.time(),
+            "processed": self.processed,
+            "inbound_depth": self.queue.depth(),
+            "outbound_depth": self.handler.outbound_depth(),
+            "queue_lag_ms_avg": 1000 * self.lag_sum / self.processed if self.processed else 0.0,
+            "queue_lag_ms_max": 1000 * self.lag_max,
+            "age_ms": 1000 * self.age if self.age is not None else None,
+            "dropped": self.queue.dropped,
+            "coalesced": self.queue.coalesced,
+            "rejected": self.rejected
+        }
+        if self.counts is not None:
+            metrics.update(self.counts())
+        self.handler.client.publish(self.topic, json.dumps(metrics), 0)
+        self.next_report = now + self.interval
+        self.processed = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
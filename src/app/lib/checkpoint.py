@@ -0,0 +1,84 @@
+"""
+Periodic snapshots of a stage's per-asset state, so a restarted stage resumes where it stopped instead of at the
+origin.
+
+A stage collects {asset_id: state} from its Transformer/Tracking objects (get_state()) at most once per interval and
+writes it to a local JSON file. The file is written to a temporary file first and then renamed over the old one, so a
+crash during a write leaves the previous snapshot intact. On start the stage loads the file and hands each asset's state
+to set_state() when it creates the asset's objects.
+
+Each worker of a sharded stage (see sharding.py) writes its own file, <path stem>.<shard><suffix>. A worker loads the
+files of all the stage's workers and the newest state of every asset wins, so the assets are found again when the
+number of workers changed between runs.
+"""
+
+import glob
+import json
+import os
+import time
+
+DEFAULT_CHECKPOINT = {
+    "path": None,
+    "interval": 1.0
+}
+
+
+def shard_path(path: str, shard: int):
+    "Snapshot file of one worker of a sharded stage."
+    root, suffix = os.path.splitext(path)
+    return f"{root}.{shard}{suffix}"
+
+
+class Checkpoint:
+    def __init__(self, path: str, interval: float = 1.0, shard: int = None):
+        """
+        Args:
+            path (str): Snapshot file. None disables checkpointing.\n
+            interval (float, optional): Minimum seconds between snapshots. Defaults to 1.0.\n
+            shard (int, optional): Worker index of a sharded stage, its snapshot file is shard_path(path, shard).
+            Defaults to None.
+        """
+        self.stage_path = path
+        self.path = path if path is None or shard is None else shard_path(path, shard)
+        self.interval = interval
+        self.next_save = time.monotonic() + interval
+        self.saves = 0
+
+    def load(self):
+        """Returns {asset_id: state} of the last snapshots of the stage, empty if there is none. The snapshots of all
+        the stage's workers are read, the newest one wins for an asset found in several."""
+        if self.stage_path is None:
+            return {}
+        root, suffix = os.path.splitext(self.stage_path)
+        snapshots = []
+        for path in [self.stage_path] + glob.glob(f"{glob.escape(root)}.*{suffix}"):
+            if os.path.exists(path):
+                with open(path) as checkpoint_file:
+                    snapshots.append(json.load(checkpoint_file))
+        states = {}
+        for snapshot in sorted(snapshots, key=lambda snapshot: snapshot["unix_timestamp"]):
+            # Stored as [asset_id, state] pairs, asset ids are not necessarily strings
+            states.update((asset_id, state) for asset_id, state in snapshot["assets"])
+        return states
+
+    def tick(self, snapshot, now: float = None):
+        """Saves snapshot() if the interval has passed. Called after every processed message and while idle.
+
+        Args:
+            snapshot (callable): Returns {asset_id: state} of the stage.\n
+            now (float, optional): time.monotonic(). Defaults to None.
+        """
+        if self.path is None:
+            return
+        if now is None:
+            now = time.monotonic()
+        if now >= self.next_save:
+            self.save(snapshot())
+            self.next_save = now + self.interval
+
+    def save(self, states: dict):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump({"unix_timestamp": time.time(), "assets": list(states.items())}, checkpoint_file)
+        os.replace(tmp_path, self.path)
+        self.saves += 1
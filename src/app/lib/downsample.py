@@ -0,0 +1,114 @@
+"""
+Shape preserving downsampling of x,y paths.
+Used to keep an entire run's path visible on the graph with a bounded number of vertices.
+"""
+
+
+def lttb(x_values: list, y_values: list, threshold: int):
+    """Largest-Triangle-Three-Buckets downsampling. Keeps the first and last point and, for every bucket in between,
+    the point that forms the largest triangle with the previously kept point and the average of the next bucket.
+
+    Args:
+        x_values (list): x coordinates of the path, in order.\n
+        y_values (list): y coordinates of the path, in order.\n
+        threshold (int): Number of points to keep.
+
+    Returns:
+        tuple: (x list, y list) of the kept points.
+    """
+    n = len(x_values)
+    if threshold >= n or threshold < 3:
+        return list(x_values), list(y_values)
+
+    out_x = [x_values[0]]
+    out_y = [y_values[0]]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # Average point of the next bucket
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        count = next_end - next_start
+        avg_x = sum(x_values[next_start:next_end]) / count
+        avg_y = sum(y_values[next_start:next_end]) / count
+
+        # Point in this bucket with the largest triangle area
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax = x_values[a]
+        ay = y_values[a]
+        max_area = -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (y_values[j] - ay) - (ax - x_values[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                a_next = j
+        out_x.append(x_values[a_next])
+        out_y.append(y_values[a_next])
+        a = a_next
+
+    out_x.append(x_values[-1])
+    out_y.append(y_values[-1])
+    return out_x, out_y
+
+
+class TieredTrail:
+    """
+    Holds the older part of a path as a list of tiers, the first tier being the most recent. Points enter the first
+    tier at full resolution. When a tier overflows it is downsampled with lttb() and moved onto the newest end of the
+    next, older tier. The oldest tier is downsampled in place, so the whole run stays visible while the total vertex
+    count never exceeds tiers * tier_length.
+    """
+    def __init__(self, tier_length: int, tiers: int, factor: int = 4):
+        """
+        Args:
+            tier_length (int): Maximum number of points held by each tier.\n
+            tiers (int): Number of tiers.\n
+            factor (int, optional): Reduction applied when a tier is moved to the next. Defaults to 4.
+        """
+        self.tier_length = tier_length
+        self.factor = factor
+        self.tiers = [([], []) for _ in range(tiers)]
+
+    def append(self, x, y):
+        if not self.tiers:
+            return
+        xs, ys = self.tiers[0]
+        xs.append(x)
+        ys.append(y)
+        if len(xs) > self.tier_length:
+            self.compact(0)
+
+    def compact(self, i: int):
+        xs, ys = self.tiers[i]
+        if i + 1 < len(self.tiers):
+            dx, dy = lttb(xs, ys, max(3, self.tier_length // self.factor))
+            older_x, older_y = self.tiers[i + 1]
+            older_x.extend(dx)
+            older_y.extend(dy)
+            xs.clear()
+            ys.clear()
+            if len(older_x) > self.tier_length:
+                self.compact(i + 1)
+        else:
+            dx, dy = lttb(xs, ys, max(3, self.tier_length // 2))
+            xs[:] = dx
+            ys[:] = dy
+
+    def points(self):
+        """Returns (x list, y list) of the whole history, oldest point first."""
+        x_values = []
+        y_values = []
+        for xs, ys in reversed(self.tiers):
+            x_values.extend(xs)
+            y_values.extend(ys)
+        return x_values, y_values
+
+    def clear(self):
+        for xs, ys in self.tiers:
+            xs.clear()
+            ys.clear()
+
+    def __len__(self):
+        return sum(len(xs) for xs, _ in self.tiers)
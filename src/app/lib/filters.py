@@ -1,9 +1,419 @@
-# Class to hold all the different math functions along with filter added versions that get applied at different stages 
-# of the data transformation.
-# NOT IMPLEMENTED
+"""
+Streaming filters applied at the raw->linear and linear->location stages.
 
-class Filters():
-    def __init__(self) -> None:
+config.json selects an ordered list of filters for each stage with "filter_chain", e.g.
+    [{"type": "dps"}, {"type": "median", "k": 3}, {"type": "ema", "alpha": 0.5}]
+Each stage builds one FilterChain per channel (per wheel), so every filter instance holds the state of one channel.
+
+Every filter has:
+- update(value, sample): filters one value in O(1) using state preallocated in __init__.
+- batch(values, samples): filters a NumPy array of consecutive values, vectorized where the filter allows it. It
+  continues from, and leaves behind, the same state as calling update() on each value.
+sample is the dict the value was read from (the sensor block at raw->linear, the message at linear->location) and
+samples the same fields as arrays. Only the complementary filter reads it.
+"""
+
+import math
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+def dps_filter_value(dps: float, wheel: str, cutoff: float, cutoff_multiplier: float, additive_factor: float,
+                     percentage: float, left_wheel_exponent: float, right_wheel_exponent: float):
+    """
+    Filter the raw gyroscope DPS reading, return filtered DPS.
+    Low-Bandwidth filter nullifies gyroscope noise/drift.
+    Sensor Difference Filter attempts to balance the variance of each sensor.
+        - These values and transformations were determined from testing specific sensors
+    """
+    final_dps_ = 0.0
+
+    # LOW BANDWIDTH FILTER
+    if abs(dps) > cutoff:
+        final_dps_ = dps
+
+    # SENSOR DIFFERENCE FILTER
+    if abs(dps) > (cutoff * cutoff_multiplier):
+        # augmented 1/X applies more correction to slow-moving wheels
+        if "left" in wheel:
+            final_dps_ += ((cutoff + additive_factor) ** left_wheel_exponent / final_dps_)
+            final_dps_ -= (final_dps_ * percentage)
+        if "right" in wheel:
+            final_dps_ += ((cutoff + additive_factor) ** right_wheel_exponent / final_dps_)
+            final_dps_ += (final_dps_ * percentage)
+
+    return final_dps_
+
+
+def first_order_recurrence(a, b, y0: float, block: int = 32):
+    """Vectorized y[k] = a[k] * y[k-1] + b[k] with y[-1] = y0. Solved in blocks with cumulative products so the
+    products do not underflow, blocks containing a zero coefficient are solved with a loop."""
+    a = np.broadcast_to(np.asarray(a, dtype=float), np.shape(b))
+    b = np.asarray(b, dtype=float)
+    y = np.empty_like(b)
+    prev = y0
+    for start in range(0, len(b), block):
+        a_blk = a[start:start + block]
+        b_blk = b[start:start + block]
+        if np.all(a_blk != 0):
+            p = np.cumprod(a_blk)
+            y_blk = p * (prev + np.cumsum(b_blk / p))
+        else:
+            y_blk = np.empty_like(b_blk)
+            for i in range(len(b_blk)):
+                prev = a_blk[i] * prev + b_blk[i]
+                y_blk[i] = prev
+        y[start:start + block] = y_blk
+        prev = y_blk[-1]
+    return y
+
+
+class Filter(ABC):
+    @abstractmethod
+    def update(self, value: float, sample: dict = None):
+        "Filters one value, see the module docstring."
+
+    def batch(self, values, samples: dict = None):
+        "Fallback batch variant for filters that can not be vectorized."
+        out = np.empty(len(values))
+        for i, value in enumerate(values):
+            out[i] = self.update(float(value))
+        return out
+
+    def reset(self):
         pass
-    
-    # TODO: Write optional filter versions of basic math functions needed in raw_to_linear.py and linear_to_location.py
\ No newline at end of file
+
+
+class DpsFilter(Filter):
+    """The original raw_to_linear.Transformer dps_filter as a chain element. Stateless."""
+
+    def __init__(self, wheel: str, cutoff: float = 1.0, cutoff_multiplier: float = 2, additive_factor: float = 0.4,
+                 percentage: float = 0.0045, left_wheel_exponent: float = 2, right_wheel_exponent: float = 2):
+        self.wheel = wheel
+        self.cutoff = cutoff
+        self.cutoff_multiplier = cutoff_multiplier
+        self.additive_factor = additive_factor
+        self.percentage = percentage
+        self.left_wheel_exponent = left_wheel_exponent
+        self.right_wheel_exponent = right_wheel_exponent
+
+    def update(self, value, sample=None):
+        return dps_filter_value(value, self.wheel, self.cutoff, self.cutoff_multiplier, self.additive_factor,
+                                self.percentage, self.left_wheel_exponent, self.right_wheel_exponent)
+
+    def batch(self, values, samples=None):
+        values = np.asarray(values, dtype=float)
+        magnitude = np.abs(values)
+        out = np.where(magnitude > self.cutoff, values, 0.0)
+        corrected = magnitude > (self.cutoff * self.cutoff_multiplier)
+        if "left" in self.wheel:
+            exponent, sign = self.left_wheel_exponent, -1.0
+        elif "right" in self.wheel:
+            exponent, sign = self.right_wheel_exponent, 1.0
+        else:
+            return out
+        with np.errstate(divide='ignore', invalid='ignore'):
+            adjusted = out + (self.cutoff + self.additive_factor) ** exponent / out
+            adjusted = adjusted + sign * adjusted * self.percentage
+        return np.where(corrected, adjusted, out)
+
+
+class MovingAverage(Filter):
+    """Mean of the last k values, the mean of all values so far until k have been seen."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.window = [0.0] * k
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def update(self, value, sample=None):
+        if self.count == self.k:
+            self.total -= self.window[self.index]
+        else:
+            self.count += 1
+        self.window[self.index] = value
+        self.total += value
+        self.index = (self.index + 1) % self.k
+        return self.total / self.count
+
+    def history(self):
+        "Values in the window, oldest first."
+        if self.count < self.k:
+            return self.window[:self.count]
+        return self.window[self.index:] + self.window[:self.index]
+
+    def batch(self, values, samples=None):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return values.copy()
+        history = self.history()
+        h = len(history)
+        extended = np.concatenate([np.asarray(history, dtype=float), values])
+        sums = np.concatenate([[0.0], np.cumsum(extended)])
+        ends = np.arange(h + 1, h + len(values) + 1)
+        starts = np.maximum(0, ends - self.k)
+        out = (sums[ends] - sums[starts]) / (ends - starts)
+        # Carry the window forward
+        tail = extended[-self.k:]
+        self.window = [0.0] * self.k
+        self.window[:len(tail)] = tail.tolist()
+        self.count = len(tail)
+        self.index = len(tail) % self.k
+        self.total = float(tail.sum())
+        return out
+
+    def reset(self):
+        self.window = [0.0] * self.k
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+
+class Median(Filter):
+    """Median of the last k values, removes single sample spikes. k is small so sorting the window is O(1)."""
+
+    def __init__(self, k: int = 3):
+        self.k = k
+        self.window = [0.0] * k
+        self.index = 0
+        self.count = 0
+
+    def update(self, value, sample=None):
+        self.window[self.index] = value
+        self.index = (self.index + 1) % self.k
+        if self.count < self.k:
+            self.count += 1
+            ordered = sorted(self.window[:self.count])
+        else:
+            ordered = sorted(self.window)
+        return ordered[len(ordered) // 2]
+
+    def batch(self, values, samples=None):
+        values = np.asarray(values, dtype=float)
+        # The first k - 1 values see a partially filled window, those are filtered one by one
+        head = min(len(values), max(0, self.k - self.count - 1))
+        out = np.empty(len(values))
+        for i in range(head):
+            out[i] = self.update(float(values[i]))
+        if head == len(values):
+            return out
+        if self.count < self.k:
+            history = self.window[:self.count]
+        else:
+            history = self.window[self.index:] + self.window[:self.index]
+        # The last k - 1 values of the window, none for k = 1 (history[-0:] would be all of it)
+        extended = np.concatenate([np.asarray(history[len(history) - (self.k - 1):], dtype=float), values[head:]])
+        windows = np.lib.stride_tricks.sliding_window_view(extended, self.k)
+        out[head:] = np.sort(windows, axis=1)[:, self.k // 2]
+        tail = extended[-self.k:]
+        self.window = tail.tolist()
+        self.index = 0
+        self.count = self.k
+        return out
+
+    def reset(self):
+        self.window = [0.0] * self.k
+        self.index = 0
+        self.count = 0
+
+
+class Ema(Filter):
+    """Exponential moving average, y = y + alpha * (x - y). The first value initializes y."""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.y = None
+
+    def update(self, value, sample=None):
+        if self.y is None:
+            self.y = value
+        else:
+            self.y += self.alpha * (value - self.y)
+        return self.y
+
+    def batch(self, values, samples=None):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return values.copy()
+        y0 = values[0] if self.y is None else self.y
+        out = first_order_recurrence(1.0 - self.alpha, self.alpha * values, y0)
+        self.y = float(out[-1])
+        return out
+
+    def reset(self):
+        self.y = None
+
+
+class Complementary(Filter):
+    """
+    Complementary filter for a wheel mounted sensor. Gravity rotates through the sensor's x,y plane as the wheel turns,
+    so the accelerometer gives a drift free but noisy wheel angle, and the gyro a smooth angle that drifts. The wheel
+    angle is estimated as angle = alpha * (angle + dps * dt) + (1 - alpha) * accelerometer_angle and the filtered DPS
+    is the change of that angle over dt. Requires accX, accY and timestamp in the sample, values pass through
+    unchanged when the accelerometer is not streamed (gyro_only) or on the first sample.
+    """
+
+    def __init__(self, alpha: float = 0.98):
+        self.alpha = alpha
+        self.angle = None
+        self.acc_angle = 0.0
+        self.last_raw = 0.0
+        self.timestamp = None
+
+    def unwrapped_acc_angle(self, acc_x: float, acc_y: float):
+        # The sensor turns opposite to the gravity vector seen in its frame
+        raw = -math.degrees(math.atan2(acc_y, acc_x))
+        delta = (raw - self.last_raw + 180.0) % 360.0 - 180.0
+        self.last_raw = raw
+        self.acc_angle += delta
+        return self.acc_angle
+
+    def update(self, value, sample=None):
+        if sample is None or (sample.get("accX", 0.0) == 0.0 and sample.get("accY", 0.0) == 0.0):
+            return value
+        acc_angle = self.unwrapped_acc_angle(sample["accX"], sample["accY"])
+        timestamp = sample["timestamp"]
+        if self.angle is None or timestamp <= self.timestamp:
+            self.angle = acc_angle
+            self.timestamp = timestamp
+            return value
+        dt = timestamp - self.timestamp
+        previous = self.angle
+        self.angle = self.alpha * (self.angle + value * dt) + (1 - self.alpha) * acc_angle
+        self.timestamp = timestamp
+        return (self.angle - previous) / dt
+
+    def batch(self, values, samples=None):
+        values = np.asarray(values, dtype=float)
+        if samples is None or len(values) < 2 or self.angle is None:
+            return super().batch(values, samples) if samples is None else self.batch_loop(values, samples)
+        acc_x = np.asarray(samples["accX"], dtype=float)
+        acc_y = np.asarray(samples["accY"], dtype=float)
+        timestamps = np.asarray(samples["timestamp"], dtype=float)
+        if np.any((acc_x == 0.0) & (acc_y == 0.0)) or np.any(np.diff(timestamps) <= 0) or timestamps[0] <= self.timestamp:
+            return self.batch_loop(values, samples)
+        raw = -np.degrees(np.arctan2(acc_y, acc_x))
+        deltas = (np.diff(np.concatenate([[self.last_raw], raw])) + 180.0) % 360.0 - 180.0
+        acc_angles = self.acc_angle + np.cumsum(deltas)
+        dt = np.diff(np.concatenate([[self.timestamp], timestamps]))
+        angles = first_order_recurrence(self.alpha, self.alpha * values * dt + (1 - self.alpha) * acc_angles, self.angle)
+        out = np.diff(np.concatenate([[self.angle], angles])) / dt
+        self.angle = float(angles[-1])
+        self.acc_angle = float(acc_angles[-1])
+        self.last_raw = float(raw[-1])
+        self.timestamp = float(timestamps[-1])
+        return out
+
+    def batch_loop(self, values, samples):
+        out = np.empty(len(values))
+        for i in range(len(values)):
+            sample = {key: float(column[i]) for key, column in samples.items()}
+            out[i] = self.update(float(values[i]), sample)
+        return out
+
+    def reset(self):
+        self.angle = None
+        self.acc_angle = 0.0
+        self.last_raw = 0.0
+        self.timestamp = None
+
+
+class Kalman(Filter):
+    """1D Kalman filter with a constant value model, e.g. for wheel DPS.
+    q is the process noise (how fast the true value changes), r the measurement noise."""
+
+    def __init__(self, q: float = 0.5, r: float = 4.0):
+        self.q = q
+        self.r = r
+        self.x = None
+        self.p = r
+
+    def update(self, value, sample=None):
+        if self.x is None:
+            self.x = value
+            return self.x
+        self.p += self.q
+        gain = self.p / (self.p + self.r)
+        self.x += gain * (value - self.x)
+        self.p *= (1 - gain)
+        return self.x
+
+    def batch(self, values, samples=None):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return values.copy()
+        if self.x is None:
+            self.x = float(values[0])
+            return np.concatenate([[self.x], self.batch(values[1:])])
+        # The gains do not depend on the measurements, they are computed first and the state then solved in one go
+        gains = np.empty(len(values))
+        p = self.p
+        for i in range(len(values)):
+            p += self.q
+            gains[i] = p / (p + self.r)
+            p *= (1 - gains[i])
+        self.p = p
+        out = first_order_recurrence(1.0 - gains, gains * values, self.x)
+        self.x = float(out[-1])
+        return out
+
+    def reset(self):
+        self.x = None
+        self.p = self.r
+
+
+FILTERS = {
+    "dps": DpsFilter,
+    "moving_average": MovingAverage,
+    "median": Median,
+    "ema": Ema,
+    "complementary": Complementary,
+    "kalman": Kalman,
+}
+
+
+class FilterChain:
+    """Ordered list of filters for one channel, each filter's output is the next one's input."""
+
+    def __init__(self, filters: list):
+        self.filters = filters
+        # The usual single filter chain calls the filter directly, without creating a loop iterator per value
+        if len(filters) == 1:
+            self.update = filters[0].update
+
+    def update(self, value: float, sample: dict = None):
+        for f in self.filters:
+            value = f.update(value, sample)
+        return value
+
+    def batch(self, values, samples: dict = None):
+        values = np.asarray(values, dtype=float)
+        for f in self.filters:
+            values = f.batch(values, samples)
+        return values
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+
+
+def build_chain(spec: list, wheel: str, dps: dict = None):
+    """Builds a FilterChain from a config.json filter_chain list.
+
+    Args:
+        spec (list): Filter configs, each a dict with "type" (a key of FILTERS) and the filter's parameters.\n
+        wheel (str): left | right, the channel the chain filters.\n
+        dps (dict, optional): Default parameters for dps filters, overridden by the parameters in spec. Defaults to None.
+    """
+    filters = []
+    for config in spec:
+        params = dict(config)
+        name = params.pop("type")
+        if name not in FILTERS:
+            raise KeyError(f'Filter "{name}" not supported. Accepted values are: {", ".join(FILTERS)}')
+        if name == "dps":
+            params = {**(dps or {}), **params, "wheel": wheel}
+        filters.append(FILTERS[name](**params))
+    return FilterChain(filters)
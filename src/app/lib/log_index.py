@@ -0,0 +1,167 @@
+"""
+Sparse sidecar index of a JSON lines log (location_to_log.py), for replaying or exporting a time range without reading
+the log from the start.
+
+Every `every` records the index stores the byte offset of the record, together with the largest unix_timestamp and
+seq of all the records before it. Records of several assets are not strictly ordered, the running maxima make a seek
+safe anyway: every record before the chosen offset is older than the requested time. A seek is a binary search in the
+index followed by a bounded forward read.
+
+The index is written next to the log as <log_path>.idx, while the log is written (LocationToLog) or afterwards for an
+existing log: python3 -m app.lib.log_index [log_path] [every]
+"""
+
+import json
+import os
+import re
+import struct
+import numpy as np
+
+INDEX_SUFFIX = ".idx"
+MAGIC = b"LOGIDX1\n"
+PREAMBLE = struct.Struct("<I")
+# offset, largest unix_timestamp and largest seq before the record at offset
+ENTRY = np.dtype([("offset", "<u8"), ("timestamp", "<f8"), ("seq", "<i8")])
+# Values are read with a regex instead of parsing every line when an existing log is indexed
+TIMESTAMP = re.compile(rb'"unix_timestamp":\s*(-?[0-9.eE+-]+)')
+SEQ = re.compile(rb'"seq":\s*(-?\d+)')
+
+
+def record_keys(line: bytes):
+    "unix_timestamp and seq of a log line, -inf and -1 when the record has none."
+    timestamp = TIMESTAMP.search(line)
+    seq = SEQ.search(line)
+    return (float(timestamp.group(1)) if timestamp else -np.inf), (int(seq.group(1)) if seq else -1)
+
+
+class IndexWriter:
+    def __init__(self, log_path: str, every: int = 1000):
+        """Continues the index of log_path, rebuilding it if it is missing and the log is not empty.
+
+        Args:
+            log_path (str): JSON lines log being appended to.\n
+            every (int, optional): Records between index entries. Defaults to 1000.
+        """
+        self.index_path = log_path + INDEX_SUFFIX
+        self.every = every
+        self.offset = 0
+        self.count = 0
+        # Record count at which the next entry is written
+        self.next_entry = 0
+        self.timestamp = -np.inf
+        self.seq = -1
+        entries = load_entries(self.index_path, every) if os.path.exists(log_path) else None
+        # An index that points past the end of the log belongs to a log that was replaced
+        if entries is None or not len(entries) or entries[-1]["offset"] > os.path.getsize(log_path):
+            self.file = open(self.index_path, 'wb')
+            self.file.write(MAGIC + PREAMBLE.pack(every))
+        else:
+            # Start from the last entry, the records after it are read back to restore the running state
+            self.file = open(self.index_path, 'ab')
+            last = entries[-1]
+            self.offset = int(last["offset"])
+            self.timestamp = float(last["timestamp"])
+            self.seq = int(last["seq"])
+            self.count = (len(entries) - 1) * every
+            self.next_entry = self.count + every
+        if os.path.exists(log_path):
+            with open(log_path, 'rb') as log_file:
+                log_file.seek(self.offset)
+                for line in log_file:
+                    if not line.endswith(b'\n'):
+                        break
+                    self.add(line, *record_keys(line))
+        self.file.flush()
+
+    def add(self, line: bytes, timestamp: float, seq: int):
+        "Accounts for a line appended to the log, writing an index entry every `every` records."
+        if self.count == self.next_entry:
+            np.array([(self.offset, self.timestamp, self.seq)], dtype=ENTRY).tofile(self.file)
+            self.next_entry += self.every
+        self.count += 1
+        self.offset += len(line)
+        if timestamp > self.timestamp:
+            self.timestamp = timestamp
+        if seq > self.seq:
+            self.seq = seq
+
+    def record(self, line: str, data: dict):
+        "add() for a record written by the logger, whose values are known without parsing the line."
+        timestamp = data.get("unix_timestamp")
+        seq = data.get("seq")
+        self.add(line.encode(), -np.inf if timestamp is None else timestamp, -1 if seq is None else seq)
+
+    def close(self):
+        self.file.close()
+
+
+def load_entries(index_path: str, every: int = None):
+    "Entries of an index file, None if there is none or it was built with a different every."
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'rb') as index_file:
+        if index_file.read(len(MAGIC)) != MAGIC:
+            return None
+        (index_every,) = PREAMBLE.unpack(index_file.read(PREAMBLE.size))
+        if every is not None and index_every != every:
+            return None
+        data = index_file.read()
+    # A partially written last entry is ignored
+    return np.frombuffer(data[:len(data) - len(data) % ENTRY.itemsize], dtype=ENTRY)
+
+
+def build_index(log_path: str, every: int = 1000):
+    "Indexes an existing log from scratch."
+    if os.path.exists(log_path + INDEX_SUFFIX):
+        os.remove(log_path + INDEX_SUFFIX)
+    IndexWriter(log_path, every).close()
+
+
+def seek_offset(log_path: str, start: float = None, seq: int = None):
+    """Offset in the log from which every record with unix_timestamp >= start (or seq >= seq) follows. 0 when the log
+    has no index."""
+    entries = load_entries(log_path + INDEX_SUFFIX)
+    if entries is None or not len(entries):
+        return 0
+    if start is not None:
+        # Last entry where every record before it is older than start
+        position = np.searchsorted(entries["timestamp"], start, side='left') - 1
+    elif seq is not None:
+        position = np.searchsorted(entries["seq"], seq, side='left') - 1
+    else:
+        return 0
+    return int(entries["offset"][max(position, 0)])
+
+
+def read_window(log_path: str, start: float = None, end: float = None, seq: int = None, max_records: int = None):
+    """Yields the records of the log from start (unix_timestamp) or seq, until end or max_records, seeking with the
+    index instead of reading from the beginning.
+
+    Args:
+        log_path (str): JSON lines log.\n
+        start (float, optional): First unix_timestamp. Defaults to None, the beginning.\n
+        end (float, optional): Records after this unix_timestamp end the window. Defaults to None, the end of the log.\n
+        seq (int, optional): First seq, used when start is None. Defaults to None.\n
+        max_records (int, optional): Most records yielded. Defaults to None.
+    """
+    yielded = 0
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(seek_offset(log_path, start, seq))
+        for line in log_file:
+            data = json.loads(line)
+            timestamp = data.get("unix_timestamp")
+            if start is not None and timestamp is not None and timestamp < start:
+                continue
+            if start is None and seq is not None and data.get("seq", seq) < seq:
+                continue
+            if end is not None and timestamp is not None and timestamp > end:
+                break
+            yield data
+            yielded += 1
+            if max_records is not None and yielded >= max_records:
+                break
+
+
+if __name__ == '__main__':
+    from sys import argv
+    build_index(argv[1], int(argv[2]) if len(argv) > 2 else 1000)
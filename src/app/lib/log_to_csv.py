@@ -1,15 +1,25 @@
 # Converts the .log files created by location_to_log.py into csv files.
 # Either supply the path of .log file as a cli arg: python3 log_to_csv.py [path_to_file.log]
 # or the path specified in config.json initialize.py: { log_data: { log_path: "path_to_file.log" } } will be used.
+# --start/--end (unix_timestamp) or --seq with --max-records convert only a window of the log, located with its sidecar
+# index (log_index.py) when it has one: python3 log_to_csv.py [path_to_file.log] --start 1700000000 --end 1700000300
 
-import json, csv
-from sys import argv
+import argparse, json, csv
+# Run as a script from this folder, log_index.py sits next to it
+from log_index import read_window
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log_file_path', nargs='?')
+    parser.add_argument('--start', type=float, help='First unix_timestamp converted.')
+    parser.add_argument('--end', type=float, help='Last unix_timestamp converted.')
+    parser.add_argument('--seq', type=int, help='First seq converted, when --start is not given.')
+    parser.add_argument('--max-records', type=int)
+    args = parser.parse_args()
     log_file_path = None
     
-    if len(argv) > 1:
-        log_file_path = argv[1]
+    if args.log_file_path:
+        log_file_path = args.log_file_path
     else:
         with open('../../config.json') as config_file:
             config = json.load(config_file)
@@ -17,8 +27,7 @@ if __name__ == '__main__':
         log_file_path = '../' + config['initialize.py']["log_data"]["log_path"]
     
     
-    with open (log_file_path) as log_file:
-        Lines = log_file.readlines()
+    records = read_window(log_file_path, args.start, args.end, args.seq, args.max_records)
     
     
     csv_file_path =  log_file_path.split('.log')[0] + '.csv'
@@ -27,8 +36,7 @@ if __name__ == '__main__':
         writer = csv.writer(csv_file)
         writer.writerow(['Start_Time', 'LW_Dis', 'RW_Dis', 'LW_Total', 'RW_Total', 'Unix_Timestamp', 'X_Loc', 'Y_Loc', 'Heading', 'Reset', 'L-AccX', 'L-AccY', 'L-AccZ', 'L-GyroX', 'L-GyroY', 'L-GyroZ', 'L-Timestamp', 'R-AccX', 'R-AccY', 'R-AccZ', 'R-GyroX', 'R-GyroY', 'R-GyroZ', 'R-Timestamp' ])
         
-        for line in Lines:
-            data = json.loads(line)
+        for data in records:
             writer.writerow(
                 [data['start_time'],
                  data['LW_dis'],
@@ -5,16 +5,26 @@ Process to handle log messages.
 from multiprocessing import Process
 import logging
 import logging.handlers
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
 import sys
 import traceback
 
 
 class Logger(Process):
-    def __init__(self, queue):
+    def __init__(self, queue, profiling:dict=None):
+        """
+        Args:
+            queue (multiprocessing Queue): Log records of all processes, None stops the process.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
         Process.__init__(self)
         self.queue = queue
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
 
     def run(self):
+        SamplingProfiler('logger', **self.profiling_config).install()
         
         root = logging.getLogger()
         h = logging.StreamHandler()
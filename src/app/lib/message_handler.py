@@ -7,6 +7,34 @@ from paho.mqtt.client import Client, MQTTv5
 import paho.mqtt.properties as properties
 import logging
 
+# Transport settings used when a Handler is not given a profile, or a profile leaves a setting out.
+# Named profiles are defined under "transport_profiles" in config.json.
+DEFAULT_TRANSPORT = {
+    "qos": 1,
+    "max_inflight_messages": 20,
+    "max_queued_messages": 0,
+    "keepalive": 60,
+    "session_expiry": 300,
+    "clean_start": False
+}
+
+
+def transport_profile(config: dict, name: str = None):
+    """Returns the named transport profile from config.json merged over DEFAULT_TRANSPORT.
+
+    Args:
+        config (dict): The whole config.json object.\n
+        name (str, optional): Profile name in config["transport_profiles"]. Defaults to None, which returns the defaults.
+    """
+    profile = dict(DEFAULT_TRANSPORT)
+    if name is not None:
+        profiles = config.get("transport_profiles", {})
+        if name not in profiles:
+            raise KeyError(f'Transport profile "{name}" not found in config.json "transport_profiles"')
+        profile.update(profiles[name])
+    return profile
+
+
 class Handler():
     """
     Configures and initializes a paho client and offers some wrapper functions for connecting to a broker, starting
@@ -16,16 +44,20 @@ class Handler():
     will be called for specific topic filters, otherwise the default on_message callback will be used.
     """
 
-    def __init__(self, client_id: str, topic_sub: str, topic_pub: str = None, userdata=None, host='localhost', port=1883, qos= 1):
+    def __init__(self, client_id: str, topic_sub, topic_pub: str = None, userdata=None, host='localhost', port=1883, qos=None, on_ready=None, transport: dict = None):
         """
         Args:
             client_id (str): Name of this process for use by Mosquitto msg broker.\n
-            topic_sub (str): Broker topic to subscribe to.\n
+            topic_sub (str | list): Broker topic, or list of topics, to subscribe to.\n
             topic_pub (str, optional): Broker topic to publish to. Defaults to None\n
             userdata (_type_, optional): Context to hang userdata on. Defaults to None.\n
             host (str, optional): IP address of Mosquitto server. Defaults to 'localhost'.\n
             port (int, optional): Port of Mosquitto server . Defaults to 1883.\n
-            qos (int, optional): Quality of service level for messages. Defaults to 1.
+            qos (int, optional): Quality of service level for messages. Defaults to None, which uses the transport qos.\n
+            on_ready (callable, optional): Called once, with no arguments, when the client is connected and the broker
+            has acknowledged the subscription to topic_sub (SUBACK). Defaults to None.\n
+            transport (dict, optional): Transport profile, see transport_profile(). Keys left out fall back to
+            DEFAULT_TRANSPORT. Defaults to None.
         """
 
         self.client_id = client_id
@@ -34,7 +66,15 @@ class Handler():
         self.userdata = userdata
         self.host = host
         self.port = port
-        self.qos = qos
+        self.transport = dict(DEFAULT_TRANSPORT)
+        if transport is not None:
+            self.transport.update(transport)
+        self.qos = self.transport["qos"] if qos is None else qos
+        self.on_ready = on_ready
+        self.is_ready = False
+        self.subscribe_mid = None
+        # mid -> callback of the subscribe() and unsubscribe() calls waiting for the broker's acknowledgement
+        self.acknowledgements = {}
 
         # Create client
         self.client = Client(
@@ -47,7 +87,9 @@ class Handler():
         self.connect_properties = properties.Properties(
             properties.PacketTypes.CONNECT
         )
-        self.connect_properties.SessionExpiryInterval = 300
+        self.connect_properties.SessionExpiryInterval = self.transport["session_expiry"]
+        self.client.max_inflight_messages_set(self.transport["max_inflight_messages"])
+        self.client.max_queued_messages_set(self.transport["max_queued_messages"])
         self.client.username_pw_set(
             username=self.client_id,
             password="test"
@@ -58,6 +100,8 @@ class Handler():
         self.client.on_disconnect = self.__on_disconnect
         self.client.on_message = self.__on_message
         self.client.on_publish = self.__on_publish
+        self.client.on_subscribe = self.__on_subscribe
+        self.client.on_unsubscribe = self.__on_unsubscribe
 
     # Wrapper functions
 
@@ -66,14 +110,39 @@ class Handler():
         self.client.connect(
             host=self.host,
             port=self.port,
-            keepalive=60,
-            clean_start=False,
+            keepalive=self.transport["keepalive"],
+            clean_start=self.transport["clean_start"],
             properties=self.connect_properties
         )
 
-    def publish(self, payload):
-        "Wrapper for paho client.publish(), publishes to topic_pub"
-        self.client.publish(self.topic_pub, payload, self.qos)
+    def publish(self, payload, topic: str = None):
+        "Wrapper for paho client.publish(), publishes to topic, topic_pub by default. Returns paho's MQTTMessageInfo."
+        return self.client.publish(self.topic_pub if topic is None else topic, payload, self.qos)
+
+    def subscribe(self, topics: list, callback=None):
+        """Subscribes to more topics once connected. callback(reason_codes) is called with the broker's SUBACK.
+        Topics that should be renewed after a reconnect must also be added to topic_sub."""
+        result, mid = self.client.subscribe([(topic, self.qos) for topic in topics])
+        if callback is not None:
+            self.acknowledgements[mid] = callback
+        return result
+
+    def unsubscribe(self, topics: list, callback=None):
+        """Unsubscribes from topics. callback() is called with the broker's UNSUBACK, no message of topics arrives
+        after it."""
+        result, mid = self.client.unsubscribe(topics)
+        if callback is not None:
+            self.acknowledgements[mid] = callback
+        return result
+
+    def outbound_depth(self):
+        "Number of messages held by paho waiting to be sent or acknowledged, None if this paho version keeps them elsewhere."
+        # Private attributes of paho-mqtt 1.x, there is no public accessor
+        out_messages = getattr(self.client, "_out_messages", None)
+        out_packet = getattr(self.client, "_out_packet", None)
+        if out_messages is None or out_packet is None:
+            return None
+        return len(out_messages) + len(out_packet)
 
     def loop(self):
         """ Blocking form of the network loop and will not return until the client calls disconnect(). 
@@ -89,10 +158,32 @@ class Handler():
 
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        client.subscribe([
-            (self.topic_sub, self.qos)
+        topics = [self.topic_sub] if isinstance(self.topic_sub, str) else self.topic_sub
+        result, self.subscribe_mid = client.subscribe([
+            (topic, self.qos) for topic in topics
         ])
 
+    def __on_subscribe(self, client, userdata, mid, reason_codes, properties=None):
+        "Called when the broker acknowledges a subscription. The first successful SUBACK for topic_sub marks the client as ready."
+        if mid in self.acknowledgements:
+            self.acknowledgements.pop(mid)(reason_codes)
+            return
+        if mid != self.subscribe_mid:
+            return
+        if any(rc.value >= 128 for rc in reason_codes):
+            logging.error(f"MESSAGE BROKER: cid={self.client_id}, Subscription to {self.topic_sub} refused: {reason_codes}")
+            return
+        logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Subscribed to {self.topic_sub}")
+        if not self.is_ready:
+            self.is_ready = True
+            if self.on_ready is not None:
+                self.on_ready()
+
+    def __on_unsubscribe(self, client, userdata, mid, properties=None, reason_codes=None):
+        "Called when the broker acknowledges an unsubscribe()."
+        if mid in self.acknowledgements:
+            self.acknowledgements.pop(mid)()
+
     def __on_disconnect(self, client, userdata, rc, properties=None):
         if rc != 0:
             logging.debug(f"MESSAGE BROKER: cid={self.client_id}, Unexpected disconnection.")
@@ -3,18 +3,122 @@ messages.py's Message class is to be used by processes that are responsible for
  
 The initial Message.payload dictionary structure defined here is serialized and deserialized
 as it is passed through the various layers of the application. 
-Layers may add key value pairs, but they should not remove any keys. As other layers may require them and 
-enables better logging of results.    
+
+Stages publish in one of two payload modes:
+- full: layers may add key value pairs, but they should not remove any keys. As other layers may require them and 
+  enables better logging of results.
+- delta: a stage publishes only the fields it produced plus the PASS_THROUGH keys, see delta(). The seq stamped by the
+  source identifies the reading, consumers that need the full record rebuild it with a Reassembler.
+
+Readings stay the decoded payload dicts inside a stage as well. Every stage receives and publishes JSON, and a record
+with __slots__ that is converted from and to the dict at those edges was measured slower than working on the dict:
+31.5 against 26.2 us per message in the raw stage, 37.5 against 30.5 us in the linear stage when built eagerly.
 """
 
+from collections import OrderedDict
+
+PAYLOAD_MODES = ("full", "delta")
+
+# Keys every stage forwards in delta mode
+PASS_THROUGH = ("seq", "run", "asset_id", "unix_timestamp", "reset")
+
+
+def delta(data: dict, fields: tuple):
+    """Returns the delta payload of a message: the PASS_THROUGH keys and the given fields.
+
+    Args:
+        data (dict): The full message after the stage has processed it.\n
+        fields (tuple): Keys produced by the stage, keys inside a sensor block are written as "LSensor.F_dps".
+    """
+    out = {key: data[key] for key in PASS_THROUGH if key in data}
+    for field in fields:
+        if '.' in field:
+            block, key = field.split('.', 1)
+            out.setdefault(block, {})[key] = data[block][key]
+        else:
+            out[field] = data[field]
+    return out
+
+
+def merge(record: dict, part: dict):
+    "Deep merges part into record, nested dicts (the sensor blocks) are merged key by key."
+    for key, value in part.items():
+        if isinstance(value, dict) and isinstance(record.get(key), dict):
+            merge(record[key], value)
+        else:
+            record[key] = value
+    return record
+
+
+class Reassembler:
+    """
+    Rebuilds full records from the delta payloads of several stages. Parts are matched by (asset_id, seq) and merged
+    in stage order, so a later stage's value wins regardless of arrival order. A record is complete when every stage's
+    part arrived. Records of an asset older than a completed one will not complete anymore (their later parts were
+    coalesced or dropped upstream) and are returned first with the parts that did arrive.
+    Payloads without a seq (full payloads of a producer that does not stamp one) are returned unchanged.
+    """
+
+    def __init__(self, stages: int, max_pending: int = 1000):
+        """
+        Args:
+            stages (int): Number of stages whose parts make up a record.\n
+            max_pending (int, optional): Incomplete records kept before the oldest is returned as is. Defaults to 1000.
+        """
+        self.stages = stages
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+
+    def add(self, stage: int, data: dict):
+        """Adds a stage's part, returns the list of records that are done, oldest first.
+
+        Args:
+            stage (int): Index of the stage that published data, in pipeline order.\n
+            data (dict): The decoded payload.
+        """
+        seq = data.get("seq")
+        if seq is None:
+            return [data]
+        key = (data.get("asset_id"), seq)
+        parts = self.pending.get(key)
+        if parts is None:
+            parts = self.pending[key] = [None] * self.stages
+        parts[stage] = data
+
+        done = []
+        if all(part is not None for part in parts):
+            for older in [k for k in self.pending if k[0] == key[0] and k[1] < seq]:
+                done.append(self.assemble(self.pending.pop(older)))
+            done.append(self.assemble(self.pending.pop(key)))
+        while len(self.pending) > self.max_pending:
+            done.append(self.assemble(self.pending.popitem(last=False)[1]))
+        return done
+
+    def flush(self):
+        "Returns all incomplete records, used on shutdown."
+        done = [self.assemble(parts) for parts in self.pending.values()]
+        self.pending.clear()
+        return done
+
+    def assemble(self, parts: list):
+        record = {}
+        for part in parts:
+            if part is not None:
+                merge(record, part)
+        return record
+
+
 class Message():
     """
     Represents the state of a single paired data reading from a cohort of senors as well as various transformations
     to that data to turn it into location data.  
     """
-    def __init__(self, l_mac:str, r_mac:str):
+    def __init__(self, l_mac:str, r_mac:str, asset_id:str=None):
         self.flag = 0
         self.payload = {
+            "asset_id": asset_id if asset_id is not None else l_mac,
+            "seq": 0,
+            "run": 0,
             "start_time": 0.0,
             "LW_dis": 0.0,
             "RW_dis": 0.0,
@@ -55,12 +159,13 @@ class Message():
 
         Args:
             sensor (str): Name of the sensor data in the JSON message: LSensor | RSensor.\n
-            data (list): Data generated by sensors.\n
+            data (list): Data generated by sensors, [acc, gyro]. acc is None when only the gyro is streamed.\n
             timestamp (float): Time data was generated.
         """
-        self.payload[sensor]["accX"] = data[0].x
-        self.payload[sensor]["accY"] = data[0].y
-        self.payload[sensor]["accZ"] = data[0].z
+        if data[0] is not None:
+            self.payload[sensor]["accX"] = data[0].x
+            self.payload[sensor]["accY"] = data[0].y
+            self.payload[sensor]["accZ"] = data[0].z
         self.payload[sensor]["gyroX"] = data[1].x
         self.payload[sensor]["gyroY"] = data[1].y
         self.payload[sensor]["gyroZ"] = data[1].z
@@ -0,0 +1,349 @@
+"""
+Per-stage counters, latency histograms and resource usage, aggregated into one Prometheus text endpoint.
+
+Every stage process keeps a StageMetrics with:
+- counters of the messages it received, processed and published,
+- histograms of the seconds spent decoding, processing and encoding a message, and of the garbage collector's pauses,
+- gauges read when a snapshot is taken: the inbound StageQueue depth, paho's outbound queue depth, CPU seconds,
+  resident memory and the garbage collections per generation.
+The hot path adds to integers and tests a flag. The flag is raised every sample_interval by the reporting thread, the
+next message is then timed and lowers it, so about one message per sample_interval reads the clock whatever the
+message rate. This still costs about 1 to 2 % of the raw and linear stages' message cost (python3 -m
+app.Test.benchmark metrics), so metrics are off by default. Histograms have fixed power of two buckets, a value is
+counted in its bucket with math.frexp instead of a search.
+
+A daemon thread publishes a JSON snapshot of the stage to <topic>/<stage> every interval, counters are totals since the
+process started. MetricsServer subscribes to <topic>/+ and serves the latest snapshot of every stage at GET /metrics in
+the Prometheus text format, with the stage as a label, so a single scrape covers every process of the pipeline.
+"""
+
+from math import frexp
+from multiprocessing import Process
+from threading import Lock, Thread
+from sys import exit
+import app.lib.message_handler as message_handler
+from app.lib.profiling import DEFAULT_PROFILING, SamplingProfiler
+import gc, json, logging, os, signal, sys, time
+
+DEFAULT_METRICS = {
+    "enabled": False,
+    "topic": "Debug/metrics",
+    "interval": 5,
+    "sample_interval": 0.05
+}
+
+# Histogram bucket upper bounds are 2**exponent seconds, from about 1 us to 4 s, plus +Inf
+MIN_EXPONENT = -20
+MAX_EXPONENT = 2
+BUCKETS = [2.0 ** exponent for exponent in range(MIN_EXPONENT, MAX_EXPONENT + 1)]
+
+# Snapshot key, metric name and help text
+COUNTERS = (
+    ("received", "pipeline_messages_received_total", "Messages received by the stage."),
+    ("processed", "pipeline_messages_processed_total", "Messages processed by the stage."),
+    ("published", "pipeline_messages_published_total", "Messages published by the stage."),
+    ("cpu_seconds", "pipeline_cpu_seconds_total", "CPU time of the stage process, user and system."),
+)
+GAUGES = (
+    ("inbound_depth", "pipeline_inbound_queue_depth", "Messages waiting in the stage's inbound queue."),
+    ("outbound_depth", "pipeline_outbound_queue_depth", "Messages held by paho waiting to be sent or acknowledged."),
+    ("rss_bytes", "pipeline_resident_memory_bytes", "Resident memory of the stage process."),
+)
+HISTOGRAMS = (
+    ("decode_seconds", "pipeline_decode_seconds", "Time to decode a received message, sampled."),
+    ("process_seconds", "pipeline_process_seconds", "Time to process a message, sampled."),
+    ("encode_seconds", "pipeline_encode_seconds", "Time to encode a message for publishing, sampled."),
+    ("gc_pause_seconds", "pipeline_gc_pause_seconds", "Garbage collector pauses."),
+)
+
+
+class Histogram:
+    """Counts of observed seconds in the BUCKETS, and their sum."""
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        # seconds < 2**exponent, so it belongs to the bucket bounded by 2**exponent
+        index = frexp(seconds)[1] - MIN_EXPONENT if seconds > 0 else 0
+        if index < 0:
+            index = 0
+        elif index > len(BUCKETS):
+            index = len(BUCKETS)
+        self.counts[index] += 1
+        self.sum += seconds
+
+    def since(self, start: float):
+        "Observes the seconds since start, a time.perf_counter() value, and returns time.perf_counter()."
+        now = time.perf_counter()
+        self.observe(now - start)
+        return now
+
+    def state(self):
+        return {"counts": list(self.counts), "sum": self.sum}
+
+
+def rss_bytes():
+    "Resident memory of this process, the peak instead where /proc is not available, None on Windows."
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kB, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else 1024 * maxrss
+
+
+class StageMetrics:
+    """Counters and histograms of one stage process, published periodically by start()."""
+
+    def __init__(self, stage: str, handler=None, queue=None, enabled: bool = True, topic: str = "Debug/metrics", interval: float = 5, sample_interval: float = 0.05):
+        """
+        Args:
+            stage (str): Name reported in the metrics, the stage's client_id.\n
+            handler (_type_, optional): The stage's message_handler.Handler, used to read paho's queue depth and to
+            publish. Defaults to None.\n
+            queue (StageQueue, optional): The stage's inbound queue. Defaults to None.\n
+            enabled (bool, optional): Publish the metrics. When false the counters are still kept but nothing is timed.
+            Defaults to True.\n
+            topic (str, optional): Snapshots are published to topic/stage. Defaults to "Debug/metrics".\n
+            interval (float, optional): Seconds between snapshots. Defaults to 5.\n
+            sample_interval (float, optional): Seconds between timed messages. Defaults to 0.05.
+        """
+        self.stage = stage
+        self.handler = handler
+        self.queue = queue
+        self.enabled = enabled
+        self.topic = f"{topic}/{stage}"
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.received = 0
+        self.processed = 0
+        self.published = 0
+        # Raised by sample(), only while enabled, so nothing is timed when disabled
+        self.sample_receive = False
+        self.sample_process = False
+        self.decode_time = Histogram()
+        self.process_time = Histogram()
+        self.encode_time = Histogram()
+        self.gc_pause = Histogram()
+        self.gc_start = None
+        if enabled:
+            gc.callbacks.append(self.on_gc)
+
+    # Stages count every message and only call these when the flag is raised:
+    #   self.metrics.received += 1
+    #   start = self.metrics.sample_receive and self.metrics.start_receive()
+    #   ... decode ...
+    #   if start:
+    #       self.metrics.decode_time.since(start)
+    def start_receive(self):
+        "Lowers sample_receive and returns time.perf_counter(), the start of the timed message's decoding."
+        self.sample_receive = False
+        return time.perf_counter()
+
+    def start_process(self):
+        "Lowers sample_process and returns time.perf_counter(), the start of the timed message's processing."
+        self.sample_process = False
+        return time.perf_counter()
+
+    def sample(self):
+        "Has the next received and the next processed message timed."
+        self.sample_receive = True
+        self.sample_process = True
+
+    def on_gc(self, phase: str, info: dict):
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.gc_pause.observe(time.perf_counter() - self.gc_start)
+            self.gc_start = None
+
+    def snapshot(self):
+        "Counters, gauges and histograms of the stage."
+        return {
+            "stage": self.stage,
+            "unix_timestamp": time.time(),
+            "received": self.received,
+            "processed": self.processed,
+            "published": self.published,
+            "inbound_depth": self.queue.depth() if self.queue is not None else None,
+            "outbound_depth": self.handler.outbound_depth() if self.handler is not None else None,
+            "cpu_seconds": time.process_time(),
+            "rss_bytes": rss_bytes(),
+            "gc_collections": [generation["collections"] for generation in gc.get_stats()],
+            "decode_seconds": self.decode_time.state(),
+            "process_seconds": self.process_time.state(),
+            "encode_seconds": self.encode_time.state(),
+            "gc_pause_seconds": self.gc_pause.state()
+        }
+
+    def report(self):
+        "Publishes a snapshot to topic/stage."
+        self.handler.client.publish(self.topic, json.dumps(self.snapshot()), 0)
+
+    def start(self):
+        "Samples a message every sample_interval and publishes a snapshot every interval from a daemon thread, if enabled."
+        if self.enabled:
+            Thread(target=self.report_loop, daemon=True).start()
+
+    def report_loop(self):
+        logger = logging.getLogger('app')
+        next_report = time.monotonic() + self.interval
+        while True:
+            time.sleep(self.sample_interval)
+            self.sample()
+            if time.monotonic() < next_report:
+                continue
+            next_report += self.interval
+            try:
+                self.report()
+            except Exception as e:
+                logger.warning(f"METRICS {self.stage}: {e}")
+
+
+def prometheus(snapshots: dict, now: float = None):
+    """Prometheus text exposition of the latest snapshot of every stage.
+
+    Args:
+        snapshots (dict): {stage: snapshot}, see StageMetrics.snapshot().\n
+        now (float, optional): time.time(), for the age of the snapshots. Defaults to None.
+    """
+    if now is None:
+        now = time.time()
+    stages = sorted(snapshots)
+    lines = []
+
+    def label(stage):
+        return 'stage="' + str(stage).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for kind, metrics in (("counter", COUNTERS), ("gauge", GAUGES)):
+        for key, name, help_text in metrics:
+            family(name, kind, help_text)
+            for stage in stages:
+                value = snapshots[stage].get(key)
+                if value is not None:
+                    lines.append(f"{name}{{{label(stage)}}} {value}")
+    family("pipeline_gc_collections_total", "counter", "Garbage collections per generation.")
+    for stage in stages:
+        for generation, collections in enumerate(snapshots[stage].get("gc_collections") or []):
+            lines.append(f'pipeline_gc_collections_total{{{label(stage)},generation="{generation}"}} {collections}')
+    for key, name, help_text in HISTOGRAMS:
+        family(name, "histogram", help_text)
+        for stage in stages:
+            histogram = snapshots[stage].get(key)
+            if histogram is None:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label(stage)},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label(stage)}}} {histogram['sum']}")
+            lines.append(f"{name}_count{{{label(stage)}}} {cumulative}")
+    family("pipeline_metrics_age_seconds", "gauge", "Seconds since the stage's last snapshot, grows when a stage stopped reporting.")
+    for stage in stages:
+        lines.append(f"pipeline_metrics_age_seconds{{{label(stage)}}} {now - snapshots[stage]['unix_timestamp']:.3f}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(Process):
+    def __init__(self, client_id:str, topic:str, host:str="127.0.0.1", port:int=9108, control_queue=None, transport:dict=None, profiling:dict=None):
+        """
+        Args:
+            client_id (str): Name of this process for use by Mosquitto msg broker.\n
+            topic (str): Topic the stages publish their metrics under, <topic>/<stage>.\n
+            host (str, optional): Address the HTTP endpoint listens on. Defaults to "127.0.0.1", local clients only.\n
+            port (int, optional): Port of the HTTP endpoint. Defaults to 9108.\n
+            control_queue (multiprocessing Queue, optional): Used to tell parent process this stage is ready. Defaults to None.\n
+            transport (dict, optional): Transport profile for the message handler. Defaults to None.\n
+            profiling (dict, optional): Sampling profiler toggled by a signal, see app.lib.profiling. Defaults to None.
+        """
+        Process.__init__(self)
+        self.client_id = client_id
+        self.topic = topic
+        self.host = host
+        self.port = port
+        self.control_queue = control_queue
+        self.transport = transport
+        self.profiling_config = dict(DEFAULT_PROFILING)
+        if profiling is not None:
+            self.profiling_config.update(profiling)
+        self.logger = logging.getLogger('app')
+
+    def run(self):
+        try:
+            # Setup interrupt signal handler
+            signal.signal(signal.SIGTERM, self.interrupt_handler)
+            SamplingProfiler(self.client_id, **self.profiling_config).install()
+            self.logger.debug('Process Started')
+
+            # http.server is imported here, not with the module, so the stages that import StageMetrics do not load it
+            from http.server import ThreadingHTTPServer
+            self.snapshots = {}
+            self.lock = Lock()
+            self.server = ThreadingHTTPServer((self.host, self.port), self.request_handler())
+            self.server.daemon_threads = True
+            Thread(target=self.server.serve_forever, daemon=True).start()
+            self.logger.info(f"METRICS SERVING ON http://{self.host}:{self.port}/metrics")
+
+            topic_sub = f"{self.topic}/+"
+            self.handler = message_handler.Handler(self.client_id, topic_sub, on_ready=self.ready, transport=self.transport)
+            self.handler.client.message_callback_add(topic_sub, self.on_message)
+            self.handler.connect()
+            self.handler.loop()
+
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            exit(1)
+
+    def on_message(self, client, userdata, msg):
+        snapshot = json.loads(msg.payload)
+        with self.lock:
+            self.snapshots[snapshot.get("stage") or msg.topic.rsplit('/', 1)[-1]] = snapshot
+
+    def interrupt_handler(self, signum, frame):
+        self.logger.debug(f'Handling signal {signum} ({signal.Signals(signum).name}).')
+        self.handler.client.disconnect()
+        self.server.shutdown()
+        self.logger.debug('Process Ended')
+        time.sleep(1)
+        exit(0)
+
+    def ready(self):
+        "Tells the parent process this stage is connected and subscribed."
+        if self.control_queue is not None:
+            self.control_queue.put_nowait(self.client_id)
+
+    def request_handler(self):
+        "Returns the HTTP request handler class bound to this server's snapshots."
+        from http.server import BaseHTTPRequestHandler
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                with server.lock:
+                    payload = prometheus(dict(server.snapshots)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
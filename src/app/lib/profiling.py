@@ -0,0 +1,124 @@
+"""
+On demand sampling profiler of a running stage process, toggled by a signal.
+
+Every stage process installs a SamplingProfiler at the start of run(). Sending its signal (SIGUSR1 by default) to the
+process starts a profile, kill -USR1 <pid>, sending it again stops the profile early, else it stops after duration
+seconds. The pid of every process is logged when the profiler is installed.
+
+While a profile runs a daemon thread reads the stack of every other thread of the process (sys._current_frames())
+every interval seconds and counts the distinct stacks. The cost is one stack walk per interval, independent of the
+number of calls the process makes, and nothing runs between profiles. cProfile would only see the thread it is enabled
+in and slow every call down. The counts are written to <path>/<name>-<pid>-<YYYYmmdd-HHMMSS>.collapsed in the collapsed
+stack format: one line per stack, thread;outermost frame;...;innermost frame <samples>, read by flamegraph.pl,
+speedscope and inferno.
+
+The signal handler only sets an event, the sampling thread does the rest, so the handler never takes a lock the
+interrupted code could hold (e.g. the logging queue's) and the SIGTERM handlers run as before. A profile that is
+running when the process stops is not written.
+"""
+
+from threading import Event, Thread, get_ident, enumerate as threads
+import logging, os, signal, sys, time
+
+DEFAULT_PROFILING = {
+    "enabled": True,
+    "signal": "SIGUSR1",
+    "duration": 30,
+    "interval": 0.01,
+    "path": "profiles"
+}
+
+
+class SamplingProfiler:
+    def __init__(self, name:str, enabled:bool=True, signal:str="SIGUSR1", duration:float=30, interval:float=0.01, path:str="profiles"):
+        """
+        Args:
+            name (str): Name of the process in the profile's file name, its client_id.\n
+            enabled (bool, optional): If False, install() does nothing. Defaults to True.\n
+            signal (str, optional): Name of the signal that starts and stops a profile. Defaults to "SIGUSR1".\n
+            duration (float, optional): Most seconds a profile runs. Defaults to 30.\n
+            interval (float, optional): Seconds between samples. Defaults to 0.01.\n
+            path (str, optional): Folder the profiles are written to, created when needed. Defaults to "profiles".
+        """
+        self.name = name
+        self.enabled = enabled
+        self.signal = signal
+        self.duration = duration
+        self.interval = interval
+        self.path = path
+        self.toggled = Event()
+        self.labels = {}
+        self.logger = logging.getLogger('app')
+
+    def install(self):
+        """Installs the signal handler and starts the idle sampling thread. Call from the main thread of the process,
+        in run(). Returns False if disabled or the signal does not exist on this platform (Windows)."""
+        signum = getattr(signal, self.signal, None)
+        if not self.enabled or signum is None:
+            return False
+        signal.signal(signum, self.toggle)
+        Thread(target=self.loop, name="profiler", daemon=True).start()
+        self.logger.debug(f'Profiler of {self.name} on {self.signal}: kill -{self.signal[3:]} {os.getpid()}')
+        return True
+
+    def toggle(self, signum=None, frame=None):
+        "Signal handler, starts a profile or stops the running one."
+        self.toggled.set()
+
+    def loop(self):
+        while True:
+            self.toggled.wait()
+            self.toggled.clear()
+            try:
+                self.logger.info(f'PROFILING {self.name} FOR UP TO {self.duration} s')
+                stacks, samples = self.profile()
+                path = self.write(stacks)
+                self.logger.info(f'Profile of {self.name} written to {path}: {samples} samples, {len(stacks)} stacks')
+            except Exception as e:
+                self.logger.warning(f'Profile of {self.name} failed: {e}')
+
+    def profile(self):
+        "Samples until duration has passed or the signal is sent again, returns ({stack: samples}, samples)."
+        stacks = {}
+        samples = 0
+        own = get_ident()
+        deadline = time.monotonic() + self.duration
+        # Event.wait() is the sleep between samples and ends it early when the profile is stopped
+        while not self.toggled.wait(self.interval):
+            if time.monotonic() >= deadline:
+                break
+            self.sample(stacks, own)
+            samples += 1
+        self.toggled.clear()
+        return stacks, samples
+
+    def sample(self, stacks:dict, own:int):
+        "Adds the current stack of every thread but the sampling one to stacks."
+        names = {thread.ident: thread.name for thread in threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(self.label(frame.f_code))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stack = ';'.join(reversed(frames))
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+    def label(self, code):
+        "Frame name of a code object, function (file:line), cached since a process runs a limited set of functions."
+        label = self.labels.get(code)
+        if label is None:
+            label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ',')
+            self.labels[code] = label
+        return label
+
+    def write(self, stacks:dict):
+        "Writes stacks in the collapsed stack format, returns the file's path."
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, f'{self.name}-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.collapsed')
+        with open(path, 'w') as profile_file:
+            for stack, count in sorted(stacks.items()):
+                profile_file.write(f'{stack} {count}\n')
+        return path
@@ -0,0 +1,60 @@
+"""
+Registry of the data sources, sinks and optional services that initialize.py can start.
+
+Entries are "module:Class" strings that are only imported when they are resolved, so a run never imports the stack
+of a source, sink or service it does not use (e.g. a json replay never loads mbientlab.metawear, a run without the
+state cache or the heatmap never loads their modules or http.server). numpy is loaded either way, the linear stage's
+filters use it. Extra entries, or overrides of the defaults, can be added under "sources", "sinks" and "services" in
+the initialize.py section of config.json.
+
+Source constructor signatures:
+- metawear: (client_id, topic_sub, topic_pub, l_mac, r_mac, queue, transport=None, sampling=None, asset_id=None)
+- replay sources (any other name): (client_id, topic_pub, path, hz, queue, transport=None, seek=None)
+Sources also receive partitions=<number of partitions> when the raw stage is sharded, see app/lib/sharding.py, and
+publish each reading to topic_pub/<partition of its asset_id>. The metawear source also receives metrics=<the metrics.py
+settings of config.json>, see app/lib/metrics.py. Every source receives profiling=<the profiling.py settings of
+config.json>, see app/lib/profiling.py.
+
+Sink constructor signature: (client_id, topic_sub, path, control_queue, transport=None, reassemble_topics=None,
+metrics=None, profiling=None, **options) where options are the sink specific settings in log_data.options.
+
+Services are started with the arguments of their section in config.json, see initialize.py.
+"""
+
+from importlib import import_module
+
+SOURCES = {
+    "metawear": "app.Aggregator.sensor_to_raw_msg_handler:SensorProcess",
+    "json": "app.Test.json_to_raw:JsonToRaw",
+    "csv": "app.Test.csv_to_raw:CsvToRaw",
+}
+
+SINKS = {
+    "location_log": "app.Test.location_to_log:LocationToLog",
+    "async_log": "app.Test.sink_host:SinkHost",
+    "trajectory": "app.Database.trajectory_msg_handler:TrajectorySink",
+}
+
+SERVICES = {
+    "state_cache": "app.Database.state_cache:StateCache",
+    "metrics_server": "app.lib.metrics:MetricsServer",
+    "geofence": "app.Analytics.geofence_msg_handler:GeofenceProcess",
+    "heatmap": "app.Analytics.heatmap_msg_handler:HeatmapProcess",
+}
+
+
+def resolve(registry: dict, name: str, overrides: dict = None):
+    """Imports and returns the class registered under name.
+
+    Args:
+        registry (dict): SOURCES, SINKS or SERVICES.\n
+        name (str): Name of the entry.\n
+        overrides (dict, optional): Entries from config.json that take precedence over registry. Defaults to None.
+    """
+    entries = dict(registry)
+    if overrides:
+        entries.update(overrides)
+    if name not in entries:
+        raise KeyError(f'"{name}" is not registered. Accepted values are: {", ".join(sorted(entries))}')
+    module_name, class_name = entries[name].split(':')
+    return getattr(import_module(module_name), class_name)
@@ -0,0 +1,107 @@
+"""
+Restores the order of an asset's readings from the seq the source stamps on them (see app.lib.messages).
+
+With QoS 1 a reading can arrive twice after a reconnect, with QoS 0 it can be lost, and readings can arrive out of
+order. A Resequencer per asset drops duplicates, holds readings briefly in a reorder buffer, and releases them in seq
+order together with the number of readings missing before each one, so the consumer can bridge the gap explicitly
+(see raw_to_linear.GAP_STRATEGIES).
+
+Sources also stamp the run, an id of the source's current run (its start time in ms). A source that restarts numbers
+its readings again under a new run, the Resequencer then releases what it held of the previous run and resynchronises
+on the new one. Within a run a reading behind the next expected seq is a duplicate however far behind it is, e.g. a
+late QoS 1 redelivery. The first reading of a new run is released with gap None: it does not continue the previous
+reading, so nothing is integrated across the restart.
+"""
+
+import heapq
+import math
+import time
+
+DEFAULT_SEQUENCING = {
+    "reorder_window": 4,
+    "max_delay": 0.2,
+    "gap_strategy": "interpolate"
+}
+
+
+class Resequencer:
+    """Reorder buffer for the readings of one asset."""
+
+    def __init__(self, reorder_window: int = 4, max_delay: float = 0.2):
+        """
+        Args:
+            reorder_window (int, optional): Readings held while waiting for a missing one. Defaults to 4.\n
+            max_delay (float, optional): Seconds a reading is held at most before the missing ones are given up. Defaults to 0.2.
+        """
+        self.reorder_window = reorder_window
+        self.max_delay = max_delay
+        self.next_seq = None
+        self.run = None
+        # (seq, arrival, data)
+        self.buffer = []
+        self.buffered = set()
+        self.duplicates = 0
+        self.held = 0
+        self.missing = 0
+        self.restarts = 0
+        # The next reading released is the first of a new run
+        self.restarted = False
+
+    def push(self, data: dict, now: float = None):
+        """Adds a reading, returns the list of (data, gap) that can be released, in seq order. gap is the number of
+        readings missing right before data, None for the first reading of a new run of the source."""
+        seq = data.get("seq")
+        if seq is None:
+            return [(data, 0)]
+        if now is None:
+            now = time.monotonic()
+        out = []
+        run = data.get("run")
+        if self.next_seq is None:
+            self.next_seq = seq
+            self.run = run
+        elif run != self.run:
+            # The source restarted, readings held from its previous run are released first
+            out = self.release(math.inf)
+            self.next_seq = seq
+            self.run = run
+            self.restarts += 1
+            self.restarted = True
+        if seq < self.next_seq or seq in self.buffered:
+            self.duplicates += 1
+            return out + self.release(now)
+        if seq != self.next_seq or self.buffer:
+            self.held += 1
+        heapq.heappush(self.buffer, (seq, now, data))
+        self.buffered.add(seq)
+        return out + self.release(now)
+
+    def release(self, now: float = None):
+        """Releases the buffered readings that are next in order, and those that waited longer than max_delay or that
+        overflow the reorder window. Called on every push and while the stage is idle."""
+        if now is None:
+            now = time.monotonic()
+        out = []
+        while self.buffer:
+            seq, arrival, data = self.buffer[0]
+            if seq != self.next_seq and len(self.buffer) <= self.reorder_window and now - arrival < self.max_delay:
+                break
+            heapq.heappop(self.buffer)
+            self.buffered.discard(seq)
+            if self.restarted:
+                self.restarted = False
+                gap = None
+            else:
+                gap = seq - self.next_seq
+                self.missing += gap
+            self.next_seq = seq + 1
+            out.append((data, gap))
+        return out
+
+    def get_state(self):
+        "The next expected seq and its run, so readings processed before a restart are recognized as duplicates after it."
+        return {"next_seq": self.next_seq, "run": self.run}
+
+    def set_state(self, state: dict):
+        self.next_seq = state["next_seq"]
+        self.run = state.get("run")
@@ -0,0 +1,435 @@
+"""
+Horizontal sharding of a transformation stage by asset id.
+
+Transformer and Tracking keep state per asset, so a stage is scaled out by giving every asset to exactly one worker
+process instead of running copies behind a shared subscription. Asset ids are hashed into a fixed number of partitions
+and publishers send each message to <topic>/<partition> (Router). The partitions are spread over the workers of the
+stage with a consistent hash ring (HashRing) and every worker subscribes only to the partition topics it owns, so the
+broker delivers all messages of an asset to the same worker. Adding or removing a worker moves about 1/N of the
+partitions, the others keep their owner.
+
+The workers of a stage coordinate under <control_topic>/<stage> (ShardMember):
+- members/<worker>: retained while the worker is connected, cleared by its last will when it stops or dies. A worker
+  that is stopped first announces that it is leaving and hands its partitions to the others like any other move.
+- claims/<worker>: the partitions the worker owns in its view of the members or still waits for, each with the worker
+  it expects the handoff from, sent once it is subscribed to them.
+- handoff/<worker>: the state of a partition's assets, sent to the worker that claimed the partition from the sender.
+
+When the members change every worker rebuilds the ring. A worker that gains a partition subscribes to it, holds its
+messages and claims it. The previous owner unsubscribes, processes the messages it already received and hands the state
+of the partition's assets (the checkpoint format, see checkpoint.py) to the claimer. A partition that moves again
+before its handoff arrived is passed on along the same chain once it did. The claimer applies it and then
+processes the held messages, skipping those the previous owner processed while both were subscribed. A partition whose
+previous owner died, or whose handoff does not arrive within handoff_timeout, is restored from the checkpoint files of
+the stage's workers instead, losing the movement since the owner's last snapshot and the messages sent while nobody was
+subscribed.
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCodes
+
+DEFAULT_SHARDING = {
+    "workers": 1,
+    "partitions": 64,
+    "replicas": 64,
+    "control_topic": "Control/shards",
+    "handoff_timeout": 5.0
+}
+
+
+def settings(sharding: dict = None):
+    "sharding settings of a stage merged over DEFAULT_SHARDING."
+    merged = dict(DEFAULT_SHARDING)
+    if sharding is not None:
+        merged.update(sharding)
+    return merged
+
+
+def shards(sharding: dict):
+    "Shard index of each worker to start, [None] for a stage that is not sharded."
+    return [None] if sharding["workers"] <= 1 else list(range(sharding["workers"]))
+
+
+def partitions(sharding: dict):
+    "Number of partitions publishers to the stage route to, None when the stage is not sharded."
+    return sharding["partitions"] if sharding["workers"] > 1 else None
+
+
+def partition_of(asset_id, partitions: int):
+    "Partition of an asset. Unlike hash() the result is the same in every process and on every host."
+    return zlib.crc32(str(asset_id).encode()) % partitions
+
+
+def subscription(topic: str, partitions: int = None):
+    "Topic filter that receives every message of topic, also when it is split into partitions."
+    return topic if partitions is None else f"{topic}/#"
+
+
+def point(key: str):
+    "Position of key on the hash ring."
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring of the workers of a stage. Each worker is placed at `replicas` points, a partition belongs
+    to the worker of the first point at or after the partition's own point."""
+
+    def __init__(self, workers, replicas: int = 64):
+        points = sorted((point(f"{worker}#{i}"), worker) for worker in workers for i in range(replicas))
+        self.points = [p for p, worker in points]
+        self.workers = [worker for p, worker in points]
+
+    def owner(self, partition: int):
+        "Worker that owns partition, None when the ring is empty."
+        if not self.points:
+            return None
+        i = bisect.bisect_left(self.points, point(f"partition-{partition}"))
+        return self.workers[i % len(self.points)]
+
+    def assignment(self, partitions: int):
+        "Owner of every partition, indexed by partition."
+        return [self.owner(partition) for partition in range(partitions)]
+
+
+class Router:
+    """Topic a publisher sends an asset's messages to, topic/<partition> when the next stage is sharded."""
+
+    def __init__(self, topic: str, partitions: int = None):
+        """
+        Args:
+            topic (str): Topic of the next stage.\n
+            partitions (int, optional): Partitions of the next stage. Defaults to None, the stage is not sharded and
+            topic is used as is.
+        """
+        self.base = topic
+        self.partitions = partitions
+        self.topics = {}
+
+    def topic(self, asset_id):
+        if self.partitions is None:
+            return self.base
+        topic = self.topics.get(asset_id)
+        if topic is None:
+            topic = self.topics[asset_id] = f"{self.base}/{partition_of(asset_id, self.partitions)}"
+        return topic
+
+
+class ShardMember:
+    """Membership, partition ownership and state handoff of one worker of a sharded stage."""
+
+    def __init__(self, stage: str, worker: str, topic_sub: str, sharding: dict, handler, queue, release, adopt, load, on_ready=None):
+        """Takes over the subscriptions of handler, call before handler.connect().
+
+        Args:
+            stage (str): Name of the stage, the client_id shared by its workers.\n
+            worker (str): client_id of this worker.\n
+            topic_sub (str): Topic of the stage, its partitions are topic_sub/<partition>.\n
+            sharding (dict): Settings, see DEFAULT_SHARDING.\n
+            handler (message_handler.Handler): The worker's handler.\n
+            queue (backpressure.StageQueue): The worker's inbound queue, held messages are put on it.\n
+            release (callable): release(partition) removes the assets of partition from the worker and returns
+            {asset_id: state}. Only called once the messages queued before the partition was
+            unsubscribed were processed, on the handoff thread.\n
+            adopt (callable): adopt({asset_id: state}, handed_off) sets the state of assets the worker takes over,
+            handed_off is True when another worker handed them over and False when they come from the checkpoint files.\n
+            load (callable): Returns {asset_id: state} of the stage's checkpoint files.\n
+            on_ready (callable, optional): Called once, when the worker sees all `workers` members and is subscribed to
+            its partitions. Defaults to None.
+        """
+        self.stage = stage
+        self.worker = worker
+        self.topic_sub = topic_sub
+        self.partitions = sharding["partitions"]
+        self.replicas = sharding["replicas"]
+        self.workers = sharding["workers"]
+        self.handoff_timeout = sharding["handoff_timeout"]
+        self.handler = handler
+        self.queue = queue
+        self.release = release
+        self.adopt = adopt
+        self.load = load
+        self.on_ready = on_ready
+        self.is_ready = False
+        self.logger = logging.getLogger('app')
+
+        self.prefix = f"{sharding['control_topic']}/{stage}"
+        self.members = set()
+        # Workers that announced they are leaving, they still hand off their partitions
+        self.leaving = set()
+        self.on_left = None
+        self.leave_timer = None
+        self.owners = [None] * self.partitions
+        # Partitions this worker is subscribed to, including those it is still subscribing to or releasing
+        self.owned = set()
+        self.subscribing = set()
+        # partition -> worker it is handed to
+        self.releasing = {}
+        # partition -> messages held until the partition's state arrives, and the worker it is expected from
+        self.pending = {}
+        self.sources = {}
+        self.timers = {}
+        # worker -> partitions of its last claim
+        self.claims = {}
+        # asset_id -> seq of the asset's last message put on the queue, sent with a handoff
+        self.last_seq = {}
+        self.lock = threading.RLock()
+
+        handler.topic_sub = [f"{self.prefix}/#"]
+        handler.on_ready = self.join
+        handler.client.will_set(f"{self.prefix}/members/{worker}", b"", qos=1, retain=True)
+        handler.client.message_callback_add(f"{self.prefix}/members/+", self.on_member)
+        handler.client.message_callback_add(f"{self.prefix}/claims/+", self.on_claim)
+        handler.client.message_callback_add(f"{self.prefix}/handoff/{worker}", self.on_handoff)
+
+    def topic(self, partition: int):
+        return f"{self.topic_sub}/{partition}"
+
+    def join(self):
+        "Announces the worker once it is subscribed to the control topics."
+        self.announce(False)
+
+    def announce(self, leaving: bool):
+        payload = json.dumps({"worker": self.worker, "leaving": leaving, "unix_timestamp": time.time()})
+        self.handler.client.publish(f"{self.prefix}/members/{self.worker}", payload, qos=1, retain=True)
+
+    def leave(self, on_left):
+        """Hands this worker's partitions to the other workers and then calls on_left(), which should stop the worker
+        and call disconnect(). The messages keep being processed meanwhile. on_left() is called after handoff_timeout
+        at the latest, and right away when no other worker is left.
+
+        Args:
+            on_left (callable): Called once, without arguments, on the broker thread, a timer thread or the thread of a
+            handoff.
+        """
+        with self.lock:
+            self.on_left = on_left
+            if not self.members - {self.worker}:
+                self.left()
+                return
+            self.leave_timer = threading.Timer(self.handoff_timeout, self.left)
+            self.leave_timer.daemon = True
+            self.leave_timer.start()
+            self.announce(True)
+
+    def left(self):
+        with self.lock:
+            on_left, self.on_left = self.on_left, None
+            orphaned = sorted(self.owned) if self.members - {self.worker} else []
+        if self.leave_timer is not None:
+            self.leave_timer.cancel()
+        if on_left is not None:
+            if orphaned:
+                self.logger.warning(f"SHARDS {self.stage}: {self.worker} LEFT WITHOUT HANDING OFF PARTITIONS {orphaned}")
+            on_left()
+
+    def disconnect(self):
+        "Disconnects with the last will, which removes the worker from the members."
+        self.handler.client.disconnect(reasoncode=ReasonCodes(PacketTypes.DISCONNECT, "Disconnect with will message"))
+
+    def accept(self, topic: str, data):
+        """Called by the broker thread for every message. Returns False when the message is held because its
+        partition's state has not arrived yet."""
+        if self.pending:
+            with self.lock:
+                held = self.pending.get(int(topic.rsplit('/', 1)[-1]))
+                if held is not None:
+                    held.append((topic, data))
+                    return False
+        self.last_seq[data.get("asset_id")] = data.get("seq")
+        return True
+
+    # Control messages, on the broker thread
+
+    def on_member(self, client, userdata, msg):
+        worker = msg.topic.rsplit('/', 1)[-1]
+        announcement = json.loads(msg.payload) if msg.payload else None
+        members = set(self.members)
+        leaving = set(self.leaving)
+        members.discard(worker)
+        leaving.discard(worker)
+        if announcement is not None:
+            (leaving if announcement.get("leaving") else members).add(worker)
+        if members == self.members and leaving == self.leaving:
+            return
+        with self.lock:
+            changed = members != self.members
+            previous = self.owners
+            self.members = members
+            self.leaving = leaving
+            # Nobody is left to hand off the partitions of a worker that died
+            for partition, source in list(self.sources.items()):
+                if source not in members and source not in leaving:
+                    self.finish(partition, None)
+            if not changed:
+                return
+            self.owners = HashRing(sorted(members), self.replicas).assignment(self.partitions)
+            gained = [p for p in range(self.partitions) if self.owners[p] == self.worker and p not in self.owned]
+            for partition in gained:
+                self.gain(partition, previous[partition])
+            self.logger.info(f"SHARDS {self.stage}: {len(members)} WORKERS, {self.worker} OWNS "
+                             f"{self.owners.count(self.worker)} OF {self.partitions} PARTITIONS ({len(gained)} GAINED)")
+            if gained:
+                self.subscribe(gained)
+            else:
+                # Claimed again so workers still subscribed to this worker's partitions release them
+                self.claim()
+            self.check_releases()
+            self.check_ready()
+
+    def on_claim(self, client, userdata, msg):
+        with self.lock:
+            self.claims[msg.topic.rsplit('/', 1)[-1]] = {p: source for p, source in json.loads(msg.payload)["partitions"]}
+            self.check_releases()
+
+    def on_handoff(self, client, userdata, msg):
+        handoff = json.loads(msg.payload)
+        self.logger.info(f"SHARDS {self.stage}: PARTITION {handoff['partition']} HANDED OFF BY {handoff['from']} "
+                         f"WITH {len(handoff['assets'])} ASSETS")
+        self.finish(handoff["partition"], handoff["assets"])
+
+    # Gaining a partition
+
+    def gain(self, partition: int, source: str):
+        """Starts taking over partition. Its messages are held until source hands off the state, source None or a
+        worker that left means there is nobody to wait for."""
+        self.owned.add(partition)
+        self.subscribing.add(partition)
+        if source is not None and source != self.worker and (source in self.members or source in self.leaving):
+            self.pending[partition] = []
+            self.sources[partition] = source
+            timer = self.timers[partition] = threading.Timer(self.handoff_timeout, self.finish, (partition, None))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.adopt(self.restore(partition))
+
+    def subscribe(self, gained: list):
+        self.update_subscriptions()
+        self.handler.subscribe([self.topic(partition) for partition in gained], lambda reason_codes: self.subscribed(gained))
+
+    def subscribed(self, gained: list):
+        with self.lock:
+            self.subscribing.difference_update(gained)
+            self.claim()
+            self.check_ready()
+
+    def claim(self):
+        "Publishes the owned partitions this worker is subscribed to, with the worker each one's handoff is expected from."
+        claimed = [[p, self.sources.get(p)] for p in sorted(self.owned)
+                   if p not in self.subscribing and (self.owners[p] == self.worker or p in self.pending)]
+        self.handler.client.publish(f"{self.prefix}/claims/{self.worker}", json.dumps({"partitions": claimed}), qos=1)
+
+    def finish(self, partition: int, assets: list):
+        """Applies the state of a gained partition, handed off as [asset_id, state, seq] entries or from the checkpoint
+        files when assets is None, and queues its held messages."""
+        with self.lock:
+            held = self.pending.pop(partition, None)
+            source = self.sources.pop(partition, None)
+            timer = self.timers.pop(partition, None)
+            if timer is not None:
+                timer.cancel()
+            if held is None:
+                if assets is not None:
+                    self.logger.warning(f"SHARDS {self.stage}: IGNORED HANDOFF OF PARTITION {partition}, NOT WAITING FOR IT")
+                return
+            if assets is None:
+                self.logger.warning(f"SHARDS {self.stage}: NO HANDOFF OF PARTITION {partition} FROM {source}, RESTORED FROM CHECKPOINT")
+                states, seqs = self.restore(partition), {}
+            else:
+                states = {asset_id: state for asset_id, state, seq in assets}
+                seqs = {asset_id: seq for asset_id, state, seq in assets if seq is not None}
+            self.adopt(states, assets is not None)
+            # Both workers were subscribed for a moment: the previous owner processed the held messages of each asset
+            # up to the last one it saw
+            overlap = {}
+            for i, (topic, data) in enumerate(held):
+                if data.get("seq") is not None and data.get("seq") == seqs.get(data.get("asset_id")):
+                    overlap[data.get("asset_id")] = i
+            for i, (topic, data) in enumerate(held):
+                if i > overlap.get(data.get("asset_id"), -1):
+                    self.last_seq[data.get("asset_id")] = data.get("seq")
+                    self.queue.put(data.get("asset_id"), data)
+            # Claimed again without the partition's source, or without the partition if it moved on meanwhile
+            self.claim()
+            self.check_releases()
+            self.check_ready()
+
+    def restore(self, partition: int):
+        "State of the assets of partition in the stage's checkpoint files."
+        return {asset_id: state for asset_id, state in self.load().items() if partition_of(asset_id, self.partitions) == partition}
+
+    # Releasing a partition
+
+    def recipient(self, partition: int):
+        """Worker partition is released to: one that claimed it expecting the handoff from this worker, or its owner if
+        that expects no handoff. The owner is preferred, None while nobody claimed it."""
+        owner = self.owners[partition]
+        for worker in [owner] + sorted(self.claims):
+            claimed = self.claims.get(worker, {})
+            if (worker != self.worker and worker in self.members and partition in claimed
+                    and (claimed[partition] == self.worker or (worker == owner and claimed[partition] is None))):
+                return worker
+        return None
+
+    def check_releases(self):
+        "Releases the partitions that belong to another worker once a worker has claimed them from this one."
+        for partition in sorted(self.owned):
+            # A partition still waiting for its handoff is released once the handoff arrived, with the state in it
+            if self.owners[partition] == self.worker or partition in self.releasing or partition in self.pending:
+                continue
+            recipient = self.recipient(partition)
+            if recipient is not None:
+                self.releasing[partition] = recipient
+                self.handler.unsubscribe([self.topic(partition)], lambda partition=partition: self.hand_off(partition))
+
+    def hand_off(self, partition: int):
+        """Called with the UNSUBACK on the broker thread. The handoff waits for the processing thread, so it runs on its
+        own thread and the broker thread keeps reading the other partitions' messages meanwhile."""
+        threading.Thread(target=self.released, args=(partition,), name=f"handoff-{partition}", daemon=True).start()
+
+    def released(self, partition: int):
+        "Hands the partition's state to its new owner once the broker stopped sending its messages (UNSUBACK)."
+        with self.lock:
+            owner = self.releasing.pop(partition)
+            if partition in self.pending:
+                self.finish(partition, None)
+            self.owned.discard(partition)
+            self.subscribing.discard(partition)
+            self.update_subscriptions()
+        # Messages of the partition received before the UNSUBACK are processed first, messages of the other partitions
+        # keep arriving so the queue may never be empty
+        self.queue.drain()
+        states = self.release(partition)
+        assets = [[asset_id, state, self.last_seq.pop(asset_id, None)] for asset_id, state in states.items()]
+        self.handler.client.publish(f"{self.prefix}/handoff/{owner}",
+                                    json.dumps({"from": self.worker, "partition": partition, "assets": assets}), qos=1)
+        self.logger.info(f"SHARDS {self.stage}: PARTITION {partition} HANDED OFF TO {owner} WITH {len(assets)} ASSETS")
+        with self.lock:
+            if self.owners[partition] == self.worker:
+                # The members changed back while the partition was released
+                self.gain(partition, owner)
+                self.subscribe([partition])
+            self.check_ready()
+            done = self.on_left is not None and not self.owned
+        if done:
+            self.left()
+
+    def update_subscriptions(self):
+        "Topics the handler subscribes to again after a reconnect."
+        self.handler.topic_sub = [f"{self.prefix}/#"] + [self.topic(partition) for partition in sorted(self.owned)]
+
+    def check_ready(self):
+        if self.is_ready or len(self.members) < self.workers or self.worker not in self.members:
+            return
+        if self.pending or self.subscribing or self.releasing:
+            return
+        self.is_ready = True
+        if self.on_ready is not None:
+            self.on_ready()
@@ -0,0 +1,27 @@
+# Converts the trajectory files created by the trajectory sink (app/Database/trajectory_msg_handler.py) into csv files.
+# Run from the src folder: python3 -m app.lib.trajectory_to_csv [path_to_file.traj] [hz]
+# Without hz the kept points are written, with hz the path of every asset is reconstructed at that rate.
+
+import csv
+import numpy as np
+from sys import argv
+from app.Database.trajectory import TrajectoryReader
+
+if __name__ == '__main__':
+    trajectory_path = argv[1]
+    hz = float(argv[2]) if len(argv) > 2 else 0
+
+    reader = TrajectoryReader(trajectory_path)
+    csv_file_path = trajectory_path.rsplit('.', 1)[0] + '.csv'
+
+    with open(csv_file_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Asset_Id', 'Unix_Timestamp', 'X_Loc', 'Y_Loc', 'Heading'])
+
+        for asset_id in reader.assets():
+            points = reader.points(asset_id)
+            if hz > 0 and len(points):
+                timestamps = np.arange(points[0, 0], points[-1, 0], 1 / hz)
+                points = np.column_stack([timestamps, reader.positions(asset_id, timestamps)])
+            for timestamp, x, y, heading in points:
+                writer.writerow([asset_id, round(timestamp, 3), x, y, heading])
@@ -10,25 +10,35 @@ from logging.handlers import QueueHandler
 import sys
 import time
 import signal
+import queue
 from multiprocessing import active_children, current_process
 from multiprocessing import Queue
 import app.Transformation.linear_to_location_msg_handler as linear_handler
 import app.Transformation.raw_to_linear_msg_handler as raw_handler
-import app.Aggregator.sensor_to_raw_msg_handler as sensor_handler
-import app.Test.csv_to_raw as csv_to_raw
-import app.Test.json_to_raw as json_to_raw
-import app.Test.location_to_log as data_logger
 import app.lib.logger_process as logger_process
+import app.lib.metrics as metrics
+import app.lib.profiling as profiling
+import app.lib.registry as registry
+import app.lib.sharding as sharding
+from app.lib.message_handler import transport_profile
 
 
-def shutdown(process_list, errno):
+def shutdown(process_list, errno, timeout=10):
     logger.info("SHUTDOWN PROCESS STARTED")
-    for p in process_list:
+    # Stages that were never started (e.g. the source when a consumer failed to get ready) have no pid
+    started = [p for p in process_list if p.pid is not None]
+    for p in started:
         p.terminate()
-        p.join()
+    deadline = time.monotonic() + timeout
+    for p in started:
+        p.join(max(deadline - time.monotonic(), 0))
+        if p.is_alive():
+            logger.warning(f'Process {getattr(p, "client_id", p.name)} did not stop within {timeout}s, killing it')
+            p.kill()
+            p.join(1)
         
     logging_queue.put_nowait(None)
-    logger_p.join()
+    logger_p.join(timeout)
     
     children = active_children()
     print(f'Active Children Count: {len(children)}')
@@ -37,6 +47,35 @@ def shutdown(process_list, errno):
             print(child)
     sys.exit(errno)
 
+def start_and_wait_until_ready(stages, control_queue, timeout):
+    """Starts stages concurrently and blocks until each one reports over control_queue that it is connected to the
+    broker and subscribed.
+
+    Args:
+        stages (list): Process objects that put their client_id on control_queue when ready.\n
+        control_queue (multiprocessing Queue): Queue the stages report readiness on.\n
+        timeout (float): Seconds to wait for all stages before giving up.
+    """
+    for p in stages:
+        p.start()
+
+    pending = {p.client_id: p for p in stages}
+    deadline = time.monotonic() + timeout
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f'Stages not ready after {timeout}s: {", ".join(sorted(pending))}')
+        try:
+            name = control_queue.get(timeout=min(remaining, 0.5))
+        except queue.Empty:
+            # A stage that died during setup will never report ready
+            for stage_name, p in pending.items():
+                if not p.is_alive():
+                    raise RuntimeError(f'Stage {stage_name} exited with code {p.exitcode} before it was ready')
+            continue
+        pending.pop(name, None)
+        logger.debug(f'Stage ready: {name}')
+
 def interrupt_handler_main(signum, frame):
     name = current_process().name
     if name == 'MainProcess':
@@ -56,6 +95,10 @@ if __name__ == '__main__':
         sensor_config = config.get("sensor_to_raw_msg_handler.py")
         raw_config = config.get("raw_to_linear_msg_handler.py")
         linear_config = config.get("linear_to_location_msg_handler.py")
+        metrics_config = dict(metrics.DEFAULT_METRICS)
+        metrics_config.update(config.get("metrics.py") or {})
+        profiling_config = dict(profiling.DEFAULT_PROFILING)
+        profiling_config.update(config.get("profiling.py") or {})
         proc_list = []
         l_mac = None
         r_mac = None
@@ -69,7 +112,7 @@ if __name__ == '__main__':
         logging_queue = Queue()
         
         # Create and start a logger process
-        logger_p = logger_process.Logger(logging_queue)
+        logger_p = logger_process.Logger(logging_queue, profiling=profiling_config)
         logger_p.start()
         
         # Configure root logger for all processes
@@ -82,6 +125,7 @@ if __name__ == '__main__':
         #Create logger for main process
         logger = logging.getLogger('app')
         logger.info('Main process started.')
+        profiling.SamplingProfiler('main', **profiling_config).install()
         
         
         #  --- Create Other Process Objects ---
@@ -89,6 +133,9 @@ if __name__ == '__main__':
         # Create timing queues that lets child processes tell initialize.py that it can start its runtime timer
         timing_queue = Queue()
         
+        # Create control queue that lets subscribing child processes tell initialize.py they are ready
+        control_queue = Queue()
+        
         # Check if using the testbed or wheel chair.
         if init_config.get("use_testbed") == True:
             l_mac = sensor_config["testbed_l_mac"]
@@ -100,81 +147,210 @@ if __name__ == '__main__':
             r_mac = sensor_config["chair_r_mac"]
             wheel_diameter = raw_config["chair_wheel_diameter"]
             axle_length = linear_config["chair_axle_length"]
+
+        # Sharded stages run several workers, their publishers route every asset to one partition of the stage's topic
+        raw_sharding = sharding.settings(raw_config.get("sharding"))
+        linear_sharding = sharding.settings(linear_config.get("sharding"))
+        raw_partitions = sharding.partitions(raw_sharding)
+        linear_partitions = sharding.partitions(linear_sharding)
+        source_options = {} if raw_partitions is None else {"partitions": raw_partitions}
         
-        #Check if this a test run using old data
+        #Check if this a test run using old data. Sources are resolved and imported from the registry only when used.
         if init_config["test_old"] == True:
             logger.info("RUNNING WITH LEGACY DATA - NOT LIVE!")
-            if init_config["old_data"]["type"] == "csv":
-                sensor_to_raw = csv_to_raw.CsvToRaw(
-                    init_config["old_data"]["client_id"],
-                    init_config["old_data"]["topic_pub"],
-                    init_config["old_data"]["path"],
-                    init_config["old_data"]["hz"],
-                    timing_queue
-                )
-            elif init_config["old_data"]["type"] == "json":
-               sensor_to_raw = json_to_raw.JsonToRaw(
-                    init_config["old_data"]["client_id"],
-                    init_config["old_data"]["topic_pub"],
-                    init_config["old_data"]["path"],
-                    init_config["old_data"]["hz"],
-                    timing_queue
-                )
-            else:
-                raise KeyError('\"old_data\" \"type\" WRONG OR MISSING. Accepted values are \"csv\" or \"json\" ')
+            source_class = registry.resolve(registry.SOURCES, init_config["old_data"]["type"], init_config.get("sources"))
+            sensor_to_raw = source_class(
+                init_config["old_data"]["client_id"],
+                init_config["old_data"]["topic_pub"],
+                init_config["old_data"]["path"],
+                init_config["old_data"]["hz"],
+                timing_queue,
+                transport=transport_profile(config, init_config["old_data"].get("transport_profile")),
+                seek=init_config["old_data"].get("seek"),
+                profiling=profiling_config,
+                **source_options
+            )
         else:
             logger.info("RUNNING WITH LIVE DATA.")
                 
-            sensor_to_raw = sensor_handler.SensorProcess(
+            source_class = registry.resolve(registry.SOURCES, "metawear", init_config.get("sources"))
+            sensor_to_raw = source_class(
                 sensor_config["client_id"],
                 sensor_config["topic_sub"],
                 sensor_config["topic_pub"],
                 l_mac,
                 r_mac,
-                timing_queue
+                timing_queue,
+                transport=transport_profile(config, sensor_config.get("transport_profile")),
+                sampling=sensor_config.get("sampling"),
+                asset_id=sensor_config.get("asset_id"),
+                metrics=metrics_config,
+                profiling=profiling_config,
+                **source_options
             )
 
-        # Instantiate Transformation layer processes.
-        raw_to_linear = raw_handler.RawProcess(
+        # Instantiate Transformation layer processes, one per shard of each stage.
+        raw_to_linear = [raw_handler.RawProcess(
             raw_config["client_id"],
             raw_config["topic_sub"],
             raw_config["topic_pub"],
             wheel_diameter,
-            raw_config["filter_version"]
-        )
+            raw_config["filter_version"],
+            control_queue,
+            transport=transport_profile(config, raw_config.get("transport_profile")),
+            overload=raw_config.get("overload"),
+            filter_chain=raw_config.get("filter_chain"),
+            payload_mode=raw_config.get("payload_mode", "full"),
+            sequencing=raw_config.get("sequencing"),
+            checkpoint=raw_config.get("checkpoint"),
+            sharding=raw_sharding,
+            shard=shard,
+            publish_partitions=linear_partitions,
+            metrics=metrics_config,
+            profiling=profiling_config
+        ) for shard in sharding.shards(raw_sharding)]
 
-        linear_to_loc = linear_handler.LinearProcess(
+        # Map matching uses the GUI's floor plan and extent unless it sets its own, the GUI's extent is in cm and x_loc in mm
+        map_matching = dict(linear_config.get("map_matching") or {})
+        viz_config = config["visualization_PyQt.py"]
+        if map_matching.get("map_path") is None:
+            map_matching["map_path"] = viz_config["map_path"]
+        if map_matching.get("extent") is None:
+            map_matching["extent"] = [10 * viz_config[key] for key in ("min_x", "max_x", "min_y", "max_y")]
+
+        linear_to_loc = [linear_handler.LinearProcess(
             linear_config["client_id"],
             linear_config["topic_sub"],
             linear_config["topic_pub"],
             axle_length,
-            linear_config["filter_version"]
-        )
+            linear_config["filter_version"],
+            control_queue,
+            transport=transport_profile(config, linear_config.get("transport_profile")),
+            overload=linear_config.get("overload"),
+            filter_chain=linear_config.get("filter_chain"),
+            payload_mode=linear_config.get("payload_mode", "full"),
+            checkpoint=linear_config.get("checkpoint"),
+            map_matching=map_matching,
+            sharding=linear_sharding,
+            shard=shard,
+            metrics=metrics_config,
+            profiling=profiling_config
+        ) for shard in sharding.shards(linear_sharding)]
         
         proc_list.append(sensor_to_raw)
-        proc_list.append(raw_to_linear)
-        proc_list.append(linear_to_loc)
+        proc_list.extend(raw_to_linear)
+        proc_list.extend(linear_to_loc)
+        
+        # Stages that subscribe to the pipeline and must be ready before any data is published
+        consumer_list = raw_to_linear + linear_to_loc
+
+        # Other subscribers to the topics of sharded stages receive all of their partitions
+        partitioned = {raw_config["topic_sub"]: raw_partitions, linear_config["topic_sub"]: linear_partitions}
         
         # Check if data logger is on
         if init_config['should_log_output'] == True:
-            location_to_log = data_logger.LocationToLog(
+            sink_class = registry.resolve(registry.SINKS, init_config["log_data"]["sink"], init_config.get("sinks"))
+            location_to_log = sink_class(
                 init_config["log_data"]["client_id"],
                 init_config["log_data"]["topic_sub"],
-                init_config["log_data"]["log_path"]
+                init_config["log_data"]["log_path"],
+                control_queue,
+                transport=transport_profile(config, init_config["log_data"].get("transport_profile")),
+                reassemble_topics=[sharding.subscription(topic, partitioned.get(topic)) for topic in init_config["log_data"].get("reassemble_topics") or []],
+                metrics=metrics_config,
+                profiling=profiling_config,
+                **init_config["log_data"].get("options", {})
             )
             
             proc_list.append(location_to_log)
-            location_to_log.start()
-            time.sleep(1)
+            consumer_list.append(location_to_log)
+
+        # Check if the last known state cache is on
+        cache_config = init_config.get("state_cache", {})
+        if cache_config.get("enabled") == True:
+            cache_class = registry.resolve(registry.SERVICES, "state_cache", init_config.get("services"))
+            cache = cache_class(
+                cache_config["client_id"],
+                [sharding.subscription(topic, partitioned.get(topic)) for topic in cache_config["topics_sub"]],
+                cache_config["host"],
+                cache_config["port"],
+                control_queue,
+                transport=transport_profile(config, cache_config.get("transport_profile")),
+                profiling=profiling_config
+            )
+
+            proc_list.append(cache)
+            consumer_list.append(cache)
+
+        # Check if the metrics endpoint is on, it serves the metrics every stage publishes
+        server_config = init_config.get("metrics_server", {})
+        if server_config.get("enabled") == True:
+            server_class = registry.resolve(registry.SERVICES, "metrics_server", init_config.get("services"))
+            metrics_server = server_class(
+                server_config["client_id"],
+                metrics_config["topic"],
+                server_config["host"],
+                server_config["port"],
+                control_queue,
+                transport=transport_profile(config, server_config.get("transport_profile")),
+                profiling=profiling_config
+            )
+
+            proc_list.append(metrics_server)
+            consumer_list.append(metrics_server)
+
+        # Check if geofencing is on
+        geofence_config = config.get("geofence_msg_handler.py", {})
+        if geofence_config.get("enabled") == True:
+            geofence_class = registry.resolve(registry.SERVICES, "geofence", init_config.get("services"))
+            geofence = geofence_class(
+                geofence_config["client_id"],
+                geofence_config["topic_sub"],
+                geofence_config["topic_pub"],
+                geofence_config["zones_path"],
+                geofence_config["cell_size"],
+                geofence_config.get("dwell"),
+                control_queue,
+                transport=transport_profile(config, geofence_config.get("transport_profile")),
+                profiling=profiling_config
+            )
+
+            proc_list.append(geofence)
+            consumer_list.append(geofence)
+
+        # Check if the occupancy heatmap is on, it covers the GUI's extent unless it sets its own
+        heatmap_config = config.get("heatmap_msg_handler.py", {})
+        if heatmap_config.get("enabled") == True:
+            extent = heatmap_config.get("extent") or [10 * viz_config[key] for key in ("min_x", "max_x", "min_y", "max_y")]
+            heatmap_class = registry.resolve(registry.SERVICES, "heatmap", init_config.get("services"))
+            heatmap = heatmap_class(
+                heatmap_config["client_id"],
+                heatmap_config["topics_sub"],
+                extent,
+                heatmap_config["cell_size"],
+                heatmap_config["variants"],
+                heatmap_config["half_life"],
+                heatmap_config["window"],
+                heatmap_config["bucket"],
+                heatmap_config["max_gap"],
+                heatmap_config.get("path"),
+                heatmap_config["save_interval"],
+                heatmap_config["host"],
+                heatmap_config["port"],
+                control_queue,
+                transport=transport_profile(config, heatmap_config.get("transport_profile")),
+                profiling=profiling_config
+            )
+
+            proc_list.append(heatmap)
+            consumer_list.append(heatmap)
         
         #  --- Start Processes ---
         
-        linear_to_loc.start()
-        time.sleep(1)
-        raw_to_linear.start()
-        time.sleep(1)
+        # Consumers are independent of each other so they are started together, the data source only starts once
+        # every consumer has subscribed so no data is published before it can be received.
+        start_and_wait_until_ready(consumer_list, control_queue, init_config["ready_timeout"])
         sensor_to_raw.start()
-        time.sleep(1)
         
         # Check if this is a timed live test run or a historical data input.
         # If this is a un-timed live run, i.e runtime=0: user stops application with SIGINT to cli.
@@ -6,6 +6,7 @@ import signal
 import json
 from PyQt5.QtWidgets import (QApplication)
 from app.Visualization.Components.plotter_gui import PlotterGUI
+from app.lib.message_handler import transport_profile
 
 
 def sigint_handler(signal, frame):
@@ -21,6 +22,8 @@ if __name__ == '__main__':
             config = json.load(config_file)
 
         settings = config.get("visualization_PyQt.py")
+        settings["transport"] = transport_profile(config, settings.get("transport_profile"))
+        settings["metrics"] = config.get("metrics.py")
         app = QApplication(sys.argv)
         gui = PlotterGUI(settings)
         QApplication.instance().moveToThread(QApplication.instance().thread())